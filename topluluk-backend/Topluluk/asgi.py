@@ -10,7 +10,7 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 import os
 
 from django.core.asgi import get_asgi_application
-from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.routing import ProtocolTypeRouter, URLRouter, ChannelNameRouter
 from channels.security.websocket import AllowedHostsOriginValidator
 import communities.routing
 from communities.authentication import JWTAuthMiddleware
@@ -25,5 +25,8 @@ application = ProtocolTypeRouter({
                 communities.routing.websocket_urlpatterns
             )
         )
-    )
+    ),
+    'channel': ChannelNameRouter(
+        communities.routing.worker_channels
+    ),
 })
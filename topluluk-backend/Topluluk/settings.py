@@ -56,6 +56,8 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'communities.middleware.QueryBudgetMiddleware',
+    'communities.middleware.SamplingProfilerMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -64,10 +66,23 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# queries of every request are counted, requests over the budget are logged
+QUERY_BUDGET_HEADERS = DEBUG # X-Query-Count, X-Query-Time and X-Query-Duplicates response headers
+QUERY_BUDGET_MAX_QUERIES = 30
+QUERY_BUDGET_MAX_TIME_MS = 500
+
+# prometheus metrics on /metrics, scrapers send the token as a bearer token when it is set
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+# stack samples of slow requests are logged for this fraction of the requests
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_INTERVAL = 0.005 # seconds between samples
+PROFILE_SLOW_REQUEST_MS = 1000
+PROFILE_TOP_STACKS = 5
+
 ROOT_URLCONF = 'Topluluk.urls'
 
 REST_FRAMEWORK = {
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    'DEFAULT_PAGINATION_CLASS': 'communities.pagination.KeysetCursorPagination',
     'PAGE_SIZE': 10,
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'communities.authentication.CookieJWTAuthentication',
@@ -105,15 +120,114 @@ TEMPLATES = [
 
 ASGI_APPLICATION = 'Topluluk.asgi.application'
 
+REDIS_HOST = os.getenv('REDIS_HOST', 'topluluk_redis')
+REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
+# the channel layer uses database 0, application data lives in database 1
+REDIS_URL = f'redis://{REDIS_HOST}:{REDIS_PORT}/1'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'cache',
+    }
+}
+
+# users resolved from access tokens
+USER_CACHE_TTL = 60 # seconds in redis
+USER_CACHE_LOCAL_TTL = 5 # seconds in every worker, changes reach other workers after it
+USER_CACHE_LOCAL_SIZE = 10000
+AUTHORIZATION_CACHE_TTL = 60*10 # moderated communities and bans of a user, changes invalidate it
+
+# rendered topic and community details, a change of the object makes a new version
+RESPONSE_CACHE_TTL = 60*10
+RESPONSE_CACHE_VERSION_TTL = 60*60*24*30
+RESPONSE_CACHE_THROTTLE = 10 # seconds between the versions of votes, views and subscriptions
+RESPONSE_CACHE_LOCAL_TTL = 60 # slug to id lookups in every worker, deleted slugs are forgotten after it
+RESPONSE_CACHE_LOCAL_SIZE = 10000
+TIERED_CACHE_LOCAL_SIZE = 10000 # entries of every shared cache in every worker
+OBJECT_CACHE_TTL = 60*60 # communities and profile slugs, changes invalidate them
+PROFILE_CARD_TTL = 60 # karma on the profile cards is refreshed after it
+PROFILE_CARD_STALE_TTL = 60*10
+STATS_CACHE_TTL = 60 # results of the stats views per time window
+STATS_CACHE_REFRESH_AHEAD = 15 # seconds before the ttl a worker recomputes a result in the background
+STATS_CACHE_STALE_TTL = 60*5
+STATS_CACHE_FALLBACK_TTL = 60*60*24 # the last good result is served while recomputing it fails
+STATS_STATEMENT_TIMEOUT = 5000 # milliseconds a query of a stats recomputation may take
+ACTIVITY_EXACT_COUNT_LIMIT = 1_000_000 # rows of all activity tables above which the activity is estimated
+ACTIVITY_RETENTION_HOURS = 24*31 # hourly activity counters in redis
+TOPIC_CARD_TTL = 60 # counters on the topic cards of the trending topics are refreshed after it
+TOPIC_CARD_STALE_TTL = 60*10
+TRENDING_WINDOW_MINUTES = 60 # default window of the trending views
+TRENDING_MAX_WINDOW_MINUTES = 60*6 # per minute buckets are kept this long
+TRENDING_MERGE_TTL = 5 # seconds a merged window is reused
+TRENDING_WEIGHTS = {
+    'view': 1,
+    'vote': 2,
+    'comment': 3,
+    'post': 5,
+    'subscription': 5,
+}
+
+# new topics wait on the notification-fanout channel until the worker picks
+# them up. messages still waiting after CHANNEL_MESSAGE_EXPIRY are dropped and
+# sends to a full channel fail, in both cases the notifications of the topic
+# are lost, so a worker may be down for about this long without losing any
+CHANNEL_MESSAGE_EXPIRY = 60*15 # seconds
+NOTIFICATION_FANOUT_CAPACITY = 10000 # topics waiting for the worker
+
 CHANNEL_LAYERS = {
     'default': {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
         'CONFIG': {
-            'hosts': [('topluluk_redis', 6379)]
+            'hosts': [(REDIS_HOST, REDIS_PORT)],
+            'expiry': CHANNEL_MESSAGE_EXPIRY,
+            'channel_capacity': {
+                'notification-fanout': NOTIFICATION_FANOUT_CAPACITY,
+            },
         }
     }
 }
 
+# home timeline of subscribed communities
+HOME_TIMELINE_SIZE = 500 # topic ids kept per user
+HOME_TIMELINE_TTL = 60*60*24*7 # timelines of inactive users expire and are rebuilt on read
+HOME_TIMELINE_FANOUT_LIMIT = 10000 # bigger communities are merged on read instead
+
+NOTIFICATION_FANOUT_CHUNK_SIZE = 1000 # notifications inserted and sent per batch by the worker
+NOTIFICATION_COALESCE_WINDOW = datetime.timedelta(hours=1) # unread notifications of the same target are merged within it
+NOTIFICATION_COALESCE_MAX_AGE = datetime.timedelta(days=7) # older notifications are not merged into anymore
+# notifications are kept in monthly partitions, run
+# `python manage.py manage_notification_partitions` daily to apply these
+NOTIFICATION_READ_RETENTION = datetime.timedelta(days=30)
+NOTIFICATION_UNREAD_RETENTION = datetime.timedelta(days=180)
+NOTIFICATION_PURGE_CHUNK_SIZE = 1000 # rows deleted per statement by the purge
+NOTIFICATION_PARTITION_LOCK_TIMEOUT = '5s' # partition changes give up instead of queueing behind long locks
+NOTIFICATION_PAGE_SIZE = 20 # unread notifications sent to a socket per request
+NOTIFICATION_RESUME_LIMIT = 100 # missed notifications sent to a reconnecting socket
+NOTIFICATION_UNREAD_COUNT_TTL = 60*60*24 # cached unread counts are recomputed after it
+NOTIFICATION_BATCH_DELAY = 0.01 # seconds notifications wait to be sent to a socket in one frame
+NOTIFICATION_BUFFER_SIZE = 100 # notifications waiting per socket before the buffer policy applies
+NOTIFICATION_BUFFER_POLICY = 'collapse' # 'collapse' into a count the client refetches, or 'drop' the oldest
+# absolute links of notifications that are not created inside a request
+BACKEND_URL = os.getenv('BACKEND_URL', 'http://localhost:8000')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'communities': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
+    },
+}
+
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
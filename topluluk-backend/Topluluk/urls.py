@@ -20,7 +20,7 @@ from django.conf import settings
 from rest_framework.routers import DefaultRouter
 
 from communities import views as community_views
-from communities.views import MyProfileView, Subscriptions, SearchAPI
+from communities.views import MyProfileView, Subscriptions, SearchAPI, HomeTimeline, MetricsView
 
 router = DefaultRouter()
 router.register('profile', community_views.ProfileViewSet, basename='profile')
@@ -37,9 +37,11 @@ urlpatterns = [
     path('stats/', include('stats.urls')),
     path('search/', SearchAPI.as_view(), name='search'),
     path('subscriptions/', Subscriptions.as_view(), name='subscriptions'),
+    path('timeline/', HomeTimeline.as_view(), name='timeline'),
     path('my_profile/', MyProfileView.as_view(), name='my_profile'),
     path('api/login/', community_views.LoginView.as_view(), name='login'),
     path('api/logout/', community_views.LogoutView.as_view(), name='logout'),
     path('api/token/refresh/', community_views.CookieTokenRefreshView.as_view(), name='token_refresh'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
 ]
 urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
@@ -0,0 +1,70 @@
+import datetime
+
+import redis
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from communities.redis_client import get_redis
+
+# bounded time counts of the website activity. all time totals come from the
+# row estimates the planner keeps in pg_class, windows from hourly redis
+# counters and hyperloglogs of the active users that new rows add to.
+# the hourly keys expire after ACTIVITY_RETENTION_HOURS, longer windows can
+# only be counted exactly
+
+HOUR_FORMAT = '%Y%m%d%H'
+
+
+def count_key(hour):
+    return f'activity_count:{hour:{HOUR_FORMAT}}'
+
+
+def users_key(hour):
+    return f'activity_users:{hour:{HOUR_FORMAT}}'
+
+
+def record_activity(user_id=None):
+    hour = timezone.now()
+    ttl = settings.ACTIVITY_RETENTION_HOURS * 60 * 60
+    pipeline = get_redis().pipeline(transaction=False)
+    pipeline.incr(count_key(hour))
+    pipeline.expire(count_key(hour), ttl)
+    if user_id is not None:
+        pipeline.pfadd(users_key(hour), user_id)
+        pipeline.expire(users_key(hour), ttl)
+    try:
+        pipeline.execute()
+    except redis.RedisError:
+        # the approximate counts miss it, the exact ones do not
+        pass
+
+
+def last_hours(hours):
+    # the current hour and the ones before it
+    now = timezone.now()
+    return [now - datetime.timedelta(hours=offset) for offset in range(hours)]
+
+
+def windowed_activity(hours):
+    hours_of_window = last_hours(hours)
+    if not hours_of_window:
+        return 0, 0
+    client = get_redis()
+    counts = client.mget([count_key(hour) for hour in hours_of_window])
+    active_users = client.pfcount(*[users_key(hour) for hour in hours_of_window])
+    return sum(int(count) for count in counts if count is not None), active_users
+
+
+def estimated_row_counts(models):
+    # reltuples is -1 for tables that were never vacuumed or analyzed, they
+    # are left out and counted exactly by the caller
+    tables = [model._meta.db_table for model in models]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT t.name, c.reltuples FROM unnest(%s::text[]) AS t(name) '
+            'JOIN pg_class c ON c.oid = to_regclass(t.name) WHERE c.reltuples >= 0',
+            [tables]
+        )
+        estimates = dict(cursor.fetchall())
+    return {model: int(estimates[model._meta.db_table]) for model in models if model._meta.db_table in estimates}
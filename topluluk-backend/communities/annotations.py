@@ -0,0 +1,59 @@
+from django.db.models import F, Func, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from communities.models import Subscriber, CommunityClick, TopicClick, TopicVote, CommentVote, Comment
+
+# correlated subqueries that compute the counters of the models for a whole
+# queryset at once, they can be used with annotate() and order_by()
+
+
+def aggregate_subquery(queryset, function, field='id'):
+    # a plain function instead of an aggregate keeps the subquery free of GROUP BY
+    return Coalesce(
+        Subquery(
+            queryset.order_by().annotate(total=Func(F(field), function=function)).values('total'),
+            output_field=IntegerField()
+        ),
+        Value(0)
+    )
+
+
+def created_after(queryset, after_time, field='created_date'):
+    if after_time is None:
+        return queryset
+    return queryset.filter(**{f'{field}__gt': after_time})
+
+
+def community_subscriber_total(after_time=None):
+    subscribers = Subscriber.objects.filter(community=OuterRef('pk'))
+    return aggregate_subquery(created_after(subscribers, after_time, field='joined_date'), 'COUNT')
+
+
+def community_view_total(after_time=None):
+    community_clicks = CommunityClick.objects.filter(community=OuterRef('pk'))
+    topic_clicks = TopicClick.objects.filter(topic__community=OuterRef('pk'))
+    return (aggregate_subquery(created_after(community_clicks, after_time), 'COUNT') +
+            aggregate_subquery(created_after(topic_clicks, after_time), 'COUNT'))
+
+
+def topic_vote_total():
+    return aggregate_subquery(TopicVote.objects.filter(topic=OuterRef('pk')), 'SUM', field='value')
+
+
+def topic_view_total():
+    return aggregate_subquery(TopicClick.objects.filter(topic=OuterRef('pk')), 'COUNT')
+
+
+def topic_hot_score():
+    return topic_view_total() + topic_vote_total() * 5
+
+
+def topic_comment_total():
+    return aggregate_subquery(Comment.objects.filter(topic=OuterRef('pk')), 'COUNT')
+
+
+def profile_karma_total(after_time=None):
+    topic_votes = TopicVote.objects.filter(topic__user=OuterRef('user'))
+    comment_votes = CommentVote.objects.filter(comment__user=OuterRef('user'))
+    return (aggregate_subquery(created_after(topic_votes, after_time), 'SUM', field='value') +
+            aggregate_subquery(created_after(comment_votes, after_time), 'SUM', field='value'))
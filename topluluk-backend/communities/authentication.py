@@ -1,11 +1,40 @@
 from channels.middleware import BaseMiddleware
 from channels.db import database_sync_to_async
-from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.models import AnonymousUser, User
 from django.http import parse_cookie
+from django.utils.translation import gettext_lazy as _
 from rest_framework_simplejwt.authentication import JWTAuthentication
-from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.exceptions import InvalidToken, AuthenticationFailed
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.utils import get_md5_hash_password
 
-class CookieJWTAuthentication(JWTAuthentication):
+from communities.user_cache import get_cached_user
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    # same checks as JWTAuthentication.get_user with the user loaded from the cache
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        try:
+            user = get_cached_user(user_id)
+        except User.DoesNotExist:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+
+        if api_settings.CHECK_USER_IS_ACTIVE and not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+
+        if api_settings.CHECK_REVOKE_TOKEN:
+            if validated_token.get(api_settings.REVOKE_TOKEN_CLAIM) != get_md5_hash_password(user.password):
+                raise AuthenticationFailed(_("The user's password has been changed."), code='password_changed')
+
+        return user
+
+
+class CookieJWTAuthentication(CachedJWTAuthentication):
     def authenticate(self, request):
         raw_token = request.COOKIES.get('access')
         if not raw_token:
@@ -17,12 +46,16 @@ class CookieJWTAuthentication(JWTAuthentication):
         except InvalidToken:
             return None
 
+
 # authentication middleware for websocket authentication
+websocket_authentication = CachedJWTAuthentication()
+
+
 @database_sync_to_async
 def get_user_from_token(token):
     try:
-        validated_token = JWTAuthentication().get_validated_token(token)
-        return JWTAuthentication().get_user(validated_token)
+        validated_token = websocket_authentication.get_validated_token(token)
+        return websocket_authentication.get_user(validated_token)
     except Exception:
         return AnonymousUser()
 
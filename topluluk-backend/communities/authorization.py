@@ -0,0 +1,76 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from communities.models import Moderator, Ban
+
+# moderated communities and active bans of a user, loaded once per request
+# and cached in redis under a per user version that Moderator and Ban
+# changes bump. bans keep their expiry, so they end without invalidation.
+
+
+class UserAuthorization:
+    def __init__(self, moderated_community_ids=(), ban_expiries=None):
+        self.moderated_community_ids = set(moderated_community_ids)
+        # community id -> expiry timestamp, None for permanent bans
+        self.ban_expiries = ban_expiries or {}
+
+    def is_moderator(self, community_id):
+        return community_id in self.moderated_community_ids
+
+    def is_banned(self, community_id):
+        if community_id not in self.ban_expiries:
+            return False
+        expires_at = self.ban_expiries[community_id]
+        return expires_at is None or time.time() < expires_at
+
+
+def authorization_version_key(user_id):
+    return f'authorization_version:{user_id}'
+
+
+def authorization_key(user_id, version):
+    return f'authorization:{user_id}:{version}'
+
+
+def load_authorization(user_id):
+    moderated = Moderator.objects.filter(user_id=user_id).values_list('community_id', flat=True)
+    ban_expiries = {}
+    for community_id, expires_at in Ban.objects.active().filter(user_id=user_id).values_list(
+        'community_id', 'expires_at'
+    ):
+        # the longest ban of a community counts
+        expires_at = expires_at.timestamp() if expires_at is not None else None
+        if community_id in ban_expiries and (ban_expiries[community_id] is None or expires_at is not None and
+                                             expires_at < ban_expiries[community_id]):
+            continue
+        ban_expiries[community_id] = expires_at
+    return UserAuthorization(moderated, ban_expiries)
+
+
+def get_user_authorization(user_id):
+    key = authorization_key(user_id, cache.get(authorization_version_key(user_id), 0))
+    authorization = cache.get(key)
+    if authorization is None:
+        authorization = load_authorization(user_id)
+        cache.set(key, authorization, settings.AUTHORIZATION_CACHE_TTL)
+    return authorization
+
+
+def get_authorization(request):
+    # memoized on the request, permissions and views share it
+    if not hasattr(request, 'user_authorization'):
+        if request.user.is_authenticated:
+            request.user_authorization = get_user_authorization(request.user.id)
+        else:
+            request.user_authorization = UserAuthorization()
+    return request.user_authorization
+
+
+def forget_authorization(user_id):
+    try:
+        cache.incr(authorization_version_key(user_id))
+    except ValueError:
+        # readers without a version use 0
+        cache.set(authorization_version_key(user_id), 1, None)
@@ -0,0 +1,144 @@
+import http.client
+import json
+import math
+import os
+import platform
+import threading
+import time
+import urllib.parse
+
+from django.db import connections
+from django.test import Client
+from django.utils import timezone
+
+# helpers shared by the benchmark commands, a run is a dict of named
+# measurements that can be saved as a baseline and compared with a later run
+
+
+def percentile(sorted_values, fraction):
+    # nearest rank, the values must be sorted
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+def summarize(latencies, errors, elapsed):
+    # latencies in seconds, the summary is in milliseconds
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'requests': count,
+        'errors': errors,
+        'throughput': count / elapsed if elapsed else 0.0,
+        'mean': sum(latencies) / count * 1000 if count else 0.0,
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p95': percentile(latencies, 0.95) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'max': latencies[-1] * 1000 if count else 0.0,
+    }
+
+
+class LatencyRecorder:
+    # collects the latencies of the worker threads of one measurement
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def add(self, latency, ok=True):
+        with self.lock:
+            self.latencies.append(latency)
+            if not ok:
+                self.errors += 1
+
+    def summary(self):
+        finished = self.finished or time.perf_counter()
+        return summarize(self.latencies, self.errors, finished - self.started)
+
+
+class LocalClient:
+    # runs the requests in this process, every thread gets its own client
+    # and database connection
+    def __init__(self):
+        self.client = Client(HTTP_HOST='localhost')
+
+    def request(self, method, path, body, token):
+        self.client.cookies['access'] = token
+        if method == 'GET':
+            return self.client.get(path).status_code
+        return self.client.generic(method, path, json.dumps(body or {}), content_type='application/json').status_code
+
+    def close(self):
+        connections.close_all()
+
+
+class RemoteClient:
+    # keeps one connection per thread to a running server
+    def __init__(self, url):
+        parts = urllib.parse.urlsplit(url)
+        connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+        self.connection = connection_class(parts.hostname, parts.port, timeout=30)
+
+    def request(self, method, path, body, token):
+        headers = {'Cookie': f'access={token}', 'Content-Type': 'application/json'}
+        self.connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+        response = self.connection.getresponse()
+        response.read()
+        return response.status
+
+    def close(self):
+        self.connection.close()
+
+
+def process_memory(pid=None):
+    # resident memory in bytes from /proc, None where it is not available
+    try:
+        with open(f'/proc/{pid or "self"}/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def new_run(options):
+    return {
+        'created': timezone.now().isoformat(),
+        'python': platform.python_version(),
+        'options': options,
+        'results': {},
+    }
+
+
+def save_run(run, path):
+    with open(path, 'w') as file:
+        json.dump(run, file, indent=2, sort_keys=True)
+
+
+def load_run(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+# metrics where a bigger value is worse, the others get worse when they shrink
+LOWER_IS_BETTER = {'mean', 'p50', 'p95', 'p99', 'max', 'errors'}
+
+
+def find_regressions(run, baseline, threshold, metrics=('p50', 'p95', 'p99', 'throughput')):
+    # (name, metric, baseline value, new value) of every metric that got
+    # worse by more than the threshold, a fraction of the baseline value
+    regressions = []
+    for name, result in run['results'].items():
+        previous = baseline['results'].get(name)
+        if previous is None:
+            continue
+        for metric in metrics:
+            old, new = previous.get(metric), result.get(metric)
+            if old is None or new is None or old == 0:
+                continue
+            change = (new - old) / old
+            if metric not in LOWER_IS_BETTER:
+                change = -change
+            if change > threshold:
+                regressions.append((name, metric, old, new))
+    return regressions
@@ -0,0 +1,244 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, connections
+
+from communities.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+_missing = object()
+
+
+class LocalCache:
+    # in-process LRU cache whose entries expire after `ttl` seconds, the
+    # threads of a worker share it so every operation takes the lock
+    def __init__(self, max_size=1000, ttl=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            expires_at, value = self.entries.get(key, (0, _missing))
+            if value is _missing or expires_at < time.monotonic():
+                self.entries.pop(key, None)
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# values shared by the workers: every worker keeps the ones it read in a
+# LocalCache in front of redis. a value is fresh for `ttl` seconds and then
+# served for `stale_ttl` more seconds while one worker recomputes it in the
+# background, with `refresh_ahead` the recomputation starts that many seconds
+# before it goes stale. after that it is kept `fallback_ttl` more seconds and
+# served only while the database fails to recompute it or another worker is
+# recomputing it. invalidate() removes a value from redis and publishes its
+# key, every worker drops it from its LocalCache when the message arrives
+INVALIDATION_CHANNEL = 'cache_invalidation'
+
+tiered_caches = {}
+listener = None
+listener_lock = threading.Lock()
+
+
+class TieredCache:
+    lock_timeout = 10
+    wait_interval = 0.05
+
+    def __init__(self, name, ttl, stale_ttl=0, refresh_ahead=0, fallback_ttl=0, local_ttl=None, local_size=None):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.refresh_ahead = refresh_ahead
+        self.fallback_ttl = fallback_ttl
+        self.local = LocalCache(max_size=local_size or settings.TIERED_CACHE_LOCAL_SIZE, ttl=local_ttl or ttl)
+        tiered_caches[name] = self
+
+    def redis_key(self, key):
+        return f'tiered:{self.name}:{key}'
+
+    def lock_key(self, key):
+        return f'tiered_lock:{self.name}:{key}'
+
+    def get(self, key, compute):
+        start_invalidation_listener()
+        now = time.time()
+        entry = self.local.get(key)
+        if entry is None or entry[1] - self.refresh_ahead < now:
+            # an old local entry may already be refreshed by another worker
+            entry = cache.get(self.redis_key(key)) or entry
+            if entry is not None:
+                self.local.set(key, entry)
+        if entry is None:
+            return self.load(key, compute)
+        value, fresh_until = entry
+        if fresh_until + self.stale_ttl < now:
+            return self.load(key, compute, fallback=entry)
+        if fresh_until - self.refresh_ahead < now:
+            self.refresh_in_background(key, compute)
+        return value
+
+    def expired(self, entry):
+        return entry is None or entry[1] + self.stale_ttl < time.time()
+
+    def get_many(self, keys, compute_many):
+        # compute_many gets keys and returns a dict of the ones it found. the
+        # missing keys are computed together without single flight, stale
+        # values are served and refreshed together in the background
+        start_invalidation_listener()
+        now = time.time()
+        entries = {key: self.local.get(key) for key in keys}
+        # old local entries may already be refreshed by another worker
+        old = [key for key, entry in entries.items() if entry is None or entry[1] - self.refresh_ahead < now]
+        if old:
+            found = cache.get_many([self.redis_key(key) for key in old])
+            for key in old:
+                entry = found.get(self.redis_key(key))
+                if entry is not None:
+                    self.local.set(key, entry)
+                    entries[key] = entry
+
+        values = {}
+        stale = []
+        for key, entry in entries.items():
+            if self.expired(entry):
+                continue
+            values[key] = entry[0]
+            if entry[1] - self.refresh_ahead < now:
+                stale.append(key)
+        missing = [key for key in keys if key not in values]
+        if missing:
+            computed = compute_many(missing)
+            for key, value in computed.items():
+                self.set(key, value)
+            values.update(computed)
+        if stale:
+            self.refresh_many_in_background(stale, compute_many)
+        return values
+
+    def set(self, key, value):
+        entry = (value, time.time() + self.ttl)
+        cache.set(self.redis_key(key), entry, self.ttl + self.stale_ttl + self.fallback_ttl)
+        self.local.set(key, entry)
+
+    def load(self, key, compute, fallback=None):
+        # one worker computes a missing value, the others wait for it in redis
+        # and compute it themselves if it does not show up in time
+        locked = cache.add(self.lock_key(key), 1, self.lock_timeout)
+        if not locked:
+            if fallback is not None:
+                return fallback[0]
+            deadline = time.monotonic() + self.lock_timeout
+            while time.monotonic() < deadline:
+                time.sleep(self.wait_interval)
+                entry = cache.get(self.redis_key(key))
+                if entry is not None:
+                    self.local.set(key, entry)
+                    return entry[0]
+        release = locked
+        try:
+            value = compute()
+            self.set(key, value)
+            return value
+        except DatabaseError:
+            if fallback is None:
+                raise
+            # the lock is kept until it times out, so the other workers serve
+            # the fallback too instead of retrying against the database
+            release = False
+            logger.warning('recomputing %s %s failed, serving the last good value', self.name, key, exc_info=True)
+            return fallback[0]
+        finally:
+            if release:
+                cache.delete(self.lock_key(key))
+
+    def refresh_in_background(self, key, compute):
+        self.refresh_many_in_background([key], lambda keys: {key: compute()})
+
+    def refresh_many_in_background(self, keys, compute_many):
+        # keys another worker is refreshing are left to it
+        keys = [key for key in keys if cache.add(self.lock_key(key), 1, self.lock_timeout)]
+        if not keys:
+            return
+
+        def refresh():
+            try:
+                for key, value in compute_many(keys).items():
+                    self.set(key, value)
+                cache.delete_many([self.lock_key(key) for key in keys])
+            except Exception:
+                # retried once the locks time out
+                logger.exception('refreshing %s %s failed', self.name, ', '.join(map(str, keys)))
+            finally:
+                connections.close_all()
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def invalidate(self, key):
+        cache.delete(self.redis_key(key))
+        self.local.delete(key)
+        try:
+            get_redis().publish(INVALIDATION_CHANNEL, json.dumps([self.name, key]))
+        except redis.RedisError:
+            logger.warning('could not publish the invalidation of %s %s', self.name, key, exc_info=True)
+
+
+def clear_local_caches():
+    for tiered_cache in tiered_caches.values():
+        tiered_cache.local.clear()
+
+
+def start_invalidation_listener():
+    global listener
+    if listener is not None and listener.is_alive():
+        return
+    with listener_lock:
+        if listener is None or not listener.is_alive():
+            listener = threading.Thread(target=listen_for_invalidations, daemon=True, name='cache-invalidation')
+            listener.start()
+
+
+def listen_for_invalidations():
+    delay = 1
+    while True:
+        try:
+            pubsub = get_redis().pubsub()
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            for message in pubsub.listen():
+                if message['type'] == 'subscribe':
+                    # invalidations published while disconnected are lost
+                    clear_local_caches()
+                    delay = 1
+                elif message['type'] == 'message':
+                    name, key = json.loads(message['data'])
+                    tiered_cache = tiered_caches.get(name)
+                    if tiered_cache is not None:
+                        tiered_cache.local.delete(key)
+        except redis.RedisError:
+            logger.warning('cache invalidation listener disconnected, reconnecting in %ds', delay, exc_info=True)
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
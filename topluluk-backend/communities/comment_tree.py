@@ -0,0 +1,185 @@
+import base64
+import binascii
+import json
+import math
+from collections import defaultdict
+
+from django.db.models import Q, F, Window, OuterRef, Exists, FloatField
+from django.db.models.functions import RowNumber
+
+from communities.models import Comment
+from communities.pagination import keyset_condition
+
+# orderings of a thread level as (field, descending) pairs, every one of them
+# ends with the id and is served by an index on (topic, upper_comment, ...)
+COMMENT_SORTS = {
+    'old': [('id', False)],
+    'new': [('id', True)],
+    'top': [('score', True), ('id', True)],
+    'best': [('best_score', True), ('id', True)],
+}
+
+
+def sort_order_by(sort):
+    return [F(field).desc() if descending else F(field).asc() for field, descending in COMMENT_SORTS[sort]]
+
+
+def sort_position(sort, comment):
+    return [getattr(comment, field) for field, _ in COMMENT_SORTS[sort]]
+
+
+def parse_position(sort, position):
+    # raises ValueError unless position has a value of the right type for
+    # every field of the sort, decoded cursors come from the client
+    fields = COMMENT_SORTS[sort]
+    if not isinstance(position, list) or len(position) != len(fields):
+        raise ValueError('invalid cursor')
+    parsed = []
+    for (field, _), value in zip(fields, position):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError('invalid cursor')
+        if isinstance(Comment._meta.get_field(field), FloatField):
+            if not math.isfinite(value):
+                raise ValueError('invalid cursor')
+            parsed.append(float(value))
+        else:
+            if not isinstance(value, int) or abs(value) >= 2 ** 63:
+                raise ValueError('invalid cursor')
+            parsed.append(value)
+    return parsed
+
+
+def after_position(sort, position):
+    # keyset condition for everything that comes after position in the sort
+    return keyset_condition(COMMENT_SORTS[sort], position)
+
+
+class CommentTree:
+    # loads every comment of the given topics with a single query
+    # and links them in memory, so serializing a thread does not
+    # hit the database once per comment
+    def __init__(self, topics, sort='old'):
+        topics_by_id = {topic.id: topic for topic in topics}
+        self.topic_ids = set(topics_by_id)
+        self.top_level = defaultdict(list)
+        self.replies = defaultdict(list)
+
+        comments = Comment.objects.filter(
+            topic_id__in=self.topic_ids
+        ).defer('embedding').order_by(*sort_order_by(sort))
+
+        for comment in comments:
+            # reuse the already loaded topic for the hyperlinked topic field
+            comment.topic = topics_by_id[comment.topic_id]
+            if comment.upper_comment_id is None:
+                self.top_level[comment.topic_id].append(comment)
+            else:
+                self.replies[comment.upper_comment_id].append(comment)
+
+    def covers(self, topic):
+        return topic.id in self.topic_ids
+
+    def comments_of(self, topic):
+        return self.top_level.get(topic.id, [])
+
+    def replies_of(self, comment):
+        return self.replies.get(comment.id, [])
+
+
+class CommentThread:
+    # one page of a single thread level plus at most `depth` levels of
+    # replies below it, every level is cut at `limit` comments per parent
+    def __init__(self, topic, parent=None, depth=2, limit=10, sort='old', after=None):
+        self.topic = topic
+        self.parent = parent
+        self.limit = limit
+        self.sort = sort
+        self.replies = defaultdict(list)
+        self.more_replies = {}
+
+        level = Comment.objects.filter(topic=topic, upper_comment=parent).order_by(*sort_order_by(sort))
+        if after is not None:
+            level = level.filter(after_position(sort, after))
+        level = list(self.annotate(level)[:limit + 1])
+        self.has_next = len(level) > limit
+        self.comments = level[:limit]
+
+        level_depth = parent.depth + 1 if parent is not None else 0
+        last_depth = level_depth + depth - 1
+        for comment in self.comments:
+            comment.topic = topic
+        if not self.comments or depth <= 1:
+            self.mark_leaves(self.comments)
+            return
+
+        # one range scan over the paths of the page, limited by depth and
+        # by the number of replies shown under every parent
+        subtree = Q()
+        for comment in self.comments:
+            subtree |= Q(path__startswith=comment.path)
+        descendants = self.annotate(
+            Comment.objects.filter(
+                subtree,
+                topic=topic,
+                depth__gt=level_depth,
+                depth__lte=last_depth,
+            )
+        ).annotate(
+            sibling_rank=Window(RowNumber(), partition_by=[F('upper_comment')], order_by=sort_order_by(sort))
+        ).filter(sibling_rank__lte=limit + 1).order_by('depth', 'upper_comment', 'sibling_rank')
+
+        loaded = {comment.id for comment in self.comments}
+        leaves = []
+        for comment in descendants:
+            # parents cut by the limit drop their whole subtree
+            if comment.upper_comment_id not in loaded:
+                continue
+            comment.topic = topic
+            siblings = self.replies[comment.upper_comment_id]
+            if len(siblings) == limit:
+                self.more_replies[comment.upper_comment_id] = sort_position(sort, siblings[-1])
+                continue
+            siblings.append(comment)
+            loaded.add(comment.id)
+            if comment.depth == last_depth:
+                leaves.append(comment)
+        self.mark_leaves(leaves)
+
+    @staticmethod
+    def annotate(queryset):
+        return queryset.defer('embedding').annotate(
+            has_replies=Exists(Comment.objects.filter(upper_comment=OuterRef('pk'))),
+        )
+
+    def mark_leaves(self, leaves):
+        # replies of the deepest loaded level are not fetched, only announced
+        for comment in leaves:
+            if comment.has_replies:
+                self.more_replies[comment.id] = None
+
+    def next_position(self):
+        return sort_position(self.sort, self.comments[-1])
+
+    def covers(self, topic):
+        return topic.id == self.topic.id
+
+    def replies_of(self, comment):
+        return self.replies.get(comment.id, [])
+
+    def has_more_replies(self, comment):
+        return comment.id in self.more_replies
+
+    def replies_after(self, comment):
+        return self.more_replies.get(comment.id)
+
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor):
+    # raises ValueError for anything that was not produced by encode_cursor
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError('invalid cursor') from e
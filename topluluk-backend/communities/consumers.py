@@ -1,9 +1,21 @@
+from channels.consumer import AsyncConsumer
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 import json
+import logging
+import time
 
-from communities.models import Notification
+from communities.metrics import CHANNEL_SEND_SECONDS, NOTIFICATION_SOCKETS
+from communities.models import Notification, Topic, Subscriber, Profile
+from communities.notifications import create_topic_notifications, user_group_name, community_group_name, \
+    notification_target, notification_texts, get_unread_count, unread_notifications_page, \
+    unread_notifications_since, mark_read_filters, mark_notifications_read
+from communities.outbox import OutboundBuffer
 from communities.serializers import NotificationSerializer
+from communities.timeline import fan_out_topic
+
+logger = logging.getLogger(__name__)
 
 
 class NotificationConsumer(AsyncWebsocketConsumer):
@@ -12,67 +24,228 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             await self.close(code=4001)
             return
 
-        self.group_name = f"user_{self.scope['user'].id}"
+        self.group_name = user_group_name(self.scope['user'].id)
+        self.outbox = OutboundBuffer(
+            self.send_notifications,
+            delay=settings.NOTIFICATION_BATCH_DELAY,
+            max_size=settings.NOTIFICATION_BUFFER_SIZE,
+            policy=settings.NOTIFICATION_BUFFER_POLICY
+        )
+        self.connected_at = time.monotonic()
+        # disconnect decrements it for every socket that got a group name
+        NOTIFICATION_SOCKETS.inc()
 
         await self.channel_layer.group_add(
             self.group_name,
             self.channel_name
         )
 
+        # community wide events are sent once to the community groups,
+        # digest users only get the periodic summary
+        self.community_ids = set()
+        self.digest = await self.wants_digest(self.scope['user'])
+        if not self.digest:
+            for community_id in await self.get_subscribed_community_ids(self.scope['user']):
+                await self.join_community(community_id)
+
         await self.accept()
 
     async def disconnect(self, close_code):
+        if not hasattr(self, 'group_name'):
+            return
+        await self.outbox.close()
+        NOTIFICATION_SOCKETS.dec()
         await self.channel_layer.group_discard(
             self.group_name,
             self.channel_name
         )
+        for community_id in list(self.community_ids):
+            await self.leave_community(community_id)
+        logger.info('notification socket of user %s closed after %.0fs: %s',
+                    self.scope['user'].id, time.monotonic() - self.connected_at, self.outbox.metrics)
 
-    # does not return unread notifications
-    # returns all notifications lol
     @database_sync_to_async
-    def get_unread_notifications(self, user):
-        return list(Notification.objects.filter(user=user).order_by('-created_date'))
+    def wants_digest(self, user):
+        return Profile.objects.filter(user=user, notification_digest=True).exists()
 
     @database_sync_to_async
-    def get_notification_by_id(self, id):
-        try:
-            return Notification.objects.get(id=id)
-        except Notification.DoesNotExist:
-            return None
+    def get_subscribed_community_ids(self, user):
+        return list(Subscriber.objects.filter(user=user).values_list('community_id', flat=True))
+
+    async def join_community(self, community_id):
+        await self.channel_layer.group_add(community_group_name(community_id), self.channel_name)
+        self.community_ids.add(community_id)
+
+    async def leave_community(self, community_id):
+        await self.channel_layer.group_discard(community_group_name(community_id), self.channel_name)
+        self.community_ids.discard(community_id)
+
+    # sent to the user group when the user subscribes or unsubscribes
+    async def subscription_changed(self, event):
+        if self.digest:
+            return
+        if event['subscribed']:
+            await self.join_community(event['community_id'])
+        else:
+            await self.leave_community(event['community_id'])
 
     @database_sync_to_async
-    def mark_notification_as_read(self, notification):
-        notification.is_read = True
-        notification.save()
+    def get_unread_notifications(self, user, cursor, limit):
+        notifications, next_cursor = unread_notifications_page(user, cursor, limit)
+        return NotificationSerializer(notifications, many=True).data, next_cursor, get_unread_count(user.id)
+
+    @database_sync_to_async
+    def get_missed_notifications(self, user, last_id):
+        notifications = unread_notifications_since(user, last_id)
+        return NotificationSerializer(notifications, many=True).data, get_unread_count(user.id)
+
+    @database_sync_to_async
+    def mark_read(self, user, filters):
+        return mark_notifications_read(user.id, filters), get_unread_count(user.id)
 
     async def receive(self, text_data):
         text_data_json = json.loads(text_data)
         message_type = text_data_json['type']
         message_payload = text_data_json.get('payload', '')
         user = self.scope['user']
+        # pages and resumes are answered only to the asking socket
         if message_type == 'unread_notifications':
-            notifications = await self.get_unread_notifications(user)
-            serializer = NotificationSerializer(notifications, many=True)
-            await self.channel_layer.group_send(
-                f'user_{user.id}',
-                {
-                    'type': 'unread_notifications',
-                    'unread_notifications': serializer.data
+            payload = message_payload or {}
+            if not isinstance(payload, dict):
+                await self.send_error('payload must be an object')
+                return
+            try:
+                notifications, next_cursor, unread_count = await self.get_unread_notifications(
+                    user, payload.get('cursor'), int(payload.get('limit', 0))
+                )
+            except (TypeError, ValueError):
+                await self.send_error('invalid cursor or limit')
+                return
+            await self.send(text_data=json.dumps({
+                'type': 'unread_notifications',
+                'payload': {
+                    'results': notifications,
+                    'next': next_cursor,
+                    'unread_count': unread_count,
                 }
-            )
-        elif message_type == 'read_notification':
-            notification = await self.get_notification_by_id(message_payload['id'])
-            if notification:
-                await self.mark_notification_as_read(notification)
+            }))
+        elif message_type == 'resume':
+            try:
+                last_id = int(message_payload['last_id'])
+            except (TypeError, KeyError, ValueError):
+                await self.send_error('last_id is required')
+                return
+            notifications, unread_count = await self.get_missed_notifications(user, last_id)
+            await self.send(text_data=json.dumps({
+                'type': 'missed_notifications',
+                'payload': {
+                    'results': notifications,
+                    'unread_count': unread_count,
+                }
+            }))
+        elif message_type in ('mark_read', 'read_notification'):
+            payload = message_payload or {}
+            # read_notification carries a single notification, community
+            # broadcasts have no id and are found by their target
+            if message_type == 'read_notification' and isinstance(payload, dict) and payload.get('id') is not None:
+                payload = {'ids': [payload['id']]}
+            try:
+                filters = mark_read_filters(payload)
+            except (TypeError, ValueError) as e:
+                await self.send_error(str(e))
+                return
+            marked, unread_count = await self.mark_read(user, filters)
+            await self.send(text_data=json.dumps({
+                'type': 'marked_read',
+                'payload': {
+                    'marked': marked,
+                    'unread_count': unread_count,
+                }
+            }))
 
-    async def notify(self, event):
+    async def send_error(self, message):
         await self.send(text_data=json.dumps({
-            'type': 'notification',
-            'payload': event['notification']
+            'type': 'error',
+            'payload': message
         }))
 
-    async def unread_notifications(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'unread_notifications',
-            'payload': event['unread_notifications']
-        }))
+    async def notify(self, event):
+        message = {
+            'type': 'notification',
+            'payload': event['notification'],
+        }
+        # community broadcasts are shared by every subscriber, reading a count
+        # for each socket would cost a redis read per subscriber. they are sent
+        # without one and clients add them to their own count
+        if not event.get('broadcast'):
+            message['unread_count'] = None
+        self.outbox.push(message)
+
+    async def send_notifications(self, messages):
+        # notifications that arrive together are sent as one array frame with
+        # one count read for the notifications of the user
+        counted = [message for message in messages if 'unread_count' in message]
+        if counted:
+            unread_count = await database_sync_to_async(get_unread_count)(self.scope['user'].id)
+            for message in counted:
+                message['unread_count'] = unread_count
+        if len(messages) == 1:
+            await self.send(text_data=json.dumps(messages[0]))
+        else:
+            await self.send(text_data=json.dumps(messages))
+
+class NotificationFanoutConsumer(AsyncConsumer):
+    # background worker of the notification-fanout channel
+    @database_sync_to_async
+    def get_topic(self, topic_id):
+        try:
+            return Topic.objects.select_related('community').defer('embedding', 'community__embedding').get(id=topic_id)
+        except Topic.DoesNotExist:
+            return None
+
+    async def topic_created(self, message):
+        topic = await self.get_topic(message['topic_id'])
+        if topic is None:
+            return
+        await database_sync_to_async(fan_out_topic)(topic)
+
+        started = time.monotonic()
+        created = 0
+        after_id = 0
+        while True:
+            last_id, touched = await database_sync_to_async(create_topic_notifications)(
+                topic, message['url'], after_id
+            )
+            if last_id == after_id:
+                break
+            after_id = last_id
+            created += touched
+
+        # the rows only keep the read state and the count, every subscriber
+        # receives the same event so it is sent once to the community group.
+        # clients merge it into their unread notification of the same target
+        # and write the new count before merged_information, like the rows.
+        single, merged = notification_texts(Notification.Kind.NEW_POST, name=topic.community.name)
+        with CHANNEL_SEND_SECONDS.time(target='community'):
+            await self.channel_layer.group_send(
+                community_group_name(topic.community_id),
+                {
+                    'type': 'notify',
+                    'broadcast': True,
+                    'notification': {
+                        'id': None,
+                        'kind': Notification.Kind.NEW_POST,
+                        'target': notification_target(topic.community),
+                        'information': single,
+                        'merged_information': merged,
+                        'count': 1,
+                        'direct_url': message['url'],
+                        'created_date': topic.created_date.isoformat(),
+                        'is_read': False,
+                    }
+                }
+            )
+
+        elapsed = time.monotonic() - started
+        logger.info('topic %s: %d notifications in %.2fs (%.0f/s)',
+                    topic.id, created, elapsed, created / elapsed if elapsed else created)
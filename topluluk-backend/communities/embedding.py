@@ -1,5 +1,9 @@
 from sentence_transformers import SentenceTransformer
+
+from communities.metrics import EMBEDDING_SECONDS
+
 model = SentenceTransformer("all-MiniLM-L6-v2")
 
 def generate_embedding(text: str):
-    return model.encode(text).tolist()
\ No newline at end of file
+    with EMBEDDING_SECONDS.time():
+        return model.encode(text).tolist()
\ No newline at end of file
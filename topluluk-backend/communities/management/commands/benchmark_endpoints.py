@@ -0,0 +1,155 @@
+import http.client
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from rest_framework_simplejwt.tokens import AccessToken
+
+from communities.benchmark import LatencyRecorder, LocalClient, RemoteClient, new_run, save_run, load_run, \
+    find_regressions
+from communities.models import Topic, Comment
+
+# name: (method, path, body), the paths and bodies are formatted with the
+# benchmark targets and the index of the request
+READ_ENDPOINTS = {
+    'topic_detail': ('GET', '/topic/{topic}/', None),
+    'topic_comments': ('GET', '/topic/{topic}/comments/', None),
+    'community_topics': ('GET', '/community/{community}/topics/', None),
+    'search': ('GET', '/search/?q={query}', None),
+    'recommendations': ('GET', '/stats/recommendations/', None),
+    'hot_topics': ('GET', '/stats/hot_topics/', None),
+    'most_viewed_communities': ('GET', '/stats/most_viewed_communities/?time=24', None),
+    'most_subscribed_communities': ('GET', '/stats/most_subscribed_communities/?time=24', None),
+    'most_karma_profiles': ('GET', '/stats/most_karma_profiles/?time=24', None),
+    'activity_of_website': ('GET', '/stats/activity_of_website/?time=24', None),
+}
+WRITE_ENDPOINTS = {
+    'topic_vote': ('POST', '/topic/{topic}/{vote}/', None),
+    'comment_vote': ('POST', '/comment/{comment}/{vote}/', None),
+    'comment_create': ('POST', '/comment/', {'topic': '/topic/{topic}/', 'text': 'benchmark comment {index}'}),
+}
+
+
+class Command(BaseCommand):
+    # measures the main read and write flows, run it against a database
+    # filled by generate_synthetic_data. the write endpoints add votes and
+    # comments, use --skip-writes on databases that must not change
+    help = 'Benchmarks the API endpoints and compares the results with a baseline'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='base url of a running server, requests run in this process without it')
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--requests', type=int, default=200, help='measured requests per endpoint')
+        parser.add_argument('--warmup', type=int, default=10, help='requests per endpoint before measuring')
+        parser.add_argument('--users', type=int, default=50, help='number of users sending the requests')
+        parser.add_argument('--endpoints', nargs='*', help='names of the endpoints to run, all by default')
+        parser.add_argument('--skip-writes', action='store_true')
+        parser.add_argument('--topic', help='slug of the benchmarked topic, the one with most comments by default')
+        parser.add_argument('--save', help='path of the json file the results are written to')
+        parser.add_argument('--compare', help='path of a baseline json file')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='allowed change of a metric before it counts as a regression')
+
+    def handle(self, *args, **options):
+        endpoints = dict(READ_ENDPOINTS)
+        if not options['skip_writes']:
+            endpoints.update(WRITE_ENDPOINTS)
+        if options['endpoints']:
+            unknown = set(options['endpoints']) - endpoints.keys()
+            if unknown:
+                raise CommandError(f'unknown endpoints: {", ".join(sorted(unknown))}')
+            endpoints = {name: endpoints[name] for name in options['endpoints']}
+
+        targets = self.targets(options['topic'])
+        users = list(User.objects.filter(profile__interest_vector__isnull=False).order_by('id')[:options['users']])
+        if not users:
+            raise CommandError('no users with profiles, fill the database first')
+
+        run = new_run({
+            key: options[key] for key in ('url', 'concurrency', 'requests', 'warmup', 'users', 'skip_writes')
+        })
+        run['targets'] = targets
+        for name, endpoint in endpoints.items():
+            run['results'][name] = self.measure(endpoint, targets, users, options)
+            self.report(name, run['results'][name])
+
+        if options['save']:
+            save_run(run, options['save'])
+            self.stdout.write(f'saved the results to {options["save"]}')
+        if options['compare']:
+            regressions = find_regressions(run, load_run(options['compare']), options['threshold'])
+            for name, metric, old, new in regressions:
+                self.stdout.write(self.style.ERROR(f'{name} {metric}: {old:.2f} -> {new:.2f}'))
+            if regressions:
+                raise CommandError(f'{len(regressions)} metrics regressed more than {options["threshold"]:.0%}')
+            self.stdout.write(self.style.SUCCESS('no regressions'))
+
+    @staticmethod
+    def targets(topic_slug):
+        if topic_slug:
+            topic = Topic.objects.select_related('community').filter(slug=topic_slug).first()
+        else:
+            topic = Topic.objects.select_related('community').annotate(
+                comment_number=Count('comments')
+            ).order_by('-comment_number').first()
+        if topic is None:
+            raise CommandError('no topic to benchmark')
+        comment = Comment.objects.filter(topic=topic).order_by('id').first()
+        return {
+            'topic': topic.slug,
+            'community': topic.community.slug,
+            'comment': comment.id if comment else 0,
+            'query': urllib.parse.quote(topic.title.split()[0]),
+        }
+
+    def measure(self, endpoint, targets, users, options):
+        # tokens live for minutes, every endpoint gets fresh ones
+        tokens = [str(AccessToken.for_user(user)) for user in users]
+        self.send(endpoint, targets, tokens, options, range(options['warmup']), None)
+        recorder = LatencyRecorder()
+        self.send(endpoint, targets, tokens, options, range(options['warmup'], options['warmup'] + options['requests']),
+                  recorder)
+        recorder.finished = time.perf_counter()
+        return recorder.summary()
+
+    @staticmethod
+    def send(endpoint, targets, tokens, options, indexes, recorder):
+        # the threads share the request indexes, every request alternates
+        # the vote direction and picks the next user
+        method, path, body = endpoint
+        indexes = iter(indexes)
+        lock = threading.Lock()
+
+        def next_index():
+            with lock:
+                return next(indexes, None)
+
+        def worker():
+            client = RemoteClient(options['url']) if options['url'] else LocalClient()
+            try:
+                while (index := next_index()) is not None:
+                    values = dict(targets, index=index, vote='up_vote' if index % 2 else 'down_vote')
+                    request_body = {key: value.format(**values) for key, value in body.items()} if body else None
+                    started = time.perf_counter()
+                    try:
+                        status = client.request(method, path.format(**values), request_body, tokens[index % len(tokens)])
+                    except (OSError, http.client.HTTPException):
+                        status = 0
+                    if recorder is not None:
+                        recorder.add(time.perf_counter() - started, 200 <= status < 300)
+            finally:
+                client.close()
+
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as executor:
+            for future in [executor.submit(worker) for _ in range(options['concurrency'])]:
+                future.result()
+
+    def report(self, name, result):
+        self.stdout.write(
+            f'{name:<28} {result["requests"]:>6} req {result["errors"]:>4} err {result["throughput"]:>8.1f} req/s  '
+            f'p50 {result["p50"]:>8.1f}ms  p95 {result["p95"]:>8.1f}ms  p99 {result["p99"]:>8.1f}ms'
+        )
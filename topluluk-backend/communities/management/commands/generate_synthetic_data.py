@@ -0,0 +1,363 @@
+import bisect
+import csv
+import datetime
+import io
+import itertools
+import random
+import time
+
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.text import slugify
+
+from communities.annotations import topic_hot_score
+from communities.models import Profile, Community, Subscriber, Moderator, Topic, Comment, TopicVote, CommentVote, \
+    TopicClick, CommunityClick, wilson_lower_bound
+
+# rows created with --scale 1, everything grows linearly with the scale.
+# about 450k rows, --scale 25 is roughly 10M
+BASE_COUNTS = {
+    'users': 2000,
+    'communities': 40,
+    'topics': 4000,
+    'comments': 40000,
+    'topic_votes': 40000,
+    'comment_votes': 80000,
+    'topic_clicks': 120000,
+    'community_clicks': 30000,
+}
+MAX_COMMENT_DEPTH = 50
+EMBEDDING_DIMENSIONS = 384
+
+
+def format_vector(vector):
+    # pgvector text input, short enough to keep the COPY stream small
+    return '[' + ','.join(f'{value:.5f}' for value in vector) + ']'
+
+
+def zipf_cum_weights(n, exponent):
+    # the item at rank r is picked with a probability proportional to 1 / r^exponent
+    return list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, n + 1)))
+
+
+class PowerLaw:
+    # picks items by popularity rank, the ranks are shuffled so the popular
+    # items are not simply the ones that were created first
+    def __init__(self, rng, items, exponent):
+        self.rng = rng
+        self.items = list(items)
+        rng.shuffle(self.items)
+        self.cum_weights = zipf_cum_weights(len(self.items), exponent)
+        self.total = self.cum_weights[-1]
+
+    def pick(self):
+        return self.items[bisect.bisect(self.cum_weights, self.rng.random() * self.total)]
+
+
+class Command(BaseCommand):
+    help = 'Fills the database with synthetic communities, topics, comment threads, votes and clicks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=float, default=1.0, help='multiplies every row count')
+        parser.add_argument('--seed', type=int, default=42, help='the same seed generates the same data')
+        parser.add_argument('--days', type=int, default=90, help='rows are spread over the last days')
+        parser.add_argument('--embeddings', choices=['fake', 'model', 'none'], default='fake',
+                            help='fake: deterministic vectors, model: the real embedding model (slow)')
+        parser.add_argument('--prefix', default='synthetic', help='prefix of the generated names')
+        parser.add_argument('--batch-size', type=int, default=20000, help='rows sent per COPY')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('the generator loads rows with COPY and needs postgresql')
+
+        self.rng = random.Random(options['seed'])
+        self.np_rng = np.random.default_rng(options['seed'])
+        self.embeddings = options['embeddings']
+        self.prefix = slugify(options['prefix'])
+        self.batch_size = options['batch_size']
+        self.now = timezone.now()
+        self.start = self.now - datetime.timedelta(days=options['days'])
+        counts = {name: max(1, int(count * options['scale'])) for name, count in BASE_COUNTS.items()}
+
+        started = time.monotonic()
+        user_ids = self.create_users(counts['users'])
+        communities = self.create_communities(counts['communities'], user_ids)
+        self.create_subscriptions(user_ids, communities)
+        topics = self.create_topics(counts['topics'], user_ids, communities)
+        self.create_comments_and_votes(counts['comments'], counts['comment_votes'], user_ids, topics)
+        self.create_topic_votes(counts['topic_votes'], user_ids, topics)
+        self.create_clicks(counts['topic_clicks'], counts['community_clicks'], user_ids, topics, communities)
+
+        # COPY skips the signals that keep the hot scores in sync
+        Topic.objects.update(hot_score=topic_hot_score())
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        self.stdout.write(self.style.SUCCESS(f'done in {time.monotonic() - started:.0f}s'))
+
+    # loading
+
+    def reserve_ids(self, model, count):
+        # moves the id sequence forward once, the generated rows use the skipped ids
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT setval(pg_get_serial_sequence(%s, 'id'), nextval(pg_get_serial_sequence(%s, 'id')) + %s - 1)",
+                [model._meta.db_table, model._meta.db_table, count]
+            )
+            last_id = cursor.fetchone()[0]
+        return range(last_id - count + 1, last_id + 1)
+
+    def copy(self, model, rows):
+        # rows are dicts of field attnames, missing fields get their default
+        # and rows without an id get one from the sequence
+        rows = iter(rows)
+        batch = list(itertools.islice(rows, self.batch_size))
+        fields = [
+            field for field in model._meta.concrete_fields
+            if not (field.primary_key and batch and field.attname not in batch[0])
+        ]
+        columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+        sql = f"COPY {connection.ops.quote_name(model._meta.db_table)} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+        defaults = {field.attname: field.get_default() for field in fields}
+
+        copied = 0
+        while batch:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for row in batch:
+                writer.writerow([self.copy_value(row.get(field.attname, defaults[field.attname])) for field in fields])
+            buffer.seek(0)
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.cursor.copy_expert(sql, buffer)
+            copied += len(batch)
+            batch = list(itertools.islice(rows, self.batch_size))
+        self.stdout.write(f'{model._meta.db_table}: {copied} rows')
+
+    @staticmethod
+    def copy_value(value):
+        if value is None:
+            return '\\N'
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        if isinstance(value, datetime.datetime):
+            return value.isoformat()
+        return value
+
+    # generated values
+
+    def random_date(self, after=None):
+        after = max(after or self.start, self.start)
+        return after + (self.now - after) * self.rng.random()
+
+    def follow_up_date(self, after):
+        # replies and votes mostly come soon after what they answer
+        return min(after + datetime.timedelta(minutes=self.rng.expovariate(1 / 120)), self.now)
+
+    def vector(self, text, base=None):
+        if self.embeddings == 'none':
+            return None, None
+        if self.embeddings == 'model':
+            from communities.embedding import generate_embedding
+            vector = np.array(generate_embedding(text))
+        else:
+            # related rows get vectors close to their base so similarity makes sense
+            vector = self.np_rng.standard_normal(EMBEDDING_DIMENSIONS)
+            if base is not None:
+                vector = base + 0.5 * vector / np.linalg.norm(vector)
+            vector = vector / np.linalg.norm(vector)
+        return vector, format_vector(vector)
+
+    # tables
+
+    def create_users(self, count):
+        ids = list(self.reserve_ids(User, count))
+        password = make_password(f'{self.prefix}-password')
+        users = []
+        profiles = []
+        for user_id in ids:
+            username = f'{self.prefix}-{user_id}'
+            users.append({
+                'id': user_id,
+                'password': password,
+                'username': username,
+                'email': f'{username}@example.com',
+                'date_joined': self.random_date(),
+            })
+            profiles.append({
+                'user_id': user_id,
+                'display_name': username,
+                'image': 'profile_images/default.png',
+                'slug': username,
+            })
+        self.copy(User, users)
+        self.profiles = profiles
+        return ids
+
+    def create_communities(self, count, user_ids):
+        ids = list(self.reserve_ids(Community, count))
+        communities = []
+        moderators = []
+        for community_id in ids:
+            name = f'{self.prefix} community {community_id}'
+            description = f'a generated community about subject {community_id}'
+            vector, embedding = self.vector(name + ' ' + description)
+            communities.append({
+                'id': community_id,
+                'name': name,
+                'image': 'community_images/default.png',
+                'description': description,
+                'created_date': self.random_date(),
+                'embedding': embedding,
+                'slug': slugify(name),
+                'vector': vector,
+            })
+            moderators.append({'user_id': self.rng.choice(user_ids), 'community_id': community_id})
+        self.copy(Community, communities)
+        self.copy(Moderator, moderators)
+        return communities
+
+    def create_subscriptions(self, user_ids, communities):
+        # a few communities have most of the subscribers
+        popularity = PowerLaw(self.rng, communities, exponent=1.1)
+        subscribers = []
+        for user_id, profile in zip(user_ids, self.profiles):
+            subscribed = {}
+            for _ in range(min(len(communities), int(self.rng.paretovariate(1.2)) + 1)):
+                community = popularity.pick()
+                subscribed[community['id']] = community
+            for community in subscribed.values():
+                subscribers.append({
+                    'user_id': user_id,
+                    'community_id': community['id'],
+                    'joined_date': self.random_date(community['created_date']),
+                })
+            # interests start at the first subscribed community
+            first = next(iter(subscribed.values()))
+            if first['embedding'] is not None:
+                profile.update({
+                    'interest_vector': first['embedding'],
+                    'weighted_sum_vector': first['embedding'],
+                    'total_weight': 1,
+                })
+        self.copy(Profile, self.profiles)
+        self.copy(Subscriber, subscribers)
+
+    def create_topics(self, count, user_ids, communities):
+        community_popularity = PowerLaw(self.rng, communities, exponent=1.1)
+        # few users write most of the topics
+        authors = PowerLaw(self.rng, user_ids, exponent=0.8)
+        topics = []
+        for topic_id in self.reserve_ids(Topic, count):
+            community = community_popularity.pick()
+            title = f'{self.prefix} topic {topic_id}'
+            text = f'generated text of topic {topic_id} in {community["name"]}'
+            vector, embedding = self.vector(title + ' ' + text, community['vector'])
+            topics.append({
+                'id': topic_id,
+                'community_id': community['id'],
+                'title': title,
+                'text': text,
+                'created_date': self.random_date(community['created_date']),
+                'user_id': authors.pick(),
+                'embedding': embedding,
+                'slug': slugify(title),
+            })
+        self.copy(Topic, topics)
+        return topics
+
+    def create_comments_and_votes(self, count, vote_count, user_ids, topics):
+        # viral topics get most of the comments, comments mostly answer the
+        # newest comments of their topic which builds deep threads
+        popularity = PowerLaw(self.rng, topics, exponent=1.0)
+        threads = {}
+        comments = []
+        for comment_id in self.reserve_ids(Comment, count):
+            topic = popularity.pick()
+            thread = threads.setdefault(topic['id'], [])
+            parent = None
+            if thread and self.rng.random() < 0.7:
+                parent = self.rng.choice(thread[-5:])
+                if parent['depth'] >= MAX_COMMENT_DEPTH:
+                    parent = None
+            text = f'generated comment {comment_id}'
+            comment = {
+                'id': comment_id,
+                'topic_id': topic['id'],
+                'text': text,
+                'created_date': self.follow_up_date(parent['created_date'] if parent else topic['created_date']),
+                'user_id': self.rng.choice(user_ids),
+                # the model would be asked once per comment, fake ones reuse the topic vector
+                'embedding': self.vector(text)[1] if self.embeddings == 'model' else topic['embedding'],
+                'upper_comment_id': parent['id'] if parent else None,
+                'path': (parent['path'] if parent else '') + Comment.path_segment(comment_id),
+                'depth': parent['depth'] + 1 if parent else 0,
+                'up_votes': 0,
+                'down_votes': 0,
+            }
+            thread.append(comment)
+            comments.append(comment)
+
+        # the vote counters of the comments are part of the copied rows
+        comment_popularity = PowerLaw(self.rng, comments, exponent=1.0)
+        votes = {}
+        for _ in range(vote_count):
+            comment = comment_popularity.pick()
+            user_id = self.rng.choice(user_ids)
+            if (comment['id'], user_id) in votes:
+                continue
+            value = 1 if self.rng.random() < 0.8 else -1
+            votes[comment['id'], user_id] = {
+                'comment_id': comment['id'],
+                'user_id': user_id,
+                'value': value,
+                'created_date': self.follow_up_date(comment['created_date']),
+            }
+            comment['up_votes' if value > 0 else 'down_votes'] += 1
+        for comment in comments:
+            comment['score'] = comment['up_votes'] - comment['down_votes']
+            comment['best_score'] = wilson_lower_bound(comment['up_votes'], comment['down_votes'])
+
+        self.copy(Comment, comments)
+        self.copy(CommentVote, votes.values())
+
+    def create_topic_votes(self, count, user_ids, topics):
+        popularity = PowerLaw(self.rng, topics, exponent=1.0)
+        votes = {}
+        for _ in range(count):
+            topic = popularity.pick()
+            user_id = self.rng.choice(user_ids)
+            votes.setdefault((topic['id'], user_id), {
+                'topic_id': topic['id'],
+                'user_id': user_id,
+                'value': 1 if self.rng.random() < 0.8 else -1,
+                'created_date': self.follow_up_date(topic['created_date']),
+            })
+        self.copy(TopicVote, votes.values())
+
+    def create_clicks(self, topic_count, community_count, user_ids, topics, communities):
+        topic_popularity = PowerLaw(self.rng, topics, exponent=1.0)
+        community_popularity = PowerLaw(self.rng, communities, exponent=1.1)
+
+        def topic_clicks():
+            for _ in range(topic_count):
+                topic = topic_popularity.pick()
+                yield {
+                    'topic_id': topic['id'],
+                    'user_id': self.rng.choice(user_ids),
+                    'created_date': self.follow_up_date(topic['created_date']),
+                }
+
+        def community_clicks():
+            for _ in range(community_count):
+                community = community_popularity.pick()
+                yield {
+                    'community_id': community['id'],
+                    'user_id': self.rng.choice(user_ids),
+                    'created_date': self.random_date(community['created_date']),
+                }
+
+        self.copy(TopicClick, topic_clicks())
+        self.copy(CommunityClick, community_clicks())
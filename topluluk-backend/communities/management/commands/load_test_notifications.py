@@ -0,0 +1,350 @@
+import asyncio
+import collections
+import datetime
+import json
+import time
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import ChannelNameRouter
+from channels.testing import WebsocketCommunicator
+from channels.worker import Worker
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.test.utils import override_settings
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from communities.benchmark import LocalClient, RemoteClient, summarize, process_memory, new_run, save_run, load_run, \
+    find_regressions
+from communities.models import Community, Moderator, Notification, Topic, Ban
+from communities.notifications import FANOUT_CHANNEL
+
+WEBSOCKET_PATH = '/ws/notifications/'
+# the notification kind every triggered event arrives as
+EVENT_KINDS = {
+    'post': Notification.Kind.NEW_POST,
+    'comment': Notification.Kind.COMMENT,
+    'ban': Notification.Kind.BAN,
+}
+
+
+class LocalSocket:
+    # a socket of the asgi application of this process
+    def __init__(self, token):
+        from Topluluk.asgi import application
+        self.communicator = WebsocketCommunicator(application, WEBSOCKET_PATH, headers=[
+            (b'origin', b'http://localhost'),
+            (b'cookie', f'access={token}'.encode()),
+        ])
+
+    async def connect(self, timeout):
+        connected, _ = await self.communicator.connect(timeout=timeout)
+        return connected
+
+    async def receive(self):
+        return await self.communicator.receive_from(timeout=None)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class RemoteSocket:
+    # a socket of a running server, needs the websockets package
+    def __init__(self, url, token):
+        self.url = url.rstrip('/') + WEBSOCKET_PATH
+        self.headers = {'Cookie': f'access={token}', 'Origin': 'http://localhost'}
+        self.connection = None
+
+    async def connect(self, timeout):
+        from websockets.asyncio.client import connect
+        self.connection = await connect(self.url, additional_headers=self.headers, open_timeout=timeout)
+        return True
+
+    async def receive(self):
+        return await self.connection.recv()
+
+    async def close(self):
+        if self.connection is not None:
+            await self.connection.close()
+
+
+class Listener:
+    # the frames of one socket, every expected notification waits in the
+    # queue of its kind with the time its event was triggered
+    def __init__(self, user_id, socket):
+        self.user_id = user_id
+        self.socket = socket
+        self.expected = collections.defaultdict(collections.deque)
+        self.latencies = collections.defaultdict(list)
+        self.unexpected = 0
+        self.collapsed = 0
+        self.task = None
+
+    async def listen(self):
+        while True:
+            frame = json.loads(await self.socket.receive())
+            received = time.perf_counter()
+            for message in frame if isinstance(frame, list) else [frame]:
+                if message['type'] == 'notifications_collapsed':
+                    self.collapsed += message['payload']['count']
+                elif message['type'] == 'notification':
+                    kind = message['payload']['kind']
+                    if self.expected[kind]:
+                        self.latencies[kind].append(received - self.expected[kind].popleft())
+                    else:
+                        self.unexpected += 1
+
+
+class Command(BaseCommand):
+    # opens many authenticated notification sockets for the subscribers of a
+    # community and measures how the posts, comments and bans they trigger
+    # are delivered. without --url the sockets, the views and the fan-out
+    # worker all run in this process, so latencies include their contention.
+    # the run adds topics, comments and short bans to the database
+    help = 'Load tests the notification websockets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=1000)
+        parser.add_argument('--connect-concurrency', type=int, default=100, help='sockets opening at the same time')
+        parser.add_argument('--connect-timeout', type=float, default=10)
+        parser.add_argument('--community', help='slug of the community, the one with most subscribers by default')
+        parser.add_argument('--events', type=int, default=20, help='triggered events of every kind')
+        parser.add_argument('--kinds', nargs='*', choices=list(EVENT_KINDS), default=list(EVENT_KINDS))
+        parser.add_argument('--rate', type=float, default=5, help='triggered events per second')
+        parser.add_argument('--drain', type=float, default=10, help='seconds to wait for late deliveries')
+        parser.add_argument('--channel-layer', choices=['configured', 'memory'], default='configured',
+                            help='memory uses the in-memory channel layer instead of redis, only without --url')
+        parser.add_argument('--url', help='websocket base url of a running server like ws://localhost:8000')
+        parser.add_argument('--http-url', help='api base url of the running server, like http://localhost:8000')
+        parser.add_argument('--server-pid', type=int, help='pid of the server whose memory is measured with --url')
+        parser.add_argument('--save', help='path of the json file the results are written to')
+        parser.add_argument('--compare', help='path of a baseline json file')
+        parser.add_argument('--threshold', type=float, default=0.2,
+                            help='allowed change of a metric before it counts as a regression')
+
+    def handle(self, *args, **options):
+        if options['url']:
+            if options['channel_layer'] == 'memory':
+                raise CommandError('the in-memory channel layer only works in this process')
+            try:
+                import websockets  # noqa: F401
+            except ImportError:
+                raise CommandError('--url needs the websockets package')
+            if not options['http_url']:
+                options['http_url'] = options['url'].replace('ws', 'http', 1)
+
+        if options['channel_layer'] == 'memory':
+            with override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}):
+                run = asyncio.run(self.run(options))
+        else:
+            run = asyncio.run(self.run(options))
+
+        for name, result in run['results'].items():
+            self.report(name, result)
+        if options['save']:
+            save_run(run, options['save'])
+            self.stdout.write(f'saved the results to {options["save"]}')
+        if options['compare']:
+            regressions = find_regressions(run, load_run(options['compare']), options['threshold'])
+            for name, metric, old, new in regressions:
+                self.stdout.write(self.style.ERROR(f'{name} {metric}: {old:.2f} -> {new:.2f}'))
+            if regressions:
+                raise CommandError(f'{len(regressions)} metrics regressed more than {options["threshold"]:.0%}')
+            self.stdout.write(self.style.SUCCESS('no regressions'))
+
+    async def run(self, options):
+        community, users, moderator, topics = await sync_to_async(self.targets)(options)
+        tokens = {user.id: str(AccessToken.for_user(user)) for user in users + ([moderator] if moderator else [])}
+        run = new_run({
+            key: options[key] for key in ('connections', 'connect_concurrency', 'events', 'kinds', 'rate', 'url',
+                                          'channel_layer')
+        })
+        run['targets'] = {'community': community.slug, 'users': len(users)}
+
+        # topic posts are fanned out by the worker of the notification-fanout channel
+        worker = None
+        if not options['url']:
+            from communities.routing import worker_channels
+            worker = asyncio.ensure_future(
+                Worker(ChannelNameRouter(worker_channels), [FANOUT_CHANNEL], get_channel_layer()).handle()
+            )
+
+        listeners = []
+        started = timezone.now()
+        try:
+            run['results']['connect'] = await self.connect(users, tokens, listeners, options)
+            await self.trigger(community, users, moderator, topics, tokens, listeners, options)
+            await asyncio.sleep(options['drain'])
+            run['results'].update(self.deliveries(listeners, options))
+        finally:
+            for listener in listeners:
+                listener.task.cancel()
+            await asyncio.gather(*(listener.socket.close() for listener in listeners), return_exceptions=True)
+            if worker is not None:
+                worker.cancel()
+            await sync_to_async(self.clean_up)(community, started)
+        return run
+
+    def targets(self, options):
+        # subscribers of the community get the topic broadcasts, digest
+        # users are left out since they do not receive them
+        if options['community']:
+            community = Community.objects.filter(slug=options['community']).first()
+        else:
+            community = Community.objects.annotate(
+                subscriber_number=Count('subscriber')
+            ).order_by('-subscriber_number').first()
+        if community is None:
+            raise CommandError('no community to load test')
+        moderator = Moderator.objects.filter(community=community).select_related('user').first()
+        users = list(User.objects.filter(
+            subscriber__community=community, profile__notification_digest=False
+        ).exclude(
+            ban__community=community
+        ).order_by('id')[:options['connections']])
+        if moderator is not None:
+            users = [user for user in users if user.id != moderator.user_id]
+        if not users:
+            raise CommandError('the community has no subscribers')
+        if 'ban' in options['kinds'] and moderator is None:
+            raise CommandError('bans need a moderator of the community')
+        user_ids = {user.id for user in users}
+        # comments notify the author of the topic, so only their topics are used
+        topics = [topic for topic in Topic.objects.filter(community=community).order_by('-id').values(
+            'slug', 'user_id'
+        )[:1000] if topic['user_id'] in user_ids]
+        return community, users, moderator.user if moderator else None, topics
+
+    async def connect(self, users, tokens, listeners, options):
+        # more sockets than users are spread over the users
+        semaphore = asyncio.Semaphore(options['connect_concurrency'])
+        latencies = []
+        failures = 0
+        # the memory of this process, or of the server with --url and --server-pid
+        measure_memory = not options['url'] or options['server_pid']
+        memory_before = process_memory(options['server_pid']) if measure_memory else None
+
+        async def open_socket(index):
+            nonlocal failures
+            user = users[index % len(users)]
+            if options['url']:
+                socket = RemoteSocket(options['url'], tokens[user.id])
+            else:
+                socket = LocalSocket(tokens[user.id])
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    connected = await socket.connect(options['connect_timeout'])
+                except (OSError, asyncio.TimeoutError, AssertionError) as e:
+                    self.stderr.write(f'connection {index} failed: {e!r}')
+                    connected = False
+                if not connected:
+                    failures += 1
+                    return
+                latencies.append(time.perf_counter() - started)
+            listener = Listener(user.id, socket)
+            listener.task = asyncio.ensure_future(listener.listen())
+            listeners.append(listener)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(open_socket(index) for index in range(options['connections'])))
+        result = summarize(latencies, failures, time.perf_counter() - started)
+
+        memory_after = process_memory(options['server_pid']) if measure_memory else None
+        if memory_before is not None and memory_after is not None and listeners:
+            result['memory_per_connection'] = (memory_after - memory_before) / len(listeners)
+        return result
+
+    async def trigger(self, community, users, moderator, topics, tokens, listeners, options):
+        # the events of the kinds take turns at the given rate, a trigger
+        # time is queued on every socket that should receive the event
+        client = RemoteClient(options['http_url']) if options['url'] else LocalClient()
+        topics = list(topics)
+        by_user = collections.defaultdict(list)
+        for listener in listeners:
+            by_user[listener.user_id].append(listener)
+        run_id = int(time.time())
+
+        def send(method, path, body, user_id):
+            return client.request(method, path, body, tokens[user_id])
+
+        try:
+            for index in range(options['events']):
+                for kind in options['kinds']:
+                    author = users[index % len(users)]
+                    if kind == 'post':
+                        recipients = listeners
+                        request = ('POST', '/topic/', {
+                            'community': f'/community/{community.slug}/',
+                            'title': f'load test {run_id} {index}',
+                            'text': f'load test topic {index}',
+                        }, author.id)
+                    elif kind == 'comment':
+                        if not topics:
+                            continue
+                        topic = topics[index % len(topics)]
+                        recipients = by_user[topic['user_id']]
+                        request = ('POST', '/comment/', {
+                            'topic': f'/topic/{topic["slug"]}/',
+                            'text': f'load test comment {index}',
+                        }, author.id)
+                    else:
+                        banned = users[-1 - index % len(users)]
+                        recipients = by_user[banned.id]
+                        request = ('POST', '/ban/', {
+                            'user': f'/user/{banned.id}/',
+                            'community': f'/community/{community.slug}/',
+                            'expires_at': (timezone.now() + datetime.timedelta(minutes=1)).isoformat(),
+                        }, moderator.id)
+
+                    triggered = time.perf_counter()
+                    for listener in recipients:
+                        listener.expected[EVENT_KINDS[kind]].append(triggered)
+                    status = await sync_to_async(send)(*request)
+                    if not 200 <= status < 300:
+                        self.stderr.write(f'{kind} {index} failed with {status}')
+                        for listener in recipients:
+                            listener.expected[EVENT_KINDS[kind]].pop()
+                    elif kind == 'post':
+                        topics.append({'slug': f'load-test-{run_id}-{index}', 'user_id': author.id})
+                    await asyncio.sleep(1 / options['rate'])
+        finally:
+            await sync_to_async(client.close)()
+
+    @staticmethod
+    def deliveries(listeners, options):
+        # notifications still expected after the drain were dropped, the
+        # collapsed ones were replaced by a marker telling to fetch them
+        results = {}
+        collapsed = sum(listener.collapsed for listener in listeners)
+        for kind in options['kinds']:
+            notification_kind = EVENT_KINDS[kind]
+            latencies = [latency for listener in listeners for latency in listener.latencies[notification_kind]]
+            missing = sum(len(listener.expected[notification_kind]) for listener in listeners)
+            result = summarize(latencies, missing, options['events'] / options['rate'])
+            result['expected'] = len(latencies) + missing
+            results[f'deliver_{kind}'] = result
+        results['frames'] = {
+            'unexpected': sum(listener.unexpected for listener in listeners),
+            'collapsed': collapsed,
+        }
+        return results
+
+    @staticmethod
+    def clean_up(community, started):
+        # the bans of the run are lifted, the posts and comments stay
+        Ban.objects.filter(community=community, created_at__gte=started).delete()
+
+    def report(self, name, result):
+        if 'p50' not in result:
+            self.stdout.write(f'{name:<16} ' + '  '.join(f'{key} {value}' for key, value in result.items()))
+            return
+        line = (
+            f'{name:<16} {result["requests"]:>7} ok {result["errors"]:>6} lost {result["throughput"]:>9.1f}/s  '
+            f'p50 {result["p50"]:>8.1f}ms  p95 {result["p95"]:>8.1f}ms  p99 {result["p99"]:>8.1f}ms'
+        )
+        if 'memory_per_connection' in result:
+            line += f'  {result["memory_per_connection"] / 1024:.1f}KiB/connection'
+        self.stdout.write(line)
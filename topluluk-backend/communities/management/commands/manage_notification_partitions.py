@@ -0,0 +1,129 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from communities.models import Notification
+from communities.notifications import forget_unread_count
+
+PARTITION_PREFIX = 'communities_notification_p'
+DEFAULT_PARTITION = 'communities_notification_default'
+
+
+def add_months(month, months):
+    years, month_index = divmod(month.month - 1 + months, 12)
+    return datetime.date(month.year + years, month_index + 1, 1)
+
+
+def partition_name(month):
+    return f'{PARTITION_PREFIX}{month:%Y%m}'
+
+
+class Command(BaseCommand):
+    # run it daily, the scheduler service of docker-compose does. it creates
+    # the partitions of the coming months, drops the partitions that are older
+    # than both retentions and purges the expired rows of the others in small
+    # chunks
+    help = 'Creates and drops notification partitions and purges expired notifications'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=3)
+        parser.add_argument('--chunk-size', type=int, default=settings.NOTIFICATION_PURGE_CHUNK_SIZE)
+        parser.add_argument('--pause', type=float, default=0.1, help='seconds to wait between purged chunks')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        this_month = now.date().replace(day=1)
+        existing = self.partitions()
+
+        for months in range(options['months_ahead'] + 1):
+            month = add_months(this_month, months)
+            if partition_name(month) not in existing:
+                self.create_partition(month)
+
+        # every row of a partition that ended before both retentions is expired
+        drop_before = (now - max(settings.NOTIFICATION_READ_RETENTION, settings.NOTIFICATION_UNREAD_RETENTION)).date()
+        for name in sorted(existing):
+            month = datetime.datetime.strptime(name[len(PARTITION_PREFIX):], '%Y%m').date()
+            if add_months(month, 1) <= drop_before:
+                self.drop_partition(name)
+
+        read = self.purge(
+            Notification.objects.filter(is_read=True, created_date__lt=now - settings.NOTIFICATION_READ_RETENTION),
+            options['chunk_size'], options['pause']
+        )
+        unread = self.purge(
+            Notification.objects.filter(is_read=False, created_date__lt=now - settings.NOTIFICATION_UNREAD_RETENTION),
+            options['chunk_size'], options['pause']
+        )
+        self.stdout.write(self.style.SUCCESS(f'purged {read} read and {unread} unread notifications'))
+
+    def partitions(self):
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                SELECT child.relname FROM pg_inherits
+                JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+                JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                WHERE parent.relname = %s AND child.relname LIKE %s
+            """, [Notification._meta.db_table, PARTITION_PREFIX + '%'])
+            return {name for name, in cursor.fetchall()}
+
+    def lock_timeout(self, cursor):
+        cursor.execute('SET LOCAL lock_timeout = %s', [settings.NOTIFICATION_PARTITION_LOCK_TIMEOUT])
+
+    def create_partition(self, month):
+        # rows of the month that landed in the default partition are moved
+        # into the new table before it is attached, attaching checks that the
+        # default partition has none left
+        name = partition_name(month)
+        table = connection.ops.quote_name(Notification._meta.db_table)
+        with transaction.atomic(), connection.cursor() as cursor:
+            self.lock_timeout(cursor)
+            cursor.execute(
+                f'CREATE TABLE {connection.ops.quote_name(name)} '
+                f'(LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'
+            )
+            cursor.execute(f"""
+                WITH moved AS (
+                    DELETE FROM {connection.ops.quote_name(DEFAULT_PARTITION)}
+                    WHERE created_date >= %s AND created_date < %s RETURNING *
+                )
+                INSERT INTO {connection.ops.quote_name(name)} SELECT * FROM moved
+            """, [month, add_months(month, 1)])
+            moved = cursor.rowcount
+            cursor.execute(
+                f'ALTER TABLE {table} ATTACH PARTITION {connection.ops.quote_name(name)} FOR VALUES FROM (%s) TO (%s)',
+                [month, add_months(month, 1)]
+            )
+        self.stdout.write(f'created {name}, moved {moved} rows from the default partition')
+
+    def drop_partition(self, name):
+        # detaching is a short catalog change, no rows are deleted one by one
+        with transaction.atomic(), connection.cursor() as cursor:
+            self.lock_timeout(cursor)
+            cursor.execute(f'SELECT DISTINCT user_id FROM {connection.ops.quote_name(name)} WHERE NOT is_read')
+            user_ids = [user_id for user_id, in cursor.fetchall()]
+            cursor.execute(
+                f'ALTER TABLE {connection.ops.quote_name(Notification._meta.db_table)} '
+                f'DETACH PARTITION {connection.ops.quote_name(name)}'
+            )
+            cursor.execute(f'DROP TABLE {connection.ops.quote_name(name)}')
+        for user_id in user_ids:
+            forget_unread_count(user_id)
+        self.stdout.write(f'dropped {name}')
+
+    def purge(self, queryset, chunk_size, pause):
+        # short deletes keep the locks and the write bursts small
+        purged = 0
+        while True:
+            chunk = list(queryset.values_list('id', 'user_id', 'is_read')[:chunk_size])
+            if not chunk:
+                return purged
+            queryset.filter(id__in=[notification_id for notification_id, _, _ in chunk]).delete()
+            for user_id in {user_id for _, user_id, is_read in chunk if not is_read}:
+                forget_unread_count(user_id)
+            purged += len(chunk)
+            time.sleep(pause)
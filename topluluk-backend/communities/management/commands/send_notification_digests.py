@@ -0,0 +1,49 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Max
+from django.urls import reverse
+from django.utils import timezone
+
+from communities.models import Profile, Topic, Notification
+from communities.notifications import notify_user, notification_target
+
+
+class Command(BaseCommand):
+    # the scheduler container runs it every hour, every digest user gets one
+    # notification that sums up the new posts of their communities
+    help = 'Sends the new post digests of users with notification_digest enabled'
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        sent = 0
+        profiles = Profile.objects.filter(notification_digest=True).only('id', 'user_id', 'last_digest_date')
+        for profile in profiles.iterator(chunk_size=500):
+            since = profile.last_digest_date or now - settings.NOTIFICATION_COALESCE_WINDOW
+            communities = list(Topic.objects.filter(
+                community__subscriber__user_id=profile.user_id,
+                created_date__gt=since,
+                created_date__lte=now
+            ).values('community_id').annotate(
+                topic_count=Count('id'),
+                last_topic_id=Max('id')
+            ).order_by('-topic_count'))
+
+            if communities:
+                # links to the newest post of the busiest community
+                busiest = communities[0]
+                topic = Topic.objects.only('slug').get(id=busiest['last_topic_id'])
+                topic_count = sum(community['topic_count'] for community in communities)
+                notify_user(
+                    profile.user_id,
+                    Notification.Kind.DIGEST,
+                    notification_target(profile),
+                    settings.BACKEND_URL + reverse('topic-detail', kwargs={'slug': topic.slug}),
+                    topic_count=topic_count,
+                    community_count=len(communities)
+                )
+                sent += 1
+
+            profile.last_digest_date = now
+            profile.save(update_fields=['last_digest_date'])
+
+        self.stdout.write(self.style.SUCCESS(f'sent {sent} digests'))
@@ -0,0 +1,176 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# process wide counters, gauges and histograms exported in the prometheus
+# text format by the /metrics view. every worker process keeps its own
+# values, so each one is scraped on its own. an observation is a lock and
+# a few additions, cheap enough to stay on in production
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f'metric {metric.name} is already registered')
+        self.metrics[metric.name] = metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.register(self)
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects the labels {self.labelnames}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def labels_of(self, key, *extra):
+        return tuple(zip(self.labelnames, key)) + extra
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield self.name, self.labels_of(key), value
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield self.name, self.labels_of(key), value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one count per bucket, the last one is +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts)) for key, counts in self.values.items()]
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', self.labels_of(key, ('le', format_value(float(bound)))), cumulative
+            yield f'{self.name}_sum', self.labels_of(key), counts[-1]
+            yield f'{self.name}_count', self.labels_of(key), cumulative
+
+
+REQUEST_SECONDS = Histogram(
+    'topluluk_http_request_seconds', 'Duration of http requests', ['method', 'endpoint', 'status']
+)
+REQUEST_QUERIES = Histogram(
+    'topluluk_http_request_queries', 'Database queries of http requests', ['endpoint'],
+    buckets=(1, 2, 5, 10, 20, 30, 50, 100, 200)
+)
+REQUEST_DATABASE_SECONDS = Histogram(
+    'topluluk_http_request_database_seconds', 'Time http requests spent in database queries', ['endpoint']
+)
+EMBEDDING_SECONDS = Histogram('topluluk_embedding_seconds', 'Duration of embedding generation')
+VECTOR_QUERY_SECONDS = Histogram('topluluk_vector_query_seconds', 'Duration of vector similarity queries', ['query'])
+CHANNEL_SEND_SECONDS = Histogram(
+    'topluluk_channel_send_seconds', 'Duration of channel layer sends', ['target']
+)
+INTERACTION_WRITE_SECONDS = Histogram(
+    'topluluk_interaction_write_seconds', 'Duration of click and vote writes with the interest update', ['model']
+)
+SERIALIZER_SECONDS = Histogram(
+    'topluluk_serializer_seconds', 'Duration of serializing one top level object with its nested ones',
+    ['serializer']
+)
+NOTIFICATION_SOCKETS = Gauge('topluluk_notification_sockets', 'Open notification websockets')
+OUTBOX_MESSAGES = Counter(
+    'topluluk_outbox_messages_total', 'Notification messages of the socket outboxes by what happened to them', ['event']
+)
+OUTBOX_FRAMES = Counter('topluluk_outbox_frames_total', 'Frames sent by the socket outboxes')
+PROFILED_REQUESTS = Counter('topluluk_profiled_requests_total', 'Slow requests whose stack samples were logged')
@@ -0,0 +1,104 @@
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from communities.metrics import REQUEST_SECONDS, REQUEST_QUERIES, REQUEST_DATABASE_SECONDS, PROFILED_REQUESTS
+from communities.profiling import StackSampler
+
+logger = logging.getLogger(__name__)
+
+
+class QueryStats:
+    # database execute wrapper that counts the queries of a request, queries
+    # with the same sql but different parameters share a signature
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.signatures = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+            self.signatures[sql] += 1
+
+    def duplicates(self):
+        # extra executions of repeated signatures, an N+1 shows up here
+        return sum(count - 1 for count in self.signatures.values())
+
+    def most_repeated(self):
+        sql, count = self.signatures.most_common(1)[0] if self.signatures else ('', 0)
+        return sql, count
+
+
+class QueryBudgetMiddleware:
+    # records the queries of every request. with QUERY_BUDGET_HEADERS they
+    # are sent back as X-Query-* headers, requests over the budget are logged
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = QueryStats()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(stats))
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+
+        endpoint = self.endpoint(request)
+        # unmatched paths are not labels, they would grow without a bound
+        label = self.endpoint(request, 'unmatched')
+        REQUEST_SECONDS.observe(duration, method=request.method, endpoint=label, status=response.status_code)
+        REQUEST_QUERIES.observe(stats.count, endpoint=label)
+        REQUEST_DATABASE_SECONDS.observe(stats.duration, endpoint=label)
+        if settings.QUERY_BUDGET_HEADERS:
+            response['X-Query-Count'] = stats.count
+            response['X-Query-Time'] = f'{stats.duration * 1000:.1f}ms'
+            response['X-Query-Duplicates'] = stats.duplicates()
+
+        if stats.count > settings.QUERY_BUDGET_MAX_QUERIES or stats.duration * 1000 > settings.QUERY_BUDGET_MAX_TIME_MS:
+            sql, count = stats.most_repeated()
+            logger.warning('%s %s: %d queries in %.1fms, %d duplicates, most repeated %dx: %s',
+                           request.method, endpoint, stats.count, stats.duration * 1000,
+                           stats.duplicates(), count, sql[:200])
+        return response
+
+    @staticmethod
+    def endpoint(request, unmatched=None):
+        # the url pattern keeps the endpoints apart without their ids and slugs
+        match = getattr(request, 'resolver_match', None)
+        if match is not None:
+            return match.route
+        return unmatched or request.path
+
+
+class SamplingProfilerMiddleware:
+    # samples the stacks of PROFILE_SAMPLE_RATE of the requests, the
+    # samples of the ones slower than PROFILE_SLOW_REQUEST_MS are logged
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= settings.PROFILE_SAMPLE_RATE:
+            return self.get_response(request)
+
+        started = time.perf_counter()
+        with StackSampler(threading.get_ident(), settings.PROFILE_INTERVAL) as sampler:
+            response = self.get_response(request)
+        duration_ms = (time.perf_counter() - started) * 1000
+
+        if duration_ms >= settings.PROFILE_SLOW_REQUEST_MS:
+            PROFILED_REQUESTS.inc()
+            logger.warning('%s %s took %.1fms, most sampled stacks:\n%s', request.method, request.path,
+                           duration_ms, sampler.report(settings.PROFILE_TOP_STACKS))
+        return response
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.3 on 2026-10-19 17:19
+
+from django.conf import settings
+from django.db import migrations, models
+
+PATH_SEGMENT_WIDTH = 10
+
+
+def fill_comment_paths(apps, schema_editor):
+    Comment = apps.get_model('communities', 'Comment')
+    paths = {}
+    level = list(Comment.objects.filter(upper_comment__isnull=True).only('id', 'upper_comment_id'))
+    depth = 0
+    while level:
+        for comment in level:
+            parent_path = paths.get(comment.upper_comment_id, '')
+            comment.path = parent_path + f'{comment.id:0{PATH_SEGMENT_WIDTH}d}.'
+            comment.depth = depth
+            paths[comment.id] = comment.path
+        Comment.objects.bulk_update(level, ['path', 'depth'], batch_size=1000)
+        level = list(Comment.objects.filter(
+            upper_comment_id__in=[comment.id for comment in level]
+        ).only('id', 'upper_comment_id'))
+        depth += 1
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communities', '0016_commentvote_created_date_topicvote_created_date'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='path',
+            field=models.CharField(blank=True, default='', max_length=1024),
+        ),
+        migrations.RunPython(fill_comment_paths, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['topic', 'path'], name='comment_topic_path_idx', opclasses=['int8_ops', 'varchar_pattern_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['topic', 'upper_comment', 'id'], name='comment_topic_parent_idx'),
+        ),
+    ]
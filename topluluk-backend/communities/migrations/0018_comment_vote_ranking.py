@@ -0,0 +1,72 @@
+# Generated by Django 5.2.3 on 2026-10-19 17:20
+
+from django.conf import settings
+import math
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def fill_comment_rankings(apps, schema_editor):
+    Comment = apps.get_model('communities', 'Comment')
+    CommentVote = apps.get_model('communities', 'CommentVote')
+    z = 1.281551565545
+    votes = CommentVote.objects.values('comment').annotate(
+        up=Count('id', filter=Q(value__gt=0)),
+        down=Count('id', filter=Q(value__lt=0)),
+    )
+    comments = []
+    for vote in votes:
+        n = vote['up'] + vote['down']
+        best_score = 0
+        if n:
+            p = vote['up'] / n
+            best_score = (p + z * z / (2 * n) - z * math.sqrt((p * (1 - p) + z * z / (4 * n)) / n)) / (1 + z * z / n)
+        comments.append(Comment(
+            id=vote['comment'],
+            up_votes=vote['up'],
+            down_votes=vote['down'],
+            score=vote['up'] - vote['down'],
+            best_score=best_score,
+        ))
+    Comment.objects.bulk_update(comments, ['up_votes', 'down_votes', 'score', 'best_score'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communities', '0017_comment_path_depth'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='comment',
+            name='best_score',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='down_votes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='score',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='comment',
+            name='up_votes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_comment_rankings, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['topic', 'upper_comment', 'score', 'id'], name='comment_topic_parent_top_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(fields=['topic', 'upper_comment', 'best_score', 'id'], name='comment_topic_parent_best_idx'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.3 on 2026-10-19 17:28
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+def fill_notification_updated_dates(apps, schema_editor):
+    Notification = apps.get_model('communities', 'Notification')
+    Notification.objects.update(updated_date=F('created_date'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communities', '0019_cursor_pagination_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='count',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='kind',
+            field=models.CharField(blank=True, choices=[('new_post', 'New Post'), ('comment', 'Comment'), ('reply', 'Reply'), ('ban', 'Ban'), ('digest', 'Digest')], max_length=20),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='target',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='updated_date',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(fill_notification_updated_dates, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='profile',
+            name='last_digest_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='notification_digest',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['user', 'kind', 'target', 'updated_date'], name='notification_coalesce_idx'),
+        ),
+    ]
@@ -0,0 +1,189 @@
+from django.conf import settings
+from django.db import migrations, transaction
+
+# the notification table becomes range partitioned by created_date into
+# monthly partitions named communities_notification_pYYYYMM, later ones are
+# created and old ones dropped by the manage_notification_partitions command.
+# postgres needs the partition key in the primary key, for django id stays
+# the primary key since it is still unique.
+#
+# the migration is not atomic so the table stays writable while it is copied:
+# a trigger mirrors the writes of the old table to the new one and the
+# existing rows are copied in chunks, each in its own transaction. only the
+# final swap locks the old table.
+# a default partition catches the rows of months without a partition, the
+# command moves them into the partition it creates for their month.
+
+COPY_CHUNK_SIZE = 10000
+
+COLUMNS = 'id, information, direct_url, created_date, is_read, user_id, count, kind, target, updated_date'
+
+CREATE_PARTITIONED = """
+CREATE SEQUENCE communities_notification_partitioned_id_seq;
+
+CREATE TABLE communities_notification_partitioned (
+    id bigint NOT NULL DEFAULT nextval('communities_notification_partitioned_id_seq'),
+    information text NOT NULL,
+    direct_url varchar(200) NOT NULL,
+    created_date timestamp with time zone NOT NULL,
+    is_read boolean NOT NULL,
+    user_id integer NOT NULL REFERENCES {user_table} ({user_pk}) DEFERRABLE INITIALLY DEFERRED,
+    count integer NOT NULL CHECK (count >= 0),
+    kind varchar(20) NOT NULL,
+    target varchar(50) NOT NULL,
+    updated_date timestamp with time zone NOT NULL,
+    CONSTRAINT communities_notification_partitioned_pkey PRIMARY KEY (id, created_date)
+) PARTITION BY RANGE (created_date);
+
+CREATE TABLE communities_notification_default
+    PARTITION OF communities_notification_partitioned DEFAULT;
+
+DO $$
+DECLARE
+    month date;
+BEGIN
+    FOR month IN SELECT generate_series(
+        date_trunc('month', LEAST((SELECT min(created_date) FROM communities_notification), now())),
+        date_trunc('month', GREATEST((SELECT max(created_date) FROM communities_notification), now()))
+            + interval '3 months',
+        interval '1 month'
+    )::date LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF communities_notification_partitioned FOR VALUES FROM (%L) TO (%L)',
+            'communities_notification_p' || to_char(month, 'YYYYMM'), month, month + interval '1 month'
+        );
+    END LOOP;
+END $$;
+
+-- built while the table is empty, renamed after the swap
+CREATE INDEX communities_notification_partitioned_user_id_idx ON communities_notification_partitioned (user_id);
+CREATE INDEX notification_partitioned_created_idx ON communities_notification_partitioned (created_date, id);
+CREATE INDEX notification_partitioned_user_unread_idx
+    ON communities_notification_partitioned (user_id, is_read, created_date, id);
+CREATE INDEX notification_partitioned_coalesce_idx
+    ON communities_notification_partitioned (user_id, kind, target, updated_date) WHERE NOT is_read;
+
+CREATE FUNCTION communities_notification_mirror() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM communities_notification_partitioned WHERE id = OLD.id AND created_date = OLD.created_date;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO communities_notification_partitioned ({columns})
+        VALUES (NEW.id, NEW.information, NEW.direct_url, NEW.created_date, NEW.is_read, NEW.user_id,
+                NEW.count, NEW.kind, NEW.target, NEW.updated_date);
+    END IF;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+-- waits for the running writes of the table, every later write is mirrored
+CREATE TRIGGER communities_notification_mirror
+    AFTER INSERT OR UPDATE OR DELETE ON communities_notification
+    FOR EACH ROW EXECUTE FUNCTION communities_notification_mirror();
+"""
+
+# the copied rows are locked so a concurrent update or delete waits for the
+# chunk and is then mirrored over it, rows the trigger mirrored are skipped
+COPY_CHUNK = f"""
+INSERT INTO communities_notification_partitioned ({COLUMNS})
+SELECT {COLUMNS} FROM communities_notification
+WHERE id > %s AND id <= %s
+FOR SHARE
+ON CONFLICT DO NOTHING
+"""
+
+SWAP_TABLES = """
+LOCK TABLE communities_notification IN ACCESS EXCLUSIVE MODE;
+
+SELECT setval(
+    'communities_notification_partitioned_id_seq',
+    COALESCE((SELECT max(id) FROM communities_notification), 0) + 1,
+    false
+);
+
+DROP TABLE communities_notification;
+DROP FUNCTION communities_notification_mirror();
+ALTER TABLE communities_notification_partitioned RENAME TO communities_notification;
+ALTER TABLE communities_notification
+    RENAME CONSTRAINT communities_notification_partitioned_pkey TO communities_notification_pkey;
+ALTER SEQUENCE communities_notification_partitioned_id_seq RENAME TO communities_notification_id_seq;
+ALTER SEQUENCE communities_notification_id_seq OWNED BY communities_notification.id;
+
+ALTER INDEX communities_notification_partitioned_user_id_idx RENAME TO communities_notification_user_id_idx;
+ALTER INDEX notification_partitioned_created_idx RENAME TO notification_created_idx;
+ALTER INDEX notification_partitioned_user_unread_idx RENAME TO notification_user_unread_idx;
+ALTER INDEX notification_partitioned_coalesce_idx RENAME TO notification_coalesce_idx;
+"""
+
+UNPARTITION_NOTIFICATIONS = """
+CREATE TABLE communities_notification_plain (LIKE communities_notification INCLUDING DEFAULTS);
+
+INSERT INTO communities_notification_plain SELECT * FROM communities_notification;
+
+ALTER SEQUENCE communities_notification_id_seq OWNED BY NONE;
+DROP TABLE communities_notification;
+ALTER TABLE communities_notification_plain RENAME TO communities_notification;
+ALTER SEQUENCE communities_notification_id_seq OWNED BY communities_notification.id;
+
+ALTER TABLE communities_notification ADD CONSTRAINT communities_notification_pkey PRIMARY KEY (id);
+ALTER TABLE communities_notification ADD CONSTRAINT communities_notification_user_id_fk
+    FOREIGN KEY (user_id) REFERENCES {user_table} ({user_pk}) DEFERRABLE INITIALLY DEFERRED;
+ALTER TABLE communities_notification ADD CONSTRAINT communities_notification_count_check CHECK (count >= 0);
+
+CREATE INDEX communities_notification_user_id_idx ON communities_notification (user_id);
+CREATE INDEX notification_created_idx ON communities_notification (created_date, id);
+CREATE INDEX notification_user_unread_idx ON communities_notification (user_id, is_read, created_date, id);
+CREATE INDEX notification_coalesce_idx ON communities_notification (user_id, kind, target, updated_date)
+    WHERE NOT is_read;
+"""
+
+
+def user_table(apps, schema_editor):
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    quote_name = schema_editor.connection.ops.quote_name
+    return {'user_table': quote_name(User._meta.db_table), 'user_pk': quote_name(User._meta.pk.column)}
+
+
+def partition_notifications(apps, schema_editor):
+    connection = schema_editor.connection
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(CREATE_PARTITIONED.format(columns=COLUMNS, **user_table(apps, schema_editor)))
+        # later rows are mirrored by the trigger
+        cursor.execute('SELECT COALESCE(max(id), 0) FROM communities_notification')
+        last_id, = cursor.fetchone()
+
+    copied_id = 0
+    while copied_id < last_id:
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT max(id) FROM (SELECT id FROM communities_notification WHERE id > %s AND id <= %s '
+                'ORDER BY id LIMIT %s) chunk',
+                [copied_id, last_id, COPY_CHUNK_SIZE]
+            )
+            chunk_last_id, = cursor.fetchone()
+            if chunk_last_id is None:
+                break
+            cursor.execute(COPY_CHUNK, [copied_id, chunk_last_id])
+        copied_id = chunk_last_id
+
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(SWAP_TABLES)
+
+
+def unpartition_notifications(apps, schema_editor):
+    connection = schema_editor.connection
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(UNPARTITION_NOTIFICATIONS.format(**user_table(apps, schema_editor)))
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('communities', '0021_notification_unread_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_notifications, unpartition_notifications),
+    ]
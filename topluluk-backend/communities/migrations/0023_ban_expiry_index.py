@@ -0,0 +1,19 @@
+# Generated by Django 5.2.3 on 2026-10-19 17:39
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communities', '0022_notification_partitioning'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ban',
+            index=models.Index(fields=['user', 'expires_at'], name='ban_user_expires_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.3 on 2026-10-19 18:09
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F, Func, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def fill_hot_scores(apps, schema_editor):
+    Topic = apps.get_model('communities', 'Topic')
+    TopicClick = apps.get_model('communities', 'TopicClick')
+    TopicVote = apps.get_model('communities', 'TopicVote')
+
+    def total(queryset, function, field):
+        return Coalesce(Subquery(
+            queryset.filter(topic=OuterRef('pk')).order_by().annotate(
+                total=Func(F(field), function=function)
+            ).values('total'),
+            output_field=IntegerField()
+        ), Value(0))
+
+    Topic.objects.update(
+        hot_score=total(TopicClick.objects.all(), 'COUNT', 'id') + total(TopicVote.objects.all(), 'SUM', 'value') * 5
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communities', '0023_ban_expiry_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='topic',
+            name='hot_score',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_hot_scores, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,5 @@
+import math
+
 from django.contrib.auth.models import User
 from django.db import models
 from django.utils.text import slugify
@@ -6,6 +8,17 @@ from pgvector.django import VectorField
 import numpy as np
 
 from communities.embedding import generate_embedding
+from communities.metrics import INTERACTION_WRITE_SECONDS
+
+
+# lower bound of the wilson score interval for the ratio of up votes,
+# z = 1.28 is a confidence of 80 percent
+def wilson_lower_bound(up_votes, down_votes, z=1.281551565545):
+    n = up_votes + down_votes
+    if n == 0:
+        return 0
+    p = up_votes / n
+    return (p + z * z / (2 * n) - z * math.sqrt((p * (1 - p) + z * z / (4 * n)) / n)) / (1 + z * z / n)
 
 
 class Profile(models.Model):
@@ -18,6 +31,9 @@ class Profile(models.Model):
     weighted_sum_vector = VectorField(dimensions=384, null=True)
     total_weight = models.FloatField(default=0)
     slug = models.SlugField(unique=True, blank=True)
+    # digest users get one periodic summary instead of a notification per new post
+    notification_digest = models.BooleanField(default=False)
+    last_digest_date = models.DateTimeField(null=True, blank=True)
 
     def update_interaction(self, interaction_embedding, weight):
         if self.weighted_sum_vector is not None:
@@ -32,7 +48,7 @@ class Profile(models.Model):
         self.weighted_sum_vector = ws_vec.tolist()
         self.total_weight = tw
         self.interest_vector = (ws_vec / tw).tolist()
-        self.save()
+        self.save(update_fields=['weighted_sum_vector', 'total_weight', 'interest_vector'])
 
     def karma(self):
         topic_karma = TopicVote.objects.filter(topic__user=self.user).aggregate(
@@ -110,6 +126,9 @@ class Subscriber(models.Model):
 
     class Meta:
         unique_together = ('user', 'community')
+        indexes = [
+            models.Index(fields=['joined_date', 'id'], name='subscriber_joined_idx'),
+        ]
 
     def __str__(self):
         return f'{self.user.username} is subscribed to {self.community.name}'
@@ -122,11 +141,31 @@ class Moderator(models.Model):
         return f'{self.user.username} is a moderator of {self.community.name}'
 
 class Notification(models.Model):
+    class Kind(models.TextChoices):
+        NEW_POST = 'new_post'
+        COMMENT = 'comment'
+        REPLY = 'reply'
+        BAN = 'ban'
+        DIGEST = 'digest'
+
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     information = models.TextField(null=False)
     direct_url = models.URLField(blank=True)
     created_date = models.DateTimeField(auto_now_add=True)
     is_read = models.BooleanField(default=False)
+    # unread notifications of the same kind and target are merged into one row
+    kind = models.CharField(max_length=20, choices=Kind.choices, blank=True)
+    target = models.CharField(max_length=50, blank=True)
+    count = models.PositiveIntegerField(default=1)
+    updated_date = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_date', 'id'], name='notification_created_idx'),
+            models.Index(fields=['user', 'is_read', 'created_date', 'id'], name='notification_user_unread_idx'),
+            models.Index(fields=['user', 'kind', 'target', 'updated_date'], name='notification_coalesce_idx',
+                         condition=models.Q(is_read=False)),
+        ]
 
     def __str__(self):
         return f'{self.information} notification to {self.user.username}'
@@ -140,6 +179,16 @@ class Topic(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     embedding = VectorField(dimensions=384, null=True, blank=True)
     slug = models.SlugField(unique=True, blank=True)
+    # views plus five times the votes, kept in sync with the TopicClick and
+    # TopicVote rows so hot topics are sorted by a column. hot topics are the
+    # ones of the last day, topic_created_idx finds them and only they are sorted
+    hot_score = models.IntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_date', 'id'], name='topic_created_idx'),
+            models.Index(fields=['community', 'created_date', 'id'], name='topic_community_created_idx'),
+        ]
 
     def view_count(self):
         return self.topicclick_set.count()
@@ -176,17 +225,67 @@ class Comment(models.Model):
         on_delete=models.CASCADE,
         related_name='replies'
     )
+    # materialized path of zero padded ancestor ids ending with its own id,
+    # a subtree is every comment of the topic whose path starts with it
+    path = models.CharField(max_length=1024, blank=True, default='')
+    depth = models.PositiveSmallIntegerField(default=0)
+    # kept in sync with CommentVote rows so threads can be sorted by an index
+    up_votes = models.PositiveIntegerField(default=0)
+    down_votes = models.PositiveIntegerField(default=0)
+    score = models.IntegerField(default=0)
+    best_score = models.FloatField(default=0)
+
+    PATH_SEGMENT_WIDTH = 10
+    # the deepest reply whose path still fits into the path column
+    MAX_DEPTH = 1024 // (PATH_SEGMENT_WIDTH + 1) - 1
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['topic', 'path'], name='comment_topic_path_idx',
+                         opclasses=['int8_ops', 'varchar_pattern_ops']),
+            models.Index(fields=['topic', 'upper_comment', 'id'], name='comment_topic_parent_idx'),
+            models.Index(fields=['topic', 'upper_comment', 'score', 'id'], name='comment_topic_parent_top_idx'),
+            models.Index(fields=['topic', 'upper_comment', 'best_score', 'id'], name='comment_topic_parent_best_idx'),
+            models.Index(fields=['created_date', 'id'], name='comment_created_idx'),
+        ]
+
+    @classmethod
+    def path_segment(cls, comment_id):
+        return f'{comment_id:0{cls.PATH_SEGMENT_WIDTH}d}.'
 
     def vote_count(self):
         return self.commentvote_set.aggregate(total=models.Sum('value'))['total'] or 0
 
+    def refresh_votes(self):
+        votes = self.commentvote_set.aggregate(
+            up=models.Count('id', filter=models.Q(value__gt=0)),
+            down=models.Count('id', filter=models.Q(value__lt=0)),
+        )
+        self.up_votes = votes['up']
+        self.down_votes = votes['down']
+        self.score = self.up_votes - self.down_votes
+        self.best_score = wilson_lower_bound(self.up_votes, self.down_votes)
+        Comment.objects.filter(pk=self.pk).update(
+            up_votes=self.up_votes,
+            down_votes=self.down_votes,
+            score=self.score,
+            best_score=self.best_score,
+        )
+
     def comment_count(self):
         return self.replies.count()
 
     def save(self, *args, **kwargs):
         if not self.embedding:
             self.embedding = generate_embedding(self.text)
+        if self.upper_comment is not None:
+            self.depth = self.upper_comment.depth + 1
         super().save(*args, **kwargs)
+        # the path contains the comments own id so it is known only after insert
+        if not self.path:
+            parent_path = self.upper_comment.path if self.upper_comment is not None else ''
+            self.path = parent_path + Comment.path_segment(self.pk)
+            Comment.objects.filter(pk=self.pk).update(path=self.path)
 
     def __str__(self):
         return f'{self.user.username}: {self.text}'
@@ -201,10 +300,20 @@ class VoteBase(models.Model):
 
 class TopicVote(VoteBase):
     topic = models.ForeignKey(Topic, on_delete=models.CASCADE)
+    # the value in the database, the hot score of the topic changes by the
+    # difference when the vote is saved
+    stored_value = 0
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        vote = super().from_db(db, field_names, values)
+        vote.stored_value = vote.__dict__.get('value', 0)
+        return vote
 
     def save(self, *args, **kwargs):
-        self.user.profile.update_interaction(self.topic.embedding, weight=3*self.value)
-        super().save(*args, **kwargs)
+        with INTERACTION_WRITE_SECONDS.time(model=self._meta.model_name):
+            self.user.profile.update_interaction(self.topic.embedding, weight=3*self.value)
+            super().save(*args, **kwargs)
 
     class Meta:
         unique_together = ('topic', 'user')
@@ -216,8 +325,9 @@ class CommentVote(VoteBase):
     comment = models.ForeignKey(Comment, on_delete=models.CASCADE)
 
     def save(self, *args, **kwargs):
-        self.user.profile.update_interaction(self.comment.embedding, weight=3*self.value)
-        super().save(*args, **kwargs)
+        with INTERACTION_WRITE_SECONDS.time(model=self._meta.model_name):
+            self.user.profile.update_interaction(self.comment.embedding, weight=3*self.value)
+            super().save(*args, **kwargs)
 
     class Meta:
         unique_together = ('comment', 'user')
@@ -236,8 +346,9 @@ class TopicClick(ClickBase):
     topic = models.ForeignKey(Topic, on_delete=models.CASCADE)
 
     def save(self, *args, **kwargs):
-        self.user.profile.update_interaction(self.topic.embedding, weight=1)
-        super().save(*args, **kwargs)
+        with INTERACTION_WRITE_SECONDS.time(model=self._meta.model_name):
+            self.user.profile.update_interaction(self.topic.embedding, weight=1)
+            super().save(*args, **kwargs)
 
     def __str__(self):
         return f'{self.user.username} has clicked to {self.topic.title} topic'
@@ -246,18 +357,30 @@ class CommunityClick(ClickBase):
     community = models.ForeignKey(Community, on_delete=models.CASCADE)
 
     def save(self, *args, **kwargs):
-        self.user.profile.update_interaction(self.community.embedding, weight=0.5)
-        super().save(*args, **kwargs)
+        with INTERACTION_WRITE_SECONDS.time(model=self._meta.model_name):
+            self.user.profile.update_interaction(self.community.embedding, weight=0.5)
+            super().save(*args, **kwargs)
 
     def __str__(self):
         return f'{self.user.username} has clicked to {self.community.name} community'
 
+class BanQuerySet(models.QuerySet):
+    def active(self):
+        return self.filter(models.Q(expires_at__isnull=True) | models.Q(expires_at__gt=timezone.now()))
+
 class Ban(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     community = models.ForeignKey(Community, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField(null=True, blank=True)
 
+    objects = BanQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'expires_at'], name='ban_user_expires_idx'),
+        ]
+
     def is_active(self):
         if self.expires_at:
             return timezone.now() < self.expires_at
@@ -0,0 +1,326 @@
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q, Value, CharField
+from django.db.models.functions import Cast, Concat
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from redis.exceptions import RedisError
+
+from communities.comment_tree import encode_cursor, decode_cursor
+from communities.metrics import CHANNEL_SEND_SECONDS
+from communities.models import Notification, Subscriber
+from communities.redis_client import get_redis
+from communities.serializers import NotificationSerializer
+
+logger = logging.getLogger(__name__)
+
+# channel of the background worker, run it with
+# `python manage.py runworker notification-fanout`.
+# its capacity and the expiry of its messages are set in CHANNEL_LAYERS
+FANOUT_CHANNEL = 'notification-fanout'
+
+# text of a single notification and the suffix after the count of a merged
+# one, kinds without a suffix are never merged
+NOTIFICATION_TEXTS = {
+    Notification.Kind.NEW_POST: ('New Post on {name}', ' New Posts on {name}'),
+    Notification.Kind.COMMENT: ('Someone commented on your post!', ' new comments on your post!'),
+    Notification.Kind.REPLY: ('Someone replied to your comment!', ' new replies to your comment!'),
+    Notification.Kind.BAN: ('You have been banned from a community', None),
+    Notification.Kind.DIGEST: ('{topic_count} new posts in {community_count} of your communities', None),
+}
+
+
+# cached counts are only changed while they exist, missing ones are
+# counted again from the database on the next read. every change bumps the
+# version of the count so a read that counted before it does not cache its result
+ADD_TO_EXISTING_COUNT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    local count = redis.call('INCRBY', KEYS[1], ARGV[1])
+    if count < 0 then
+        redis.call('SET', KEYS[1], 0, 'KEEPTTL')
+    end
+end
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+"""
+
+# caches a counted value only if the version did not change since the
+# count started
+SET_COUNT_OF_VERSION = """
+if (redis.call('GET', KEYS[2]) or '') == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3], 'NX')
+    return 1
+end
+return 0
+"""
+
+
+def notification_texts(kind, **names):
+    # the text of a single notification and the suffix after the count of a
+    # merged one, which is None for kinds that are never merged
+    single, merged = NOTIFICATION_TEXTS[kind]
+    return single.format(**names), None if merged is None else merged.format(**names)
+
+
+def user_group_name(user_id):
+    return f'user_{user_id}'
+
+
+def community_group_name(community_id):
+    return f'community_{community_id}'
+
+
+def notification_target(obj):
+    # e.g. 'community:3', notifications are merged per kind and target
+    return f'{obj._meta.model_name}:{obj.pk}'
+
+
+def coalesce_window_start():
+    return timezone.now() - settings.NOTIFICATION_COALESCE_WINDOW
+
+
+def recent_notifications(max_age=None):
+    # notifications are partitioned by created_date, the bound keeps queries
+    # on the recent partitions. older unread ones are purged, so without
+    # max_age nothing is left out
+    max_age = max_age or settings.NOTIFICATION_UNREAD_RETENTION
+    return Notification.objects.filter(created_date__gte=timezone.now() - max_age)
+
+
+def notify_user(user_id, kind, target, direct_url, **names):
+    # bumps the unread notification of the same kind and target if there is
+    # a recent one, otherwise creates a new row, then pushes it to the user
+    single, merged = notification_texts(kind, **names)
+    with transaction.atomic():
+        notification = None
+        if merged is not None:
+            notification = recent_notifications(settings.NOTIFICATION_COALESCE_MAX_AGE).select_for_update().filter(
+                user_id=user_id,
+                kind=kind,
+                target=target,
+                is_read=False,
+                updated_date__gte=coalesce_window_start()
+            ).order_by('-updated_date').first()
+        if notification is None:
+            notification = Notification.objects.create(
+                user_id=user_id,
+                kind=kind,
+                target=target,
+                information=single,
+                direct_url=direct_url
+            )
+            transaction.on_commit(lambda: change_unread_counts({user_id: 1}))
+        else:
+            notification.count += 1
+            notification.information = f'{notification.count}{merged}'
+            notification.direct_url = direct_url
+            notification.updated_date = timezone.now()
+            notification.save(update_fields=['count', 'information', 'direct_url', 'updated_date'])
+
+    message = {
+        'type': 'notify',
+        'notification': NotificationSerializer(notification).data
+    }
+    with CHANNEL_SEND_SECONDS.time(target='user'):
+        async_to_sync(get_channel_layer().group_send)(user_group_name(user_id), message)
+    return notification
+
+
+def unread_count_key(user_id):
+    return f'notifications:unread:{user_id}'
+
+
+def unread_count_version_key(user_id):
+    return f'notifications:unread:{user_id}:version'
+
+
+def count_unread(user_id):
+    return recent_notifications().filter(user_id=user_id, is_read=False).count()
+
+
+def get_unread_count(user_id):
+    r = get_redis()
+    count = r.get(unread_count_key(user_id))
+    if count is not None:
+        return int(count)
+    # changes that land while counting are missed by the cached value, the
+    # count is then only returned and counted again on the next read
+    version = r.get(unread_count_version_key(user_id)) or b''
+    count = count_unread(user_id)
+    r.register_script(SET_COUNT_OF_VERSION)(
+        keys=[unread_count_key(user_id), unread_count_version_key(user_id)],
+        args=[version, count, settings.NOTIFICATION_UNREAD_COUNT_TTL]
+    )
+    return count
+
+
+def change_unread_counts(amounts):
+    # amounts maps user ids to the change of their unread count
+    amounts = {user_id: amount for user_id, amount in amounts.items() if amount}
+    if not amounts:
+        return
+    r = get_redis()
+    add_to_count = r.register_script(ADD_TO_EXISTING_COUNT)
+    pipe = r.pipeline(transaction=False)
+    for user_id, amount in amounts.items():
+        add_to_count(keys=[unread_count_key(user_id), unread_count_version_key(user_id)],
+                     args=[amount, settings.NOTIFICATION_UNREAD_COUNT_TTL], client=pipe)
+    pipe.execute()
+
+
+def forget_unread_count(user_id):
+    pipe = get_redis().pipeline()
+    pipe.delete(unread_count_key(user_id))
+    pipe.incr(unread_count_version_key(user_id))
+    pipe.expire(unread_count_version_key(user_id), settings.NOTIFICATION_UNREAD_COUNT_TTL)
+    pipe.execute()
+
+
+def mark_read_filters(data):
+    # reads the notifications to mark from a request or socket payload:
+    # a list of `ids`, an `up_to_id` or `up_to_date` watermark, or the
+    # `kind` and `target` of a community broadcast. raises ValueError
+    if not isinstance(data, dict):
+        raise ValueError('an object with ids, up_to_id, up_to_date or target is required')
+    filters = {}
+    if data.get('ids') is not None:
+        if not isinstance(data['ids'], list):
+            raise ValueError('ids must be a list')
+        filters['id__in'] = [int(notification_id) for notification_id in data['ids']]
+    if data.get('up_to_id') is not None:
+        filters['id__lte'] = int(data['up_to_id'])
+    if data.get('up_to_date') is not None:
+        up_to_date = parse_datetime(str(data['up_to_date']))
+        if up_to_date is None:
+            raise ValueError('up_to_date must be a datetime')
+        filters['created_date__lte'] = up_to_date
+    if data.get('target'):
+        filters['kind'] = data.get('kind', '')
+        filters['target'] = data['target']
+    if not filters:
+        raise ValueError('ids, up_to_id, up_to_date or target is required')
+    return filters
+
+
+def mark_notifications_read(user_id, filters):
+    # one update scoped to the user, the cached count drops by the marked rows
+    marked = recent_notifications().filter(user_id=user_id, is_read=False, **filters).update(is_read=True)
+    change_unread_counts({user_id: -marked})
+    return marked
+
+
+def unread_notifications_page(user, cursor=None, limit=None):
+    # newest unread notifications first, served by notification_user_unread_idx.
+    # returns the notifications and the cursor of the next page or None,
+    # raises ValueError for invalid cursors
+    if not limit or limit < 0:
+        limit = settings.NOTIFICATION_PAGE_SIZE
+    limit = min(limit, 100)
+    notifications = recent_notifications().filter(user=user, is_read=False).order_by('-created_date', '-id')
+    if cursor is not None:
+        created_date, notification_id = decode_cursor(cursor)
+        created_date = parse_datetime(created_date)
+        if created_date is None:
+            raise ValueError('invalid cursor')
+        notifications = notifications.filter(
+            Q(created_date__lt=created_date) | Q(created_date=created_date, id__lt=notification_id)
+        )
+    notifications = list(notifications[:limit + 1])
+    next_cursor = None
+    if len(notifications) > limit:
+        notifications = notifications[:limit]
+        last = notifications[-1]
+        next_cursor = encode_cursor([last.created_date.isoformat(), last.id])
+    return notifications, next_cursor
+
+
+def unread_notifications_since(user, last_id):
+    # what a reconnecting client missed after the last notification it has
+    # seen, new rows and the merged rows that were bumped since then
+    last_seen = recent_notifications().filter(user=user, id=last_id).values_list('created_date', flat=True).first()
+    missed = Q(id__gt=last_id)
+    if last_seen is not None:
+        missed |= Q(updated_date__gt=last_seen)
+    return list(recent_notifications().filter(missed, user=user, is_read=False).order_by(
+        '-updated_date', '-id'
+    )[:settings.NOTIFICATION_RESUME_LIMIT])
+
+
+def notify_subscription_changed(user_id, community_id, subscribed):
+    # every socket of the user joins or leaves the community group
+    with CHANNEL_SEND_SECONDS.time(target='user'):
+        async_to_sync(get_channel_layer().group_send)(user_group_name(user_id), {
+            'type': 'subscription.changed',
+            'community_id': community_id,
+            'subscribed': subscribed,
+        })
+
+
+def request_topic_fan_out(topic, url):
+    # hands the notifications of a new topic to the worker so the request
+    # does not depend on the number of subscribers. it runs after the topic
+    # is committed, so a full channel or an unreachable redis only loses the
+    # notifications and is logged instead of failing the request
+    try:
+        with CHANNEL_SEND_SECONDS.time(target='worker'):
+            async_to_sync(get_channel_layer().send)(FANOUT_CHANNEL, {
+                'type': 'topic.created',
+                'topic_id': topic.id,
+                'url': url,
+            })
+    except (ChannelFull, RedisError, OSError):
+        logger.exception('could not hand the notifications of topic %s to the fan-out worker', topic.id)
+
+
+def create_topic_notifications(topic, url, after_id=0):
+    # handles the next chunk of subscribers, users with a recent unread
+    # notification of the community get it bumped with one update and the
+    # others get new rows with one insert. digest users are skipped, they
+    # are notified by the send_notification_digests command.
+    # returns the last subscriber id of the chunk and the number of rows touched
+    subscribers = list(Subscriber.objects.filter(
+        community_id=topic.community_id,
+        id__gt=after_id
+    ).order_by('id').values_list('id', 'user_id', 'user__profile__notification_digest')[
+        :settings.NOTIFICATION_FANOUT_CHUNK_SIZE
+    ])
+    if not subscribers:
+        return after_id, 0
+
+    user_ids = {user_id for _, user_id, digest in subscribers if not digest}
+    target = notification_target(topic.community)
+    single, merged = notification_texts(Notification.Kind.NEW_POST, name=topic.community.name)
+    with transaction.atomic():
+        recent = recent_notifications(settings.NOTIFICATION_COALESCE_MAX_AGE).select_for_update().filter(
+            user_id__in=user_ids,
+            kind=Notification.Kind.NEW_POST,
+            target=target,
+            is_read=False,
+            updated_date__gte=coalesce_window_start()
+        )
+        coalesced = dict(recent.values_list('id', 'user_id'))
+        recent_notifications(settings.NOTIFICATION_COALESCE_MAX_AGE).filter(id__in=coalesced).update(
+            count=F('count') + 1,
+            information=Concat(
+                Cast(F('count') + 1, CharField()),
+                Value(merged)
+            ),
+            direct_url=url,
+            updated_date=timezone.now()
+        )
+        created = Notification.objects.bulk_create([
+            Notification(
+                user_id=user_id,
+                kind=Notification.Kind.NEW_POST,
+                target=target,
+                information=single,
+                direct_url=url
+            ) for user_id in user_ids - set(coalesced.values())
+        ])
+    change_unread_counts({notification.user_id: 1 for notification in created})
+    return subscribers[-1][0], len(coalesced) + len(created)
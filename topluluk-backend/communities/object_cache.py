@@ -0,0 +1,68 @@
+import copy
+
+from django.conf import settings
+
+from communities.annotations import profile_karma_total
+from communities.cache import TieredCache
+from communities.models import Community, Profile, Topic
+from communities.serializers import TopicSerializer
+
+# community metadata, profile and topic cards shared by the workers. changed
+# communities, profiles and topics are invalidated, the karma of a profile
+# card and the counters of a topic card change with every vote and view and
+# are refreshed once the card is older than its ttl. every caller gets its own copy of
+# the cached instances since views set annotations on them
+
+communities = TieredCache('community', ttl=settings.OBJECT_CACHE_TTL)
+profile_cards = TieredCache('profile_card', ttl=settings.PROFILE_CARD_TTL, stale_ttl=settings.PROFILE_CARD_STALE_TTL)
+profile_slugs = TieredCache('profile_slug', ttl=settings.OBJECT_CACHE_TTL)
+topic_cards = TieredCache('topic_card', ttl=settings.TOPIC_CARD_TTL, stale_ttl=settings.TOPIC_CARD_STALE_TTL)
+
+
+def card_queryset():
+    return Profile.objects.defer('interest_vector', 'weighted_sum_vector').annotate(karma_total=profile_karma_total())
+
+
+def get_communities(community_ids):
+    # deleted communities are missing from the result
+    found = communities.get_many(community_ids, lambda ids: Community.objects.defer('embedding').in_bulk(ids))
+    return {community_id: copy.copy(community) for community_id, community in found.items()}
+
+
+def get_profile_card(user_id):
+    # None for users without a profile
+    profile = profile_cards.get(user_id, lambda: card_queryset().filter(user_id=user_id).first())
+    return copy.copy(profile)
+
+
+def get_profile_cards(user_ids):
+    def load(missing):
+        return {profile.user_id: profile for profile in card_queryset().filter(user_id__in=missing)}
+
+    return {user_id: copy.copy(profile) for user_id, profile in profile_cards.get_many(user_ids, load).items()}
+
+
+def get_topic_cards(topic_ids):
+    # topics with their community and counters, without a request every
+    # field of the serializer is prepared
+    def load(missing):
+        return TopicSerializer.prepare_queryset(Topic.objects.all(), {}).in_bulk(missing)
+
+    return {topic_id: copy.copy(topic) for topic_id, topic in topic_cards.get_many(topic_ids, load).items()}
+
+
+def profile_user_id(slug):
+    return profile_slugs.get(slug, lambda: Profile.objects.filter(slug=slug).values_list('user_id', flat=True).first())
+
+
+def forget_community(community_id):
+    communities.invalidate(community_id)
+
+
+def forget_profile(user_id, slug):
+    profile_cards.invalidate(user_id)
+    profile_slugs.invalidate(slug)
+
+
+def forget_topic(topic_id):
+    topic_cards.invalidate(topic_id)
@@ -0,0 +1,79 @@
+import asyncio
+from collections import deque
+
+from communities.metrics import OUTBOX_MESSAGES, OUTBOX_FRAMES
+
+# what happens when the buffer of a slow connection is full
+DROP_OLDEST = 'drop'
+COLLAPSE = 'collapse'
+
+
+class OutboundBuffer:
+    # per connection buffer of outgoing messages, messages that arrive within
+    # `delay` seconds are sent as one frame by send_frame(messages).
+    # at most `max_size` messages wait, after that the oldest one is dropped
+    # or every waiting message is collapsed into a single count
+    def __init__(self, send_frame, delay=0.01, max_size=100, policy=COLLAPSE):
+        self.send_frame = send_frame
+        self.delay = delay
+        self.max_size = max_size
+        self.policy = policy
+        self.messages = deque()
+        self.collapsed = 0
+        self.flush_task = None
+        self.metrics = {
+            'received': 0,
+            'sent': 0,
+            'frames': 0,
+            'dropped': 0,
+            'collapsed': 0,
+            'max_waiting': 0,
+        }
+
+    def push(self, message):
+        self.metrics['received'] += 1
+        OUTBOX_MESSAGES.inc(event='received')
+        if len(self.messages) >= self.max_size:
+            if self.policy == DROP_OLDEST:
+                self.messages.popleft()
+                self.metrics['dropped'] += 1
+                OUTBOX_MESSAGES.inc(event='dropped')
+            else:
+                self.collapsed += len(self.messages)
+                self.metrics['collapsed'] += len(self.messages)
+                OUTBOX_MESSAGES.inc(len(self.messages), event='collapsed')
+                self.messages.clear()
+        self.messages.append(message)
+        self.metrics['max_waiting'] = max(self.metrics['max_waiting'], len(self.messages) + bool(self.collapsed))
+
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.flush_later())
+
+    async def flush_later(self):
+        try:
+            await asyncio.sleep(self.delay)
+            # messages pushed while a frame is being sent wait for the next one
+            while self.messages or self.collapsed:
+                await self.flush()
+        finally:
+            self.flush_task = None
+
+    async def flush(self):
+        messages = list(self.messages)
+        self.messages.clear()
+        if self.collapsed:
+            # the client fetches what it missed instead of receiving every message
+            messages.insert(0, {'type': 'notifications_collapsed', 'payload': {'count': self.collapsed}})
+            self.collapsed = 0
+        if not messages:
+            return
+        await self.send_frame(messages)
+        self.metrics['sent'] += len(messages)
+        self.metrics['frames'] += 1
+        OUTBOX_MESSAGES.inc(len(messages), event='sent')
+        OUTBOX_FRAMES.inc()
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
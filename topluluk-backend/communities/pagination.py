@@ -0,0 +1,111 @@
+import base64
+import binascii
+import datetime
+import json
+
+from django.core.exceptions import ValidationError, FieldDoesNotExist
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+
+class KeysetCursorPagination(CursorPagination):
+    # cursor pagination that never counts the queryset and never uses OFFSET.
+    # views set `cursor_ordering` to model fields that end with the id and are
+    # backed by a composite index, the cursor holds the values of all of them
+    # for the first or last row of the page and the next page is filtered
+    # with a row comparison on them, so ties of the leading fields cost nothing
+    ordering = ('-created_date', '-id')
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    def get_ordering(self, request, queryset, view):
+        ordering = getattr(view, 'cursor_ordering', None)
+        if ordering is not None:
+            return tuple(ordering)
+        return tuple(self.ordering)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        # (field, descending) in the order the page is read
+        self.fields = [(name.lstrip('-'), name.startswith('-')) for name in self.ordering]
+        position, self.reverse = self.decode_position(request, queryset.model)
+
+        read_order = [(field, descending != self.reverse) for field, descending in self.fields]
+        queryset = queryset.order_by(*[F(field).desc() if descending else F(field).asc()
+                                       for field, descending in read_order])
+        if position is not None:
+            queryset = queryset.filter(keyset_condition(read_order, position))
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        if self.reverse:
+            self.page.reverse()
+            self.has_previous, self.has_next = has_more, position is not None
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.link(self.page[-1], reverse=False) if self.page else self.first_link()
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        return self.link(self.page[0], reverse=True) if self.page else self.first_link()
+
+    def first_link(self):
+        return remove_query_param(self.base_url, self.cursor_query_param)
+
+    def link(self, row, reverse):
+        position = [encode_value(getattr(row, field)) for field, _ in self.fields]
+        cursor = json.dumps({'p': position, 'r': reverse}).encode()
+        return replace_query_param(self.base_url, self.cursor_query_param, base64.urlsafe_b64encode(cursor).decode())
+
+    def decode_position(self, request, model):
+        # (position, reverse), the position is None on the first page
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None, False
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            position, reverse = cursor['p'], cursor['r']
+            if not isinstance(position, list) or len(position) != len(self.fields) or not isinstance(reverse, bool):
+                raise ValueError
+            parsed = []
+            for (field, _), value in zip(self.fields, position):
+                if value is None:
+                    raise ValueError
+                parsed.append(model._meta.get_field(field).to_python(value))
+            return parsed, reverse
+        except (TypeError, KeyError, ValueError, binascii.Error, UnicodeDecodeError, ValidationError,
+                FieldDoesNotExist):
+            raise NotFound(self.invalid_cursor_message)
+
+
+def encode_value(value):
+    # isoformat keeps the microseconds that the row comparison needs
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def keyset_condition(order, position):
+    # keyset condition for every row after position in the (field, descending) order
+    condition = Q()
+    equal = {}
+    for (field, descending), value in zip(order, position):
+        lookup = 'lt' if descending else 'gt'
+        condition |= Q(**equal, **{f'{field}__{lookup}': value})
+        equal[field] = value
+    return condition
@@ -1,6 +1,11 @@
+import logging
+
 from rest_framework import permissions
 
-from communities.models import Profile, Moderator, Ban, Topic, Comment
+from communities.authorization import get_authorization
+from communities.models import Profile, Topic, Comment
+
+logger = logging.getLogger(__name__)
 
 
 class IsOwnerOrReadonly(permissions.BasePermission):
@@ -28,11 +33,13 @@ class IsNotAuthenticated(permissions.BasePermission):
     def has_permission(self, request, view):
         return not request.user.is_authenticated
 
+# moderator and ban checks read the cached authorization of the user
+
 # permission for Community object
 class IsModerator(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
         if request.user.is_authenticated:
-            return Moderator.objects.filter(user=request.user, community=obj).exists()
+            return get_authorization(request).is_moderator(obj.id)
         return False
 
 class IsModeratorOfComment(permissions.BasePermission):
@@ -40,14 +47,14 @@ class IsModeratorOfComment(permissions.BasePermission):
         if not isinstance(obj, Comment):
             return False
         if request.user.is_authenticated:
-            return Moderator.objects.filter(user=request.user, community=obj.topic.community).exists()
+            return get_authorization(request).is_moderator(obj.topic.community_id)
         return False
 
 # object is treated as Topic
 class IsModeratorOfTopic(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
         if request.user.is_authenticated:
-            return Moderator.objects.filter(user=request.user, community=obj.community).exists()
+            return get_authorization(request).is_moderator(obj.community_id)
         return False
 
 # same as Topic but for Ban
@@ -55,28 +62,21 @@ class IsModeratorOfBan(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
         if request.user.is_authenticated:
             # prevent the user trying to ban himself
-            if obj.user.id == request.user.id:
+            if obj.user_id == request.user.id:
                 return False
-            return Moderator.objects.filter(user=request.user, community=obj.community).exists()
+            return get_authorization(request).is_moderator(obj.community_id)
         return False
 
 class IsNotBannedFromCommunity(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
-        community = None
         if isinstance(obj, Topic):
-            community = obj.community
+            community_id = obj.community_id
         elif isinstance(obj, Comment):
-            community = obj.topic.community
+            community_id = obj.topic.community_id
         else:
-            print('Not handled type for Ban Permission')
+            # without a community the ban cannot be checked
+            logger.warning('IsNotBannedFromCommunity does not handle %s objects', type(obj).__name__)
+            return False
         if request.user.is_authenticated:
-            bans = Ban.objects.filter(user=request.user, community=community)
-            if bans.exists():
-                any_ban_active = False
-                for ban in bans:
-                    if ban.is_active():
-                        any_ban_active = True
-                        break
-                return not any_ban_active
-            return True
+            return not get_authorization(request).is_banned(community_id)
         return True
\ No newline at end of file
@@ -0,0 +1,50 @@
+import sys
+import threading
+from collections import Counter
+
+
+class StackSampler:
+    # samples the stack of one thread from a background thread every
+    # `interval` seconds. the sampled thread is not traced, it only shares
+    # the gil with the sampler while a sample is taken
+    max_depth = 40
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.stacks[self.stack_of(frame)] += 1
+            self.samples += 1
+
+    def stack_of(self, frame):
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            stack.append(f'{code.co_filename}:{frame.f_lineno} {code.co_name}')
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+    def report(self, top):
+        # the most sampled stacks, innermost frame last
+        lines = []
+        for stack, count in self.stacks.most_common(top):
+            lines.append(f'{count}/{self.samples} samples:')
+            lines.extend(f'    {frame}' for frame in stack)
+        return '\n'.join(lines)
@@ -0,0 +1,13 @@
+import redis
+from django.conf import settings
+
+_client = None
+
+
+# shared client of the application redis database, it is thread safe
+# and keeps its own connection pool
+def get_redis():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(settings.REDIS_URL)
+    return _client
@@ -0,0 +1,112 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+
+from communities.cache import LocalCache
+
+# detail responses are cached per object under a version that changes with
+# the object, its comments, votes and views. the version is a timestamp in
+# microseconds so it is also the last modified time of the response.
+# frequent changes like votes bump it at most once per throttle interval,
+# the ones in between are picked up by the first read after the interval
+
+local_object_ids = LocalCache(max_size=settings.RESPONSE_CACHE_LOCAL_SIZE, ttl=settings.RESPONSE_CACHE_LOCAL_TTL)
+
+
+def version_key(name, object_id):
+    return f'response_version:{name}:{object_id}'
+
+
+def throttle_key(name, object_id):
+    return f'response_version_throttle:{name}:{object_id}'
+
+
+def pending_key(name, object_id):
+    return f'response_version_pending:{name}:{object_id}'
+
+
+def payload_key(name, object_id, version, variant):
+    return f'response:{name}:{object_id}:{version}:{variant}'
+
+
+def object_id_key(name, slug):
+    return f'response_object_id:{name}:{slug}'
+
+
+def bump_version(name, object_id):
+    version = time.time_ns() // 1000
+    cache.set(version_key(name, object_id), version, settings.RESPONSE_CACHE_VERSION_TTL)
+    return version
+
+
+def bump_version_throttled(name, object_id):
+    if cache.add(throttle_key(name, object_id), 1, settings.RESPONSE_CACHE_THROTTLE):
+        bump_version(name, object_id)
+    else:
+        cache.set(pending_key(name, object_id), 1, settings.RESPONSE_CACHE_VERSION_TTL)
+
+
+def get_version(name, object_id):
+    keys = [version_key(name, object_id), throttle_key(name, object_id), pending_key(name, object_id)]
+    values = cache.get_many(keys)
+    if keys[2] in values and keys[1] not in values:
+        # a throttled change waited out its interval
+        cache.delete(keys[2])
+        cache.add(keys[1], 1, settings.RESPONSE_CACHE_THROTTLE)
+        return bump_version(name, object_id)
+
+    version = values.get(keys[0])
+    if version is None:
+        version = time.time_ns() // 1000
+        if not cache.add(keys[0], version, settings.RESPONSE_CACHE_VERSION_TTL):
+            version = cache.get(keys[0], version)
+    return version
+
+
+def cached_object_id(name, model, slug):
+    # slugs never change, so the id behind one is cached until the object is deleted
+    key = object_id_key(name, slug)
+    object_id = local_object_ids.get(key)
+    if object_id is None:
+        object_id = cache.get(key)
+        if object_id is None:
+            object_id = model.objects.filter(slug=slug).values_list('id', flat=True).first()
+            if object_id is None:
+                return None
+            cache.set(key, object_id, settings.RESPONSE_CACHE_VERSION_TTL)
+        local_object_ids.set(key, object_id)
+    return object_id
+
+
+def forget_object_id(name, slug):
+    key = object_id_key(name, slug)
+    cache.delete(key)
+    local_object_ids.delete(key)
+
+
+def response_variant(request):
+    # hyperlinks carry the host, the query selects fields and the accept
+    # header the renderer, each combination is a separate payload
+    variant = '|'.join([request.get_host(), request.META.get('QUERY_STRING', ''), request.META.get('HTTP_ACCEPT', '')])
+    return hashlib.md5(variant.encode()).hexdigest()[:12]
+
+
+def validators(name, object_id, version, variant):
+    # the ETag and Last-Modified headers of a version
+    return {
+        'ETag': f'"{name}-{object_id}-{version}-{variant}"',
+        'Last-Modified': http_date(version // 1_000_000),
+    }
+
+
+def not_modified(request, headers):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        # weak comparison, a compressing proxy may have weakened the tag
+        etags = [etag.removeprefix('W/') for etag in parse_etags(if_none_match)]
+        return '*' in etags or headers['ETag'] in etags
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return if_modified_since is not None and parse_http_date_safe(headers['Last-Modified']) <= if_modified_since
@@ -1,6 +1,11 @@
 from django.urls import re_path
 from . import consumers
+from .notifications import FANOUT_CHANNEL
 
 websocket_urlpatterns = [
     re_path(r'ws/notifications/$', consumers.NotificationConsumer.as_asgi()),
 ]
+
+worker_channels = {
+    FANOUT_CHANNEL: consumers.NotificationFanoutConsumer.as_asgi(),
+}
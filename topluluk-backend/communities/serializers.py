@@ -1,7 +1,16 @@
+import contextvars
+
 from django.contrib.auth.models import User
-from rest_framework import serializers
+from django.db import models
+from rest_framework import serializers, permissions
+from rest_framework.reverse import reverse
+from rest_framework.utils.urls import replace_query_param
 
-from communities.models import Profile, Community, Subscriber, Moderator, Topic, Comment, TopicVote, Notification, Ban
+from communities.annotations import community_subscriber_total, community_view_total, topic_vote_total, \
+    topic_view_total, topic_comment_total, profile_karma_total
+from communities.comment_tree import CommentTree, encode_cursor
+from communities.metrics import SERIALIZER_SECONDS
+from communities.models import Profile, Community, Subscriber, Moderator, Topic, Comment, Notification, Ban
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -25,7 +34,63 @@ class UserRegisterSerializer(serializers.ModelSerializer):
         user.save()
         return user
 
-class ProfileSerializer(serializers.HyperlinkedModelSerializer):
+def query_param_set(request, name):
+    if request is None:
+        return None
+    value = request.query_params.get(name, '')
+    names = {field.strip() for field in value.split(',') if field.strip()}
+    return names or None
+
+def annotated_or(obj, name, compute):
+    # prefers the counter annotated by prepare_queryset over a query per object
+    value = getattr(obj, name, None)
+    if value is None:
+        return compute()
+    return value
+
+# set while a top level object is serialized, nested serializers are timed with it
+serializing = contextvars.ContextVar('serializing', default=False)
+
+class TimedRepresentationMixin:
+    def to_representation(self, instance):
+        if serializing.get():
+            return super().to_representation(instance)
+        token = serializing.set(True)
+        try:
+            with SERIALIZER_SECONDS.time(serializer=type(self).__name__):
+                return super().to_representation(instance)
+        finally:
+            serializing.reset(token)
+
+class DynamicFieldsMixin:
+    # `?fields=a,b` keeps only the listed fields. the expensive fields in
+    # Meta.expandable_fields are left out of lists unless they are listed
+    # in `?fields=`, `?expand=` or in the `expand` of the context
+    @classmethod
+    def selected_fields(cls, context, many):
+        request = context.get('request', None)
+        selected = set(cls.Meta.fields)
+        if request is None or request.method not in permissions.SAFE_METHODS:
+            return selected
+        fields = query_param_set(request, 'fields')
+        if fields is not None:
+            return selected & fields
+        if many:
+            expand = (query_param_set(request, 'expand') or set()) | set(context.get('expand', ()))
+            selected -= set(cls.Meta.expandable_fields) - expand
+        return selected
+
+    @classmethod
+    def prepare_queryset(cls, queryset, context, many=True):
+        return queryset
+
+    def get_fields(self):
+        fields = super().get_fields()
+        many = isinstance(self.parent, serializers.ListSerializer)
+        selected = self.selected_fields(self.context, many)
+        return {name: field for name, field in fields.items() if name in selected}
+
+class ProfileSerializer(TimedRepresentationMixin, DynamicFieldsMixin, serializers.HyperlinkedModelSerializer):
     user = serializers.HyperlinkedRelatedField(
         view_name='user-detail',
         read_only=True
@@ -34,41 +99,84 @@ class ProfileSerializer(serializers.HyperlinkedModelSerializer):
         view_name='profile-detail',
         lookup_field='slug'
     )
+    karma = serializers.SerializerMethodField()
     karma_after = serializers.SerializerMethodField()
 
     class Meta:
         model = Profile
-        fields = ['url', 'user', 'display_name', 'image', 'description', 'links', 'karma', 'karma_after']
+        fields = ['url', 'user', 'display_name', 'image', 'description', 'links', 'karma', 'karma_after',
+                  'notification_digest']
+        expandable_fields = ['karma']
+
+    @classmethod
+    def prepare_queryset(cls, queryset, context, many=True):
+        selected = cls.selected_fields(context, many)
+        queryset = queryset.defer('interest_vector', 'weighted_sum_vector')
+        if 'karma' in selected:
+            queryset = queryset.annotate(karma_total=profile_karma_total())
+        time_query = context.get('karma_after_time', None)
+        if 'karma_after' in selected and time_query is not None:
+            queryset = queryset.annotate(karma_total_after=profile_karma_total(time_query))
+        return queryset
+
+    def get_karma(self, profile):
+        return annotated_or(profile, 'karma_total', profile.karma)
 
     def get_karma_after(self, profile):
         time_query = self.context.get('karma_after_time', None)
         if time_query is not None:
-            return profile.karma_after(time_query)
+            return annotated_or(profile, 'karma_total_after', lambda: profile.karma_after(time_query))
         return None
 
-class CommunitySerializer(serializers.HyperlinkedModelSerializer):
+class CommunitySerializer(TimedRepresentationMixin, DynamicFieldsMixin, serializers.HyperlinkedModelSerializer):
     url = serializers.HyperlinkedIdentityField(
         view_name='community-detail',
         lookup_field='slug'
     )
+    subscriber_count = serializers.SerializerMethodField()
     subscriber_count_after = serializers.SerializerMethodField()
+    total_view_count = serializers.SerializerMethodField()
     view_count_after = serializers.SerializerMethodField()
 
     class Meta:
         model = Community
         fields = ['url', 'name', 'image', 'description', 'slug', 'subscriber_count', 'subscriber_count_after',
                     'total_view_count', 'view_count_after']
+        expandable_fields = ['subscriber_count', 'total_view_count']
+
+    @classmethod
+    def prepare_queryset(cls, queryset, context, many=True):
+        selected = cls.selected_fields(context, many)
+        queryset = queryset.defer('embedding')
+        if 'subscriber_count' in selected:
+            queryset = queryset.annotate(subscriber_total=community_subscriber_total())
+        if 'total_view_count' in selected:
+            queryset = queryset.annotate(view_total=community_view_total())
+        subscriber_time_query = context.get('subscriber_count_after_time', None)
+        if 'subscriber_count_after' in selected and subscriber_time_query is not None:
+            queryset = queryset.annotate(subscriber_total_after=community_subscriber_total(subscriber_time_query))
+        view_time_query = context.get('view_count_after_time', None)
+        if 'view_count_after' in selected and view_time_query is not None:
+            queryset = queryset.annotate(view_total_after=community_view_total(view_time_query))
+        return queryset
+
+    def get_subscriber_count(self, community):
+        return annotated_or(community, 'subscriber_total', community.subscriber_count)
+
+    def get_total_view_count(self, community):
+        return annotated_or(community, 'view_total', community.total_view_count)
 
     def get_subscriber_count_after(self, community):
         time_query = self.context.get('subscriber_count_after_time', None)
         if time_query is not None:
-            return community.subscriber_count_after(time_query)
+            return annotated_or(community, 'subscriber_total_after',
+                                lambda: community.subscriber_count_after(time_query))
         return None
 
     def get_view_count_after(self, community):
-        time_query = self.context.get('subscriber_count_after_time', None)
+        time_query = self.context.get('view_count_after_time', None)
         if time_query is not None:
-            return community.view_count_after(time_query)
+            return annotated_or(community, 'view_total_after', lambda: community.view_count_after(time_query))
         return None
 
 class SubscriberSerializer(serializers.HyperlinkedModelSerializer):
@@ -94,12 +202,12 @@ class ModeratorSerializer(serializers.HyperlinkedModelSerializer):
         model = Moderator
         fields = '__all__'
 
-class NotificationSerializer(serializers.ModelSerializer):
+class NotificationSerializer(TimedRepresentationMixin, serializers.ModelSerializer):
     class Meta:
         model = Notification
         fields = '__all__'
 
-class CommentSerializer(serializers.HyperlinkedModelSerializer):
+class CommentSerializer(TimedRepresentationMixin, serializers.HyperlinkedModelSerializer):
     url = serializers.HyperlinkedIdentityField(
         view_name='comment-detail'
     )
@@ -112,17 +220,71 @@ class CommentSerializer(serializers.HyperlinkedModelSerializer):
         view_name='topic-detail',
         lookup_field='slug',
     )
+    vote_count = serializers.IntegerField(source='score', read_only=True)
     replies = serializers.SerializerMethodField()
 
     class Meta:
         model = Comment
         fields = ['url', 'id', 'topic', 'text', 'created_date', 'user', 'vote_count', 'upper_comment', 'replies']
 
+    def validate_upper_comment(self, upper_comment):
+        if upper_comment is not None and upper_comment.depth >= Comment.MAX_DEPTH:
+            raise serializers.ValidationError(f'Replies can be nested at most {Comment.MAX_DEPTH} levels deep.')
+        return upper_comment
+
+    def validate(self, attrs):
+        # the path and depth of a comment and of its replies are set when it
+        # is posted, so a comment cannot be moved to another topic or parent
+        if self.instance is not None:
+            for field in ('topic', 'upper_comment'):
+                if field in attrs and attrs[field] != getattr(self.instance, field):
+                    raise serializers.ValidationError({field: 'A posted comment cannot be moved.'})
+        topic = attrs.get('topic')
+        upper_comment = attrs.get('upper_comment')
+        if topic is not None and upper_comment is not None and upper_comment.topic_id != topic.id:
+            raise serializers.ValidationError({'upper_comment': 'Replies must be in the topic of their comment.'})
+        return attrs
+
     def get_replies(self, obj):
-        serializer = CommentSerializer(obj.replies.all(), many=True, context=self.context)
+        comment_tree = self.context.get('comment_tree', None)
+        if comment_tree is not None and comment_tree.covers(obj.topic):
+            replies = comment_tree.replies_of(obj)
+        else:
+            replies = obj.replies.all()
+        serializer = self.__class__(replies, many=True, context=self.context)
         return serializer.data
 
-class TopicSerializer(serializers.HyperlinkedModelSerializer):
+class CommentThreadSerializer(CommentSerializer):
+    # expects a CommentThread as the comment tree of the context
+    more_replies = serializers.SerializerMethodField()
+
+    class Meta(CommentSerializer.Meta):
+        fields = CommentSerializer.Meta.fields + ['more_replies']
+
+    def get_more_replies(self, obj):
+        comment_thread = self.context['comment_tree']
+        if not comment_thread.has_more_replies(obj):
+            return None
+        request = self.context['request']
+        url = reverse('topic-comments', kwargs={'slug': obj.topic.slug}, request=request)
+        url = replace_query_param(url, 'parent', obj.id)
+        for param in ('depth', 'limit', 'sort'):
+            if param in request.query_params:
+                url = replace_query_param(url, param, request.query_params[param])
+        after = comment_thread.replies_after(obj)
+        if after is not None:
+            url = replace_query_param(url, 'cursor', encode_cursor(after))
+        return {'url': url}
+
+class TopicListSerializer(serializers.ListSerializer):
+    # loads the comments of every topic on the page at once
+    def to_representation(self, data):
+        topics = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        if 'comments' in self.child.fields:
+            self._context = {**self.context, 'comment_tree': CommentTree(topics)}
+        return super().to_representation(topics)
+
+class TopicSerializer(TimedRepresentationMixin, DynamicFieldsMixin, serializers.HyperlinkedModelSerializer):
     community = serializers.HyperlinkedRelatedField(
         queryset=Community.objects.all(),
         view_name='community-detail',
@@ -136,16 +298,49 @@ class TopicSerializer(serializers.HyperlinkedModelSerializer):
         view_name='topic-detail',
         lookup_field='slug'
     )
+    vote_count = serializers.SerializerMethodField()
+    view_count = serializers.SerializerMethodField()
+    comment_count = serializers.SerializerMethodField()
     comments = serializers.SerializerMethodField()
 
     class Meta:
         model = Topic
         fields = ['url', 'community', 'title', 'text', 'image', 'created_date', 'user',
-                  'vote_count', 'view_count', 'comments', 'slug']
+                  'vote_count', 'view_count', 'comment_count', 'comments', 'slug']
+        expandable_fields = ['comments']
+        list_serializer_class = TopicListSerializer
+
+    @classmethod
+    def prepare_queryset(cls, queryset, context, many=True):
+        selected = cls.selected_fields(context, many)
+        queryset = queryset.defer('embedding')
+        if 'text' not in selected:
+            queryset = queryset.defer('text')
+        if 'community' in selected:
+            queryset = queryset.select_related('community').defer('community__embedding', 'community__description')
+        if 'vote_count' in selected:
+            queryset = queryset.annotate(vote_total=topic_vote_total())
+        if 'view_count' in selected:
+            queryset = queryset.annotate(view_total=topic_view_total())
+        if 'comment_count' in selected:
+            queryset = queryset.annotate(comment_total=topic_comment_total())
+        return queryset
+
+    def get_vote_count(self, obj):
+        return annotated_or(obj, 'vote_total', obj.vote_count)
+
+    def get_view_count(self, obj):
+        return annotated_or(obj, 'view_total', obj.view_count)
+
+    def get_comment_count(self, obj):
+        return annotated_or(obj, 'comment_total', obj.comments.count)
 
     def get_comments(self, obj):
-        top_comments = obj.comments.filter(upper_comment__isnull=True).order_by('created_date')
-        return CommentSerializer(top_comments, many=True, read_only=True, context=self.context).data
+        comment_tree = self.context.get('comment_tree', None)
+        if comment_tree is None or not comment_tree.covers(obj):
+            comment_tree = CommentTree([obj])
+        context = {**self.context, 'comment_tree': comment_tree}
+        return CommentSerializer(comment_tree.comments_of(obj), many=True, read_only=True, context=context).data
 
 
 class BanSerializer(serializers.HyperlinkedModelSerializer):
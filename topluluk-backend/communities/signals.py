@@ -0,0 +1,233 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from communities.activity import record_activity
+from communities.authorization import forget_authorization
+from communities.models import Community, Subscriber, CommunityClick, Topic, Comment, TopicVote, CommentVote, \
+    TopicClick, Moderator, Ban, Profile
+from communities.notifications import notify_subscription_changed
+from communities.object_cache import forget_community, forget_profile, forget_topic
+from communities.response_cache import bump_version, bump_version_throttled, forget_object_id
+from communities.timeline import forget_timeline
+from communities.trending import record_trending
+from communities.user_cache import forget_cached_user
+
+
+# votes are changed with update_or_create and queryset deletes,
+# signals catch both so the stored ranking of the comment stays correct
+@receiver([post_save, post_delete], sender=CommentVote)
+def refresh_comment_votes(sender, instance, **kwargs):
+    instance.comment.refresh_votes()
+
+
+# the hot score moves by the change of a single click or vote, it is never
+# counted again from all the rows of the topic
+def add_hot_score(topic_id, amount):
+    if amount:
+        Topic.objects.filter(pk=topic_id).update(hot_score=F('hot_score') + amount)
+
+
+@receiver(post_save, sender=TopicClick)
+def count_topic_click(sender, instance, created, **kwargs):
+    if created:
+        add_hot_score(instance.topic_id, 1)
+
+
+@receiver(post_delete, sender=TopicClick)
+def uncount_topic_click(sender, instance, **kwargs):
+    add_hot_score(instance.topic_id, -1)
+
+
+@receiver(post_save, sender=TopicVote)
+def count_topic_vote(sender, instance, created, **kwargs):
+    add_hot_score(instance.topic_id, (instance.value - (0 if created else instance.stored_value)) * 5)
+    instance.stored_value = instance.value
+
+
+@receiver(post_delete, sender=TopicVote)
+def uncount_topic_vote(sender, instance, **kwargs):
+    add_hot_score(instance.topic_id, -instance.stored_value * 5)
+
+
+# deactivated, deleted or otherwise changed users drop out of the
+# authentication cache once the change is visible to other connections
+@receiver([post_save, post_delete], sender=User)
+def forget_changed_user(sender, instance, **kwargs):
+    user_id = instance.id
+    transaction.on_commit(lambda: forget_cached_user(user_id))
+
+
+# however a subscription is created or deleted, the home timeline of the user
+# is rebuilt and the sockets of the user join or leave the community group
+def subscription_changed_on_commit(instance, subscribed):
+    user_id = instance.user_id
+    community_id = instance.community_id
+
+    def changed():
+        forget_timeline(user_id)
+        notify_subscription_changed(user_id, community_id, subscribed=subscribed)
+
+    transaction.on_commit(changed)
+
+
+@receiver(post_save, sender=Subscriber)
+def subscription_created(sender, instance, created, **kwargs):
+    if created:
+        subscription_changed_on_commit(instance, subscribed=True)
+
+
+@receiver(post_delete, sender=Subscriber)
+def subscription_deleted(sender, instance, **kwargs):
+    subscription_changed_on_commit(instance, subscribed=False)
+
+
+@receiver([post_save, post_delete], sender=Moderator)
+@receiver([post_save, post_delete], sender=Ban)
+def forget_changed_authorization(sender, instance, **kwargs):
+    user_id = instance.user_id
+    transaction.on_commit(lambda: forget_authorization(user_id))
+
+
+# cached detail responses get a new version once the change is committed,
+# votes, views and subscriptions only change counters and are throttled
+def bump_response_version(name, object_id, throttled=False):
+    bump = bump_version_throttled if throttled else bump_version
+    transaction.on_commit(lambda: bump(name, object_id))
+
+
+@receiver([post_save, post_delete], sender=Community)
+def community_changed(sender, instance, **kwargs):
+    bump_response_version('community', instance.id)
+
+
+@receiver([post_save, post_delete], sender=Subscriber)
+@receiver([post_save, post_delete], sender=CommunityClick)
+def community_counters_changed(sender, instance, **kwargs):
+    bump_response_version('community', instance.community_id, throttled=True)
+
+
+@receiver([post_save, post_delete], sender=Topic)
+def topic_changed(sender, instance, **kwargs):
+    bump_response_version('topic', instance.id)
+
+
+@receiver([post_save, post_delete], sender=Comment)
+def topic_comments_changed(sender, instance, **kwargs):
+    bump_response_version('topic', instance.topic_id)
+
+
+@receiver([post_save, post_delete], sender=TopicVote)
+@receiver([post_save, post_delete], sender=TopicClick)
+def topic_counters_changed(sender, instance, **kwargs):
+    bump_response_version('topic', instance.topic_id, throttled=True)
+
+
+# the community response counts the clicks of its topics too
+@receiver([post_save, post_delete], sender=TopicClick)
+def community_topic_clicks_changed(sender, instance, **kwargs):
+    bump_response_version('community', instance.topic.community_id, throttled=True)
+
+
+@receiver([post_save, post_delete], sender=CommentVote)
+def comment_votes_changed(sender, instance, **kwargs):
+    bump_response_version('topic', instance.comment.topic_id, throttled=True)
+
+
+# a deleted slug may be taken by a new object with another id
+@receiver(post_delete, sender=Community)
+@receiver(post_delete, sender=Topic)
+def forget_deleted_slug(sender, instance, **kwargs):
+    name = sender._meta.model_name
+    slug = instance.slug
+    transaction.on_commit(lambda: forget_object_id(name, slug))
+
+
+# the shared object caches drop changed communities and profiles, saves
+# of the interest vectors and the digest date do not change a profile card
+PRIVATE_PROFILE_FIELDS = {'interest_vector', 'weighted_sum_vector', 'total_weight', 'last_digest_date'}
+
+
+@receiver([post_save, post_delete], sender=Community)
+def forget_changed_community(sender, instance, **kwargs):
+    community_id = instance.id
+    transaction.on_commit(lambda: forget_community(community_id))
+
+
+@receiver([post_save, post_delete], sender=Topic)
+def forget_changed_topic(sender, instance, **kwargs):
+    topic_id = instance.id
+    transaction.on_commit(lambda: forget_topic(topic_id))
+
+
+@receiver([post_save, post_delete], sender=Profile)
+def forget_changed_profile(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) <= PRIVATE_PROFILE_FIELDS:
+        return
+    user_id = instance.user_id
+    slug = instance.slug
+    transaction.on_commit(lambda: forget_profile(user_id, slug))
+
+
+# new rows feed the hourly counters of the approximate website activity
+@receiver(post_save, sender=Topic)
+@receiver(post_save, sender=Comment)
+@receiver(post_save, sender=Community)
+@receiver(post_save, sender=TopicClick)
+@receiver(post_save, sender=CommunityClick)
+@receiver(post_save, sender=TopicVote)
+@receiver(post_save, sender=CommentVote)
+def record_new_activity(sender, instance, created, **kwargs):
+    if created:
+        user_id = getattr(instance, 'user_id', None)
+        transaction.on_commit(lambda: record_activity(user_id))
+
+
+# interactions feed the trending communities and topics, the related
+# objects are already loaded by the saves of the clicks and votes
+def record_trending_on_commit(event, community_id=None, topic_id=None):
+    transaction.on_commit(lambda: record_trending(event, community_id=community_id, topic_id=topic_id))
+
+
+@receiver(post_save, sender=CommunityClick)
+def community_viewed(sender, instance, created, **kwargs):
+    if created:
+        record_trending_on_commit('view', community_id=instance.community_id)
+
+
+@receiver(post_save, sender=Subscriber)
+def community_subscribed(sender, instance, created, **kwargs):
+    if created:
+        record_trending_on_commit('subscription', community_id=instance.community_id)
+
+
+@receiver(post_save, sender=Topic)
+def topic_posted(sender, instance, created, **kwargs):
+    if created:
+        record_trending_on_commit('post', community_id=instance.community_id, topic_id=instance.id)
+
+
+@receiver(post_save, sender=TopicClick)
+def topic_viewed(sender, instance, created, **kwargs):
+    if created:
+        record_trending_on_commit('view', community_id=instance.topic.community_id, topic_id=instance.topic_id)
+
+
+@receiver(post_save, sender=TopicVote)
+def topic_voted(sender, instance, created, **kwargs):
+    if created:
+        record_trending_on_commit('vote', community_id=instance.topic.community_id, topic_id=instance.topic_id)
+
+
+@receiver(post_save, sender=Comment)
+def topic_commented(sender, instance, created, **kwargs):
+    if created:
+        record_trending_on_commit('comment', topic_id=instance.topic_id)
+
+
+@receiver(post_save, sender=CommentVote)
+def comment_voted(sender, instance, created, **kwargs):
+    if created:
+        record_trending_on_commit('vote', topic_id=instance.comment.topic_id)
@@ -1,3 +1,972 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import json
+import time
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.exceptions import ChannelFull
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, DatabaseError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from communities import redis_client, notifications
+from communities.authorization import get_authorization, get_user_authorization
+from communities.cache import TieredCache, clear_local_caches
+from communities.comment_tree import CommentTree, encode_cursor
+from communities.consumers import NotificationConsumer, NotificationFanoutConsumer
+from communities.management.commands.manage_notification_partitions import DEFAULT_PARTITION, partition_name
+from communities.notifications import notify_user, notification_target, create_topic_notifications, \
+    get_unread_count, change_unread_counts, forget_unread_count, unread_count_key, unread_notifications_page
+from communities.models import Profile, Community, Topic, Comment, Subscriber, Moderator, Ban, Notification, \
+    TopicVote, CommentVote, TopicClick, CommunityClick, wilson_lower_bound
+from communities.outbox import OutboundBuffer, DROP_OLDEST, COLLAPSE
+from communities.permissions import IsNotBannedFromCommunity
+from communities.redis_client import get_redis
+from communities.response_cache import local_object_ids
+from communities.timeline import read_timeline, fan_out_topic, timeline_key
+from communities.user_cache import local_users
+
+
+def fake_embedding(text):
+    # deterministic vectors, the similarity queries only need something to order by
+    seed = sum(map(ord, text))
+    return [((seed * (i + 1)) % 97) / 97 for i in range(384)]
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CommunityTestCase(TestCase):
+    # a user with a profile, a community and a topic of the user in it
+    def setUp(self):
+        embedding_patch = mock.patch('communities.models.generate_embedding', side_effect=fake_embedding)
+        embedding_patch.start()
+        self.addCleanup(embedding_patch.stop)
+        cache.clear()
+        local_users.clear()
+        local_object_ids.clear()
+        clear_local_caches()
+
+        self.user = self.create_user('reader')
+        self.community = Community.objects.create(name='main', description='main community',
+                                                  image='community_images/main.png')
+        self.topic = Topic.objects.create(user=self.user, community=self.community,
+                                          title='main topic', text='main topic text')
+        self.client = APIClient()
+
+    @staticmethod
+    def create_user(username):
+        user = User.objects.create_user(username=username, password='password')
+        Profile.objects.create(user=user, display_name=username, image='profile_images/profile.png')
+        return user
+
+    def login(self, user):
+        self.client.cookies['access'] = str(AccessToken.for_user(user))
+
+
+# the home timeline is left out, it is read from redis
+ENDPOINTS = [
+    '/profile/',
+    '/profile/?expand=karma',
+    '/profile/reader/',
+    '/user/',
+    '/user/{viewer_id}/',
+    '/user/{viewer_id}/profile/',
+    '/community/',
+    '/community/?expand=subscriber_count,total_view_count',
+    '/community/main/',
+    '/community/main/topics/',
+    '/topic/',
+    '/topic/?expand=comments',
+    '/topic/main-topic/',
+    '/topic/main-topic/?expand=comments',
+    '/topic/main-topic/comments/',
+    '/topic/main-topic/comments/?sort=best&depth=3',
+    '/comment/',
+    '/comment/{comment_id}/',
+    '/notification/',
+    '/ban/',
+    '/subscriber/',
+    '/subscriptions/',
+    '/my_profile/',
+    '/search/?q=topic',
+    '/stats/hot_topics/',
+    '/stats/recommendations/',
+    '/stats/most_viewed_communities/',
+    '/stats/most_viewed_communities/?time=24',
+    '/stats/most_subscribed_communities/',
+    '/stats/most_subscribed_communities/?time=24',
+    '/stats/most_karma_profiles/',
+    '/stats/most_karma_profiles/?time=24',
+    '/stats/activity_of_website/',
+    '/stats/activity_of_website/?time=24',
+]
+
+
+class QueryCountTests(CommunityTestCase):
+    # every endpoint is requested with a small and a bigger data set,
+    # the number of queries must not grow with the data
+    small_size = 2
+    large_size = 6
+
+    def setUp(self):
+        super().setUp()
+        self.viewer = self.user
+        Subscriber.objects.create(user=self.viewer, community=self.community)
+        self.comment = Comment.objects.create(topic=self.topic, user=self.viewer, text='main comment')
+        self.seeded = 0
+        self.login(self.viewer)
+
+    def seed(self, size):
+        # every seeded user adds rows under the main community, topic and
+        # comment and to the lists of the viewer
+        while self.seeded < size:
+            index = self.seeded
+            self.seeded += 1
+            user = self.create_user(f'user{index}')
+            Subscriber.objects.create(user=user, community=self.community)
+            community = Community.objects.create(name=f'community {index}', description='seeded community',
+                                                 image='community_images/seeded.png')
+            Subscriber.objects.create(user=self.viewer, community=community)
+            Moderator.objects.create(user=user, community=community)
+            Ban.objects.create(user=self.viewer, community=community)
+
+            topic = Topic.objects.create(user=user, community=self.community,
+                                         title=f'seeded topic {index}', text='seeded topic text')
+            comment = Comment.objects.create(topic=self.topic, user=user, text=f'comment {index}')
+            reply = Comment.objects.create(topic=self.topic, user=self.viewer, text=f'reply {index}',
+                                           upper_comment=comment)
+            Comment.objects.create(topic=self.topic, user=user, text=f'reply to reply {index}', upper_comment=reply)
+            Comment.objects.create(topic=topic, user=user, text=f'seeded topic comment {index}')
+            Comment.objects.create(topic=self.topic, user=user, text=f'main reply {index}',
+                                   upper_comment=self.comment)
+
+            TopicVote.objects.create(user=user, topic=self.topic, value=1)
+            TopicVote.objects.create(user=self.viewer, topic=topic, value=1)
+            CommentVote.objects.create(user=self.viewer, comment=comment, value=1)
+            CommentVote.objects.create(user=user, comment=self.comment, value=-1)
+            TopicClick.objects.create(user=user, topic=self.topic)
+            TopicClick.objects.create(user=self.viewer, topic=topic)
+            CommunityClick.objects.create(user=user, community=self.community)
+
+            Notification.objects.create(user=self.viewer, information=f'notification {index}',
+                                        kind=Notification.Kind.NEW_POST, target=f'community:{community.id}')
+
+    def count_queries(self, url):
+        # the first request creates the click rows of retrieve views, the
+        # second one is measured with empty caches
+        self.client.get(url)
+        cache.clear()
+        local_users.clear()
+        local_object_ids.clear()
+        clear_local_caches()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, f'{url}: {response.content[:200]}')
+        return len(queries)
+
+    def test_query_counts_do_not_grow_with_data(self):
+        urls = [url.format(viewer_id=self.viewer.id, comment_id=self.comment.id) for url in ENDPOINTS]
+
+        self.seed(self.small_size)
+        small = {url: self.count_queries(url) for url in urls}
+        self.seed(self.large_size)
+        large = {url: self.count_queries(url) for url in urls}
+
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertEqual(small[url], large[url])
+
+    @override_settings(QUERY_BUDGET_HEADERS=True)
+    def test_query_budget_headers(self):
+        self.seed(self.small_size)
+        response = self.client.get('/topic/main-topic/')
+        self.assertGreater(int(response['X-Query-Count']), 0)
+        self.assertIn('X-Query-Time', response)
+        self.assertIn('X-Query-Duplicates', response)
+
+
+class ResponseCacheTests(CommunityTestCase):
+    def test_unchanged_topic_is_not_modified(self):
+        response = self.client.get('/topic/main-topic/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Last-Modified', response)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/topic/main-topic/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries), 0)
+
+    def test_new_comment_changes_the_topic_version(self):
+        etag = self.client.get('/topic/main-topic/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(topic=self.topic, user=self.user, text='new comment')
+
+        response = self.client.get('/topic/main-topic/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.data['comments']), 1)
+
+    def test_topic_click_changes_the_community_version(self):
+        etag = self.client.get('/community/main/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            TopicClick.objects.create(user=self.user, topic=self.topic)
+
+        response = self.client.get('/community/main/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_query_string_is_part_of_the_key(self):
+        full = self.client.get('/community/main/')
+        selected = self.client.get('/community/main/?fields=name')
+        self.assertNotEqual(full['ETag'], selected['ETag'])
+        self.assertEqual(set(selected.data), {'name'})
+
+
+class ObjectCacheTests(CommunityTestCase):
+    def test_profile_card_is_served_from_the_cache(self):
+        self.client.get('/profile/reader/')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/profile/reader/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 0)
+
+    def test_changed_profile_is_invalidated(self):
+        self.client.get(f'/user/{self.user.id}/profile/')
+        with self.captureOnCommitCallbacks(execute=True):
+            profile = self.user.profile
+            profile.display_name = 'renamed'
+            profile.save()
+
+        response = self.client.get(f'/user/{self.user.id}/profile/')
+        self.assertEqual(response.data['profile']['display_name'], 'renamed')
+
+    def test_unknown_profile_is_not_found(self):
+        self.assertEqual(self.client.get('/profile/nobody/').status_code, 404)
+        self.assertEqual(self.client.get('/user/0/profile/').status_code, 404)
+        self.assertEqual(self.client.get('/user/\u00b2/profile/').status_code, 404)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TieredCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_value_is_computed_once(self):
+        tiered = TieredCache('computed_once', ttl=60)
+        compute = mock.Mock(return_value='value')
+        self.assertEqual(tiered.get('key', compute), 'value')
+        self.assertEqual(tiered.get('key', compute), 'value')
+        compute.assert_called_once()
+
+    def test_last_good_value_is_served_when_recomputing_fails(self):
+        tiered = TieredCache('fallback', ttl=60, fallback_ttl=60)
+        tiered.get('key', lambda: 'good')
+        with mock.patch('time.time', return_value=time.time() + 90):
+            value = tiered.get('key', mock.Mock(side_effect=DatabaseError))
+        self.assertEqual(value, 'good')
+
+    def test_stale_values_of_get_many_are_refreshed_in_the_background(self):
+        tiered = TieredCache('stale_many', ttl=60, stale_ttl=60)
+        tiered.get_many(['a', 'b'], lambda keys: {key: 'old' for key in keys})
+        compute_many = mock.Mock(side_effect=lambda keys: {key: 'new' for key in keys})
+        with mock.patch('time.time', return_value=time.time() + 90), \
+                mock.patch('communities.cache.threading.Thread') as thread:
+            self.assertEqual(tiered.get_many(['a', 'b'], compute_many), {'a': 'old', 'b': 'old'})
+        compute_many.assert_not_called()
+
+        thread.call_args.kwargs['target']()
+        compute_many.assert_called_once_with(['a', 'b'])
+        self.assertEqual(tiered.get_many(['a', 'b'], compute_many), {'a': 'new', 'b': 'new'})
+
+
+class RedisTestMixin:
+    # redis backed features run against their own redis database, it is
+    # emptied before every test
+    redis_test_database = 15
+
+    def setUp(self):
+        redis_settings = override_settings(
+            REDIS_URL=f'redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/{self.redis_test_database}'
+        )
+        redis_settings.enable()
+        self.addCleanup(redis_settings.disable)
+        redis_client._client = None
+        self.addCleanup(setattr, redis_client, '_client', None)
+        self.redis = get_redis()
+        self.redis.flushdb()
+        super().setUp()
+
+
+class CommentTreeTests(CommunityTestCase):
+    def test_tree_is_loaded_with_one_query(self):
+        first = Comment.objects.create(topic=self.topic, user=self.user, text='first')
+        second = Comment.objects.create(topic=self.topic, user=self.user, text='second')
+        reply = Comment.objects.create(topic=self.topic, user=self.user, text='reply', upper_comment=first)
+        nested = Comment.objects.create(topic=self.topic, user=self.user, text='nested', upper_comment=reply)
+
+        with self.assertNumQueries(1):
+            tree = CommentTree([self.topic])
+            self.assertEqual(tree.comments_of(self.topic), [first, second])
+            self.assertEqual(tree.replies_of(first), [reply])
+            self.assertEqual(tree.replies_of(reply), [nested])
+            self.assertEqual(tree.replies_of(second), [])
+
+    def test_expanded_topic_nests_the_replies(self):
+        comment = Comment.objects.create(topic=self.topic, user=self.user, text='comment')
+        Comment.objects.create(topic=self.topic, user=self.user, text='reply', upper_comment=comment)
+
+        response = self.client.get('/topic/?expand=comments')
+        comments = response.data['results'][0]['comments']
+        self.assertEqual([c['text'] for c in comments], ['comment'])
+        self.assertEqual([r['text'] for r in comments[0]['replies']], ['reply'])
+
+
+class CommentPathTests(CommunityTestCase):
+    def test_path_and_depth_follow_the_parent(self):
+        comment = Comment.objects.create(topic=self.topic, user=self.user, text='comment')
+        reply = Comment.objects.create(topic=self.topic, user=self.user, text='reply', upper_comment=comment)
+        self.assertEqual(reply.depth, 1)
+        self.assertEqual(reply.path, Comment.path_segment(comment.id) + Comment.path_segment(reply.id))
+
+    def test_thread_loads_a_limited_subtree(self):
+        comment = Comment.objects.create(topic=self.topic, user=self.user, text='comment')
+        reply = Comment.objects.create(topic=self.topic, user=self.user, text='reply', upper_comment=comment)
+        Comment.objects.create(topic=self.topic, user=self.user, text='nested', upper_comment=reply)
+
+        response = self.client.get('/topic/main-topic/comments/?depth=2')
+        self.assertEqual(response.status_code, 200)
+        result = response.data['results'][0]
+        self.assertEqual([r['text'] for r in result['replies']], ['reply'])
+        self.assertEqual(result['replies'][0]['replies'], [])
+        self.assertIn(f'parent={reply.id}', result['replies'][0]['more_replies']['url'])
+
+    def test_invalid_parent_is_not_found(self):
+        for parent in ['0', 'abc', '\u00b2']:
+            with self.subTest(parent=parent):
+                response = self.client.get('/topic/main-topic/comments/', {'parent': parent})
+                self.assertEqual(response.status_code, 404)
+
+    def test_too_deep_reply_is_rejected(self):
+        parent = Comment.objects.create(topic=self.topic, user=self.user, text='deep')
+        Comment.objects.filter(id=parent.id).update(depth=Comment.MAX_DEPTH)
+        self.login(self.user)
+        response = self.client.post('/comment/', {
+            'topic': f'http://testserver/topic/{self.topic.slug}/',
+            'text': 'too deep',
+            'upper_comment': parent.id,
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('upper_comment', response.data)
+
+
+    def test_reply_to_another_topic_is_rejected(self):
+        other_topic = Topic.objects.create(user=self.user, community=self.community, title='other', text='other')
+        parent = Comment.objects.create(topic=other_topic, user=self.user, text='elsewhere')
+        self.login(self.user)
+        response = self.client.post('/comment/', {
+            'topic': f'http://testserver/topic/{self.topic.slug}/',
+            'text': 'misplaced',
+            'upper_comment': parent.id,
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('upper_comment', response.data)
+
+    def test_posted_comment_cannot_be_moved(self):
+        Moderator.objects.create(user=self.user, community=self.community)
+        comment = Comment.objects.create(topic=self.topic, user=self.user, text='comment')
+        reply = Comment.objects.create(topic=self.topic, user=self.user, text='reply')
+        self.login(self.user)
+        response = self.client.patch(f'/comment/{reply.id}/', {'upper_comment': comment.id}, format='json')
+        self.assertEqual(response.status_code, 400)
+        reply.refresh_from_db()
+        self.assertIsNone(reply.upper_comment)
+        self.assertEqual(reply.path, Comment.path_segment(reply.id))
+
+
+class CommentRankingTests(CommunityTestCase):
+    def vote(self, comment, values):
+        for index, value in enumerate(values):
+            voter = self.create_user(f'voter{comment.id}x{index}')
+            CommentVote.objects.create(user=voter, comment=comment, value=value)
+        comment.refresh_from_db()
+
+    def test_votes_update_the_stored_rankings(self):
+        comment = Comment.objects.create(topic=self.topic, user=self.user, text='comment')
+        self.vote(comment, [1, 1, -1])
+        self.assertEqual((comment.up_votes, comment.down_votes, comment.score), (2, 1, 1))
+        self.assertAlmostEqual(comment.best_score, wilson_lower_bound(2, 1))
+
+        CommentVote.objects.filter(comment=comment, value=-1).delete()
+        comment.refresh_from_db()
+        self.assertEqual((comment.down_votes, comment.score), (0, 2))
+
+    def test_wilson_lower_bound_prefers_more_evidence(self):
+        self.assertEqual(wilson_lower_bound(0, 0), 0)
+        self.assertGreater(wilson_lower_bound(90, 10), wilson_lower_bound(9, 1))
+        self.assertLess(wilson_lower_bound(9, 1), 0.9)
+
+    def test_best_sort_pages_with_a_cursor(self):
+        sure = Comment.objects.create(topic=self.topic, user=self.user, text='sure')
+        lucky = Comment.objects.create(topic=self.topic, user=self.user, text='lucky')
+        Comment.objects.create(topic=self.topic, user=self.user, text='unvoted')
+        self.vote(sure, [1] * 5)
+        self.vote(lucky, [1])
+
+        response = self.client.get('/topic/main-topic/comments/?sort=best&limit=1')
+        self.assertEqual([c['text'] for c in response.data['results']], ['sure'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([c['text'] for c in response.data['results']], ['lucky'])
+
+    def test_malformed_cursor_is_rejected(self):
+        for sort, position in [('best', ['x', 1]), ('top', [1.5, 1]), ('old', [None]), ('new', [1, 2])]:
+            with self.subTest(sort=sort, position=position):
+                response = self.client.get(
+                    f'/topic/main-topic/comments/?sort={sort}&cursor={encode_cursor(position)}'
+                )
+                self.assertEqual(response.status_code, 400)
+
+
+class DynamicFieldsTests(CommunityTestCase):
+    def test_fields_selects_the_fields(self):
+        response = self.client.get('/topic/?fields=title,slug')
+        self.assertEqual(set(response.data['results'][0]), {'title', 'slug'})
+
+    def test_expandable_fields_are_left_out_of_lists(self):
+        Subscriber.objects.create(user=self.user, community=self.community)
+        response = self.client.get('/community/')
+        self.assertNotIn('subscriber_count', response.data[0])
+
+        response = self.client.get('/community/?expand=subscriber_count')
+        self.assertEqual(response.data[0]['subscriber_count'], 1)
+
+    def test_details_keep_the_expandable_fields(self):
+        response = self.client.get('/community/main/')
+        self.assertIn('subscriber_count', response.data)
+
+
+class KeysetPaginationTests(CommunityTestCase):
+    def create_topics(self, count):
+        # every topic gets the same created date, only the id breaks the ties
+        for index in range(count):
+            Topic.objects.create(user=self.user, community=self.community, title=f'tied {index}', text='tied')
+        Topic.objects.update(created_date=self.topic.created_date)
+
+    def read_pages(self, url):
+        titles = []
+        while url is not None:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            titles.extend(topic['title'] for topic in response.data['results'])
+            url = response.data['next']
+        return titles
+
+    def test_ties_are_paged_without_repeats_or_gaps(self):
+        self.create_topics(6)
+        titles = self.read_pages('/topic/?page_size=2&fields=title')
+        expected = list(Topic.objects.order_by('-created_date', '-id').values_list('title', flat=True))
+        self.assertEqual(titles, expected)
+
+    def test_previous_link_returns_the_page_before(self):
+        self.create_topics(4)
+        first = self.client.get('/topic/?page_size=2&fields=title')
+        second = self.client.get(first.data['next'])
+        previous = self.client.get(second.data['previous'])
+        self.assertEqual(previous.data['results'], first.data['results'])
+
+    def test_malformed_cursor_is_not_found(self):
+        response = self.client.get(f'/topic/?cursor={encode_cursor({"p": ["x", 1], "r": False})}')
+        self.assertEqual(response.status_code, 404)
+
+    def test_hot_topics_are_paged_by_the_stored_score(self):
+        self.create_topics(4)
+        hot = Topic.objects.get(title='tied 2')
+        TopicVote.objects.create(user=self.user, topic=hot, value=1)
+        hot.refresh_from_db()
+        self.assertEqual(hot.hot_score, 5)
+
+        titles = self.read_pages('/stats/hot_topics/?page_size=2')
+        self.assertEqual(titles[0], 'tied 2')
+        self.assertEqual(sorted(titles), sorted(Topic.objects.values_list('title', flat=True)))
+
+    def test_hot_score_moves_by_each_change(self):
+        voter = self.create_user('voter')
+        TopicClick.objects.create(user=voter, topic=self.topic)
+        TopicVote.objects.update_or_create(user=voter, topic=self.topic, defaults={'value': -1})
+        self.topic.refresh_from_db()
+        self.assertEqual(self.topic.hot_score, 1 - 5)
+
+        TopicVote.objects.update_or_create(user=voter, topic=self.topic, defaults={'value': 1})
+        self.topic.refresh_from_db()
+        self.assertEqual(self.topic.hot_score, 1 + 5)
+
+        TopicVote.objects.filter(user=voter).delete()
+        TopicClick.objects.filter(user=voter).delete()
+        self.topic.refresh_from_db()
+        self.assertEqual(self.topic.hot_score, 0)
+
+
+class HomeTimelineTests(RedisTestMixin, CommunityTestCase):
+    def setUp(self):
+        super().setUp()
+        Subscriber.objects.create(user=self.user, community=self.community)
+
+    def create_topic(self, title):
+        return Topic.objects.create(user=self.user, community=self.community, title=title, text=title)
+
+    def timeline_ids(self, **kwargs):
+        return [topic_id for topic_id, _ in read_timeline(self.user, **kwargs)]
+
+    def test_missing_timeline_is_rebuilt_from_the_database(self):
+        self.assertEqual(self.timeline_ids(), [self.topic.id])
+        self.assertTrue(self.redis.exists(timeline_key(self.user.id)))
+
+    def test_new_topic_is_fanned_out_to_existing_timelines(self):
+        self.timeline_ids()
+        topic = self.create_topic('new topic')
+        fan_out_topic(topic)
+        self.assertEqual(self.timeline_ids(), [topic.id, self.topic.id])
+
+    @override_settings(HOME_TIMELINE_FANOUT_LIMIT=0)
+    def test_topics_of_large_communities_are_merged_while_reading(self):
+        self.timeline_ids()
+        topic = self.create_topic('new topic')
+        fan_out_topic(topic)
+        self.assertIsNone(self.redis.zscore(timeline_key(self.user.id), topic.id))
+        self.assertEqual(self.timeline_ids(), [topic.id, self.topic.id])
+
+    def test_timeline_pages_with_a_cursor(self):
+        topic = self.create_topic('new topic')
+        self.login(self.user)
+        first = self.client.get('/timeline/?limit=1')
+        self.assertEqual([t['title'] for t in first.data['results']], [topic.title])
+        second = self.client.get(first.data['next'])
+        self.assertEqual([t['title'] for t in second.data['results']], [self.topic.title])
+
+    def test_topics_with_the_same_score_are_not_skipped(self):
+        for index in range(4):
+            self.create_topic(f'tied {index}')
+        Topic.objects.update(created_date=self.topic.created_date)
+        # the rebuilt timeline has five topics with one score
+        self.redis.delete(timeline_key(self.user.id))
+        pages = []
+        before = None
+        while True:
+            page = read_timeline(self.user, before=before, limit=2)
+            if not page:
+                break
+            pages.extend(topic_id for topic_id, _ in page)
+            before = (page[-1][1], page[-1][0])
+        self.assertEqual(pages, list(Topic.objects.order_by('-id').values_list('id', flat=True)))
+
+    def test_unsubscribing_through_the_subscriber_api_forgets_the_timeline(self):
+        self.timeline_ids()
+        subscriber = Subscriber.objects.get(user=self.user)
+        self.login(self.user)
+        with mock.patch('communities.signals.notify_subscription_changed') as notify, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/subscriber/{subscriber.id}/')
+        self.assertFalse(self.redis.exists(timeline_key(self.user.id)))
+        notify.assert_called_once_with(self.user.id, self.community.id, subscribed=False)
+
+
+class TopicFanOutTests(CommunityTestCase):
+    def create_topic(self):
+        self.login(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/topic/', {
+                'title': 'new topic',
+                'text': 'new topic text',
+                'community': 'http://testserver/community/main/',
+            })
+
+    def test_new_topic_is_handed_to_the_worker(self):
+        layer = mock.Mock(send=mock.AsyncMock())
+        with mock.patch('communities.notifications.get_channel_layer', return_value=layer):
+            response = self.create_topic()
+        self.assertEqual(response.status_code, 201)
+        channel, message = layer.send.call_args.args
+        self.assertEqual(channel, 'notification-fanout')
+        self.assertEqual(message['topic_id'], Topic.objects.get(title='new topic').id)
+
+    def test_full_channel_does_not_fail_the_saved_topic(self):
+        layer = mock.Mock(send=mock.AsyncMock(side_effect=ChannelFull))
+        with mock.patch('communities.notifications.get_channel_layer', return_value=layer), \
+                self.assertLogs('communities.notifications', 'ERROR'):
+            response = self.create_topic()
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(Topic.objects.filter(title='new topic').exists())
+
+
+class NotificationTestCase(RedisTestMixin, CommunityTestCase):
+    # channel layer calls are recorded instead of sent
+    def setUp(self):
+        super().setUp()
+        self.layer = mock.Mock(send=mock.AsyncMock(), group_send=mock.AsyncMock(),
+                               group_add=mock.AsyncMock(), group_discard=mock.AsyncMock())
+        layer_patch = mock.patch('communities.notifications.get_channel_layer', return_value=self.layer)
+        layer_patch.start()
+        self.addCleanup(layer_patch.stop)
+        # the worker runs in the test transaction, its connection must stay open
+        connections_patch = mock.patch('channels.db.close_old_connections')
+        connections_patch.start()
+        self.addCleanup(connections_patch.stop)
+
+    def create_subscriber(self, username):
+        user = self.create_user(username)
+        Subscriber.objects.create(user=user, community=self.community)
+        return user
+
+
+class CommunityBroadcastTests(NotificationTestCase):
+    def test_subscribing_moves_the_sockets_of_the_user(self):
+        self.login(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/community/main/subscribe/')
+        self.layer.group_send.assert_called_once_with(f'user_{self.user.id}', {
+            'type': 'subscription.changed',
+            'community_id': self.community.id,
+            'subscribed': True,
+        })
+
+    def test_socket_joins_and_leaves_community_groups(self):
+        consumer = NotificationConsumer()
+        consumer.channel_layer = self.layer
+        consumer.channel_name = 'socket'
+        consumer.digest = False
+        consumer.community_ids = set()
+        async_to_sync(consumer.subscription_changed)({'community_id': 3, 'subscribed': True})
+        self.layer.group_add.assert_called_once_with('community_3', 'socket')
+        async_to_sync(consumer.subscription_changed)({'community_id': 3, 'subscribed': False})
+        self.layer.group_discard.assert_called_once_with('community_3', 'socket')
+        self.assertEqual(consumer.community_ids, set())
+
+    def test_new_topic_is_sent_once_to_the_community_group(self):
+        subscribers = [self.create_subscriber(f'subscriber{index}') for index in range(3)]
+        consumer = NotificationFanoutConsumer()
+        consumer.channel_layer = self.layer
+        async_to_sync(consumer.topic_created)({'topic_id': self.topic.id, 'url': 'url'})
+
+        self.layer.group_send.assert_called_once()
+        group, event = self.layer.group_send.call_args.args
+        self.assertEqual(group, f'community_{self.community.id}')
+        self.assertEqual(event['notification']['target'], f'community:{self.community.id}')
+        self.assertEqual(sorted(Notification.objects.values_list('user_id', flat=True)),
+                         sorted(user.id for user in subscribers))
+
+
+class NotificationCoalescingTests(NotificationTestCase):
+    def notify(self, kind=Notification.Kind.COMMENT):
+        return notify_user(self.user.id, kind, notification_target(self.topic), 'url')
+
+    def test_repeated_notifications_are_merged(self):
+        self.notify()
+        notification = self.notify()
+        self.assertEqual(Notification.objects.count(), 1)
+        self.assertEqual(notification.count, 2)
+        self.assertEqual(notification.information, '2 new comments on your post!')
+
+    def test_notifications_outside_the_window_are_not_merged(self):
+        first = self.notify()
+        Notification.objects.filter(id=first.id).update(
+            updated_date=timezone.now() - settings.NOTIFICATION_COALESCE_WINDOW * 2
+        )
+        self.notify()
+        self.assertEqual(Notification.objects.count(), 2)
+
+    def test_read_notifications_are_not_merged(self):
+        first = self.notify()
+        Notification.objects.filter(id=first.id).update(is_read=True)
+        self.notify()
+        self.assertEqual(Notification.objects.count(), 2)
+
+    def test_bans_are_never_merged(self):
+        self.notify(Notification.Kind.BAN)
+        self.notify(Notification.Kind.BAN)
+        self.assertEqual(Notification.objects.count(), 2)
+
+    def test_fan_out_merges_new_posts_of_the_community(self):
+        subscriber = self.create_subscriber('subscriber')
+        create_topic_notifications(self.topic, 'first')
+        create_topic_notifications(self.topic, 'second')
+        notification = Notification.objects.get(user=subscriber)
+        self.assertEqual(notification.count, 2)
+        self.assertEqual(notification.information, '2 New Posts on main')
+        self.assertEqual(notification.direct_url, 'second')
+
+    def test_broadcast_text_matches_the_merged_row(self):
+        subscriber = self.create_subscriber('subscriber')
+        consumer = NotificationFanoutConsumer()
+        consumer.channel_layer = self.layer
+        for _ in range(2):
+            async_to_sync(consumer.topic_created)({'topic_id': self.topic.id, 'url': 'url'})
+        notification = self.layer.group_send.call_args.args[1]['notification']
+        row = Notification.objects.get(user=subscriber)
+        self.assertEqual(notification['information'], 'New Post on main')
+        self.assertEqual(f'{row.count}{notification["merged_information"]}', row.information)
+
+    def test_digest_users_get_a_summary_instead(self):
+        subscriber = self.create_subscriber('subscriber')
+        Profile.objects.filter(user=subscriber).update(notification_digest=True)
+        create_topic_notifications(self.topic, 'url')
+        self.assertFalse(Notification.objects.filter(user=subscriber).exists())
+
+        call_command('send_notification_digests', stdout=mock.Mock())
+        digest = Notification.objects.get(user=subscriber)
+        self.assertEqual(digest.kind, Notification.Kind.DIGEST)
+        self.assertEqual(digest.information, '1 new posts in 1 of your communities')
+        self.assertIsNotNone(Profile.objects.get(user=subscriber).last_digest_date)
+
+
+class UnreadCountTests(NotificationTestCase):
+    def create_notification(self, **kwargs):
+        return Notification.objects.create(user=self.user, kind=Notification.Kind.BAN, target='ban:1',
+                                           information='banned', direct_url='url', **kwargs)
+
+    def test_missing_count_is_counted_and_cached(self):
+        self.create_notification()
+        self.create_notification(is_read=True)
+        self.assertEqual(get_unread_count(self.user.id), 1)
+        self.assertEqual(int(self.redis.get(unread_count_key(self.user.id))), 1)
+
+    def test_changes_apply_to_cached_counts_only(self):
+        change_unread_counts({self.user.id: 1})
+        self.assertIsNone(self.redis.get(unread_count_key(self.user.id)))
+        self.assertEqual(get_unread_count(self.user.id), 0)
+        change_unread_counts({self.user.id: 2})
+        self.assertEqual(get_unread_count(self.user.id), 2)
+        change_unread_counts({self.user.id: -5})
+        self.assertEqual(get_unread_count(self.user.id), 0)
+
+    def test_change_while_counting_is_not_lost(self):
+        count_unread = notifications.count_unread
+
+        def count_then_notify(user_id):
+            count = count_unread(user_id)
+            self.create_notification()
+            change_unread_counts({user_id: 1})
+            return count
+
+        with mock.patch('communities.notifications.count_unread', side_effect=count_then_notify):
+            self.assertEqual(get_unread_count(self.user.id), 0)
+        self.assertIsNone(self.redis.get(unread_count_key(self.user.id)))
+        self.assertEqual(get_unread_count(self.user.id), 1)
+
+    def test_forgotten_count_is_counted_again(self):
+        get_unread_count(self.user.id)
+        self.create_notification()
+        forget_unread_count(self.user.id)
+        self.assertEqual(get_unread_count(self.user.id), 1)
+
+    def test_page_request_that_is_not_an_object_is_an_error(self):
+        consumer = NotificationConsumer()
+        consumer.scope = {'user': self.user}
+        consumer.send = mock.AsyncMock()
+        async_to_sync(consumer.receive)(json.dumps({'type': 'unread_notifications', 'payload': ['cursor']}))
+        self.assertEqual(json.loads(consumer.send.call_args.kwargs['text_data'])['type'], 'error')
+
+    def test_broadcasts_are_sent_without_a_count(self):
+        consumer = NotificationConsumer()
+        consumer.scope = {'user': self.user}
+        consumer.outbox = mock.Mock()
+        consumer.send = mock.AsyncMock()
+        self.create_notification()
+        async_to_sync(consumer.notify)({'notification': {'id': 1}})
+        async_to_sync(consumer.notify)({'notification': {'id': None}, 'broadcast': True})
+        messages = [push.args[0] for push in consumer.outbox.push.call_args_list]
+
+        async_to_sync(consumer.send_notifications)(messages)
+        own, broadcast = json.loads(consumer.send.call_args.kwargs['text_data'])
+        self.assertEqual(own['unread_count'], 1)
+        self.assertNotIn('unread_count', broadcast)
+
+        with mock.patch('communities.consumers.get_unread_count') as get_count:
+            async_to_sync(consumer.send_notifications)([broadcast])
+        get_count.assert_not_called()
+
+    def test_unread_pages_follow_the_cursor(self):
+        created = [self.create_notification() for _ in range(3)]
+        first, cursor = unread_notifications_page(self.user, limit=2)
+        second, last_cursor = unread_notifications_page(self.user, cursor, limit=2)
+        self.assertEqual([n.id for n in first + second], [n.id for n in reversed(created)])
+        self.assertIsNone(last_cursor)
+
+
+class MarkReadTests(NotificationTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = self.create_user('other')
+        self.notifications = [self.create_notification(self.user, f'topic:{index}') for index in range(3)]
+        self.create_notification(self.other, 'topic:0')
+        self.login(self.user)
+
+    def create_notification(self, user, target):
+        return Notification.objects.create(user=user, kind=Notification.Kind.COMMENT, target=target,
+                                           information='comment', direct_url='url')
+
+    def mark_read(self, data):
+        return self.client.post('/notification/mark_read/', data, format='json')
+
+    def unread_ids(self, user):
+        return set(Notification.objects.filter(user=user, is_read=False).values_list('id', flat=True))
+
+    def test_marks_the_given_ids(self):
+        get_unread_count(self.user.id)
+        response = self.mark_read({'ids': [self.notifications[0].id, self.notifications[1].id]})
+        self.assertEqual(response.data, {'marked': 2, 'unread_count': 1})
+        self.assertEqual(self.unread_ids(self.user), {self.notifications[2].id})
+
+    def test_marks_up_to_a_watermark(self):
+        response = self.mark_read({'up_to_id': self.notifications[1].id})
+        self.assertEqual(response.data['marked'], 2)
+        self.assertEqual(self.unread_ids(self.user), {self.notifications[2].id})
+
+    def test_marks_a_broadcast_by_its_target(self):
+        response = self.mark_read({'kind': Notification.Kind.COMMENT, 'target': 'topic:0'})
+        self.assertEqual(response.data['marked'], 1)
+        self.assertEqual(len(self.unread_ids(self.other)), 1)
+
+    def test_never_marks_other_users(self):
+        self.mark_read({'up_to_id': Notification.objects.latest('id').id})
+        self.assertEqual(self.unread_ids(self.user), set())
+        self.assertEqual(len(self.unread_ids(self.other)), 1)
+
+    def test_rejects_requests_without_filters(self):
+        self.assertEqual(self.mark_read({}).status_code, 400)
+        self.assertEqual(self.mark_read({'ids': 'all'}).status_code, 400)
+        self.assertEqual(self.mark_read([self.notifications[0].id]).status_code, 400)
+        self.assertEqual(len(self.unread_ids(self.user)), 3)
+
+
+    def test_socket_rejects_payloads_that_are_not_objects(self):
+        consumer = NotificationConsumer()
+        consumer.scope = {'user': self.user}
+        consumer.send = mock.AsyncMock()
+        for payload in ['all', [self.notifications[0].id]]:
+            with self.subTest(payload=payload):
+                async_to_sync(consumer.receive)(json.dumps({'type': 'read_notification', 'payload': payload}))
+                self.assertEqual(json.loads(consumer.send.call_args.kwargs['text_data'])['type'], 'error')
+        self.assertEqual(len(self.unread_ids(self.user)), 3)
+
+
+class OutboundBufferTests(SimpleTestCase):
+    def setUp(self):
+        self.frames = []
+
+    async def send_frame(self, messages):
+        self.frames.append(messages)
+
+    async def push_all(self, buffer, messages):
+        for message in messages:
+            buffer.push(message)
+        await buffer.flush_task
+
+    async def test_messages_arriving_together_are_one_frame(self):
+        buffer = OutboundBuffer(self.send_frame, delay=0)
+        await self.push_all(buffer, [1, 2, 3])
+        self.assertEqual(self.frames, [[1, 2, 3]])
+        self.assertEqual(buffer.metrics['frames'], 1)
+
+    async def test_drop_policy_keeps_the_newest_messages(self):
+        buffer = OutboundBuffer(self.send_frame, delay=0, max_size=2, policy=DROP_OLDEST)
+        await self.push_all(buffer, [1, 2, 3, 4])
+        self.assertEqual(self.frames, [[3, 4]])
+        self.assertEqual(buffer.metrics['dropped'], 2)
+
+    async def test_collapse_policy_sends_the_count_of_waiting_messages(self):
+        buffer = OutboundBuffer(self.send_frame, delay=0, max_size=2, policy=COLLAPSE)
+        await self.push_all(buffer, [1, 2, 3])
+        self.assertEqual(self.frames, [[{'type': 'notifications_collapsed', 'payload': {'count': 2}}, 3]])
+
+    async def test_closing_cancels_the_waiting_frame(self):
+        buffer = OutboundBuffer(self.send_frame, delay=60)
+        buffer.push(1)
+        await buffer.close()
+        await asyncio.sleep(0)
+        self.assertEqual(self.frames, [])
+
+
+class NotificationPartitionTests(NotificationTestCase):
+    def rows_of(self, table):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT id FROM {connection.ops.quote_name(table)}')
+            return [notification_id for notification_id, in cursor.fetchall()]
+
+    def test_rows_past_the_last_partition_are_kept_until_their_partition_exists(self):
+        later = timezone.now() + datetime.timedelta(days=3 * 365)
+        with mock.patch('django.utils.timezone.now', return_value=later):
+            notification = Notification.objects.create(user=self.user, kind=Notification.Kind.BAN, target='ban:1',
+                                                       information='banned', direct_url='url')
+        self.assertEqual(self.rows_of(DEFAULT_PARTITION), [notification.id])
+
+        months = (later.year - timezone.now().year) * 12 + later.month - timezone.now().month
+        call_command('manage_notification_partitions', months_ahead=months, stdout=mock.Mock())
+        self.assertEqual(self.rows_of(DEFAULT_PARTITION), [])
+        self.assertEqual(self.rows_of(partition_name(later.date().replace(day=1))), [notification.id])
+        self.assertTrue(Notification.objects.filter(id=notification.id).exists())
+
+
+class AuthenticationTests(CommunityTestCase):
+    def test_deactivated_user_is_rejected_on_reads(self):
+        self.login(self.user)
+        self.assertEqual(self.client.get('/notification/').status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+
+        for url in ['/notification/', '/subscriptions/', '/timeline/']:
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url).status_code, 401)
+
+
+class AuthorizationTests(CommunityTestCase):
+    def post_topic(self, title):
+        return self.client.post('/topic/', {
+            'title': title,
+            'text': f'{title} text',
+            'community': 'http://testserver/community/main/',
+        })
+
+    def test_moderator_changes_are_seen_at_once(self):
+        self.assertFalse(get_user_authorization(self.user.id).is_moderator(self.community.id))
+        with self.captureOnCommitCallbacks(execute=True):
+            moderator = Moderator.objects.create(user=self.user, community=self.community)
+        self.assertTrue(get_user_authorization(self.user.id).is_moderator(self.community.id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            moderator.delete()
+        self.assertFalse(get_user_authorization(self.user.id).is_moderator(self.community.id))
+
+    def test_ban_rejects_the_next_topic(self):
+        self.login(self.user)
+        self.assertEqual(self.post_topic('before ban').status_code, 201)
+        with self.captureOnCommitCallbacks(execute=True):
+            ban = Ban.objects.create(user=self.user, community=self.community)
+        self.assertEqual(self.post_topic('after ban').status_code, 403)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            ban.delete()
+        self.assertEqual(self.post_topic('after unban').status_code, 201)
+
+    def test_authorization_is_memoized_on_the_request(self):
+        request = SimpleNamespace(user=self.user)
+        authorization = get_authorization(request)
+        with self.captureOnCommitCallbacks(execute=True):
+            Ban.objects.create(user=self.user, community=self.community)
+
+        with self.assertNumQueries(0):
+            self.assertIs(get_authorization(request), authorization)
+        self.assertFalse(get_authorization(request).is_banned(self.community.id))
+        self.assertTrue(get_authorization(SimpleNamespace(user=self.user)).is_banned(self.community.id))
+
+    def test_ban_check_denies_objects_without_a_community(self):
+        request = SimpleNamespace(user=self.user)
+        with self.assertLogs('communities.permissions', 'WARNING'):
+            self.assertFalse(IsNotBannedFromCommunity().has_object_permission(request, None, self.community))
@@ -0,0 +1,133 @@
+import heapq
+import itertools
+
+from django.conf import settings
+
+from communities.models import Subscriber, Topic
+from communities.redis_client import get_redis
+
+# every user has a sorted set of topic ids scored by creation time, filled
+# when topics are published (fan-out on write). topics of communities with
+# more than HOME_TIMELINE_FANOUT_LIMIT subscribers are not copied to every
+# subscriber, they are merged in from the community set while reading.
+
+LARGE_COMMUNITIES_KEY = 'timeline:large_communities'
+
+# only timelines that already exist are extended, the others are
+# rebuilt from the database when their user reads them again
+ADD_TO_EXISTING_TIMELINE = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[3]) - 1)
+end
+"""
+
+
+def timeline_key(user_id):
+    return f'timeline:user:{user_id}'
+
+
+def community_key(community_id):
+    return f'timeline:community:{community_id}'
+
+
+def topic_score(topic):
+    return topic.created_date.timestamp()
+
+
+def fan_out_topic(topic):
+    r = get_redis()
+    size = settings.HOME_TIMELINE_SIZE
+    score = topic_score(topic)
+
+    pipe = r.pipeline(transaction=False)
+    pipe.zadd(community_key(topic.community_id), {topic.id: score})
+    pipe.zremrangebyrank(community_key(topic.community_id), 0, -size - 1)
+    pipe.execute()
+
+    subscribers = Subscriber.objects.filter(community_id=topic.community_id)
+    if subscribers.count() > settings.HOME_TIMELINE_FANOUT_LIMIT:
+        r.sadd(LARGE_COMMUNITIES_KEY, topic.community_id)
+        return
+    r.srem(LARGE_COMMUNITIES_KEY, topic.community_id)
+
+    add_to_timeline = r.register_script(ADD_TO_EXISTING_TIMELINE)
+    user_ids = subscribers.values_list('user_id', flat=True).iterator(chunk_size=1000)
+    while chunk := list(itertools.islice(user_ids, 1000)):
+        pipe = r.pipeline(transaction=False)
+        for user_id in chunk:
+            add_to_timeline(keys=[timeline_key(user_id)], args=[score, topic.id, size], client=pipe)
+        pipe.execute()
+
+
+def forget_timeline(user_id):
+    # called when subscriptions change, the timeline is rebuilt on the next read
+    get_redis().delete(timeline_key(user_id))
+
+
+def rebuild_timeline(r, user):
+    size = settings.HOME_TIMELINE_SIZE
+    topics = Topic.objects.filter(
+        community__subscriber__user_id=user.id
+    ).order_by('-created_date', '-id').values_list('id', 'created_date')[:size]
+    pipe = r.pipeline()
+    pipe.delete(timeline_key(user.id))
+    # the placeholder keeps an empty timeline from being rebuilt on every read
+    pipe.zadd(timeline_key(user.id), {'0': 0, **{topic_id: created_date.timestamp() for topic_id, created_date in topics}})
+    pipe.expire(timeline_key(user.id), settings.HOME_TIMELINE_TTL)
+    pipe.execute()
+
+
+def read_source(r, key, before, limit):
+    # at most limit (topic id, score) pairs of a sorted set that come after
+    # `before` in (score, id) order, the newest first. redis orders members
+    # with the same score as strings, so the whole groups of topics sharing
+    # the score of `before` or of the last pair are read and sorted by id
+    pipe = r.pipeline(transaction=False)
+    if before is not None:
+        pipe.zrangebyscore(key, before[0], before[0], withscores=True)
+    max_score = f'({before[0]!r}' if before is not None else '+inf'
+    pipe.zrevrangebyscore(key, max_score, '(0', start=0, num=limit, withscores=True)
+    results = pipe.execute()
+    if len(results[-1]) == limit:
+        boundary = results[-1][-1][1]
+        results.append(r.zrangebyscore(key, boundary, boundary, withscores=True))
+
+    entries = {(score, int(member)) for result in results for member, score in result if score > 0}
+    if before is not None:
+        entries = {entry for entry in entries if entry < tuple(before)}
+    return [(topic_id, score) for score, topic_id in sorted(entries, reverse=True)[:limit]]
+
+
+def read_timeline(user, before=None, limit=10):
+    # returns at most limit (topic id, score) pairs after the (score, topic
+    # id) position `before`, the newest first
+    r = get_redis()
+    key = timeline_key(user.id)
+    if not r.exists(key):
+        rebuild_timeline(r, user)
+    else:
+        r.expire(key, settings.HOME_TIMELINE_TTL)
+
+    sources = [read_source(r, key, before, limit)]
+
+    large_community_ids = r.smembers(LARGE_COMMUNITIES_KEY)
+    if large_community_ids:
+        subscribed = Subscriber.objects.filter(
+            user_id=user.id, community_id__in=[int(community_id) for community_id in large_community_ids]
+        ).values_list('community_id', flat=True)
+        for community_id in subscribed:
+            sources.append(read_source(r, community_key(community_id), before, limit))
+
+    # every source is already sorted, merging k of them costs O(limit log k)
+    merged = heapq.merge(*sources, key=lambda entry: (entry[1], entry[0]), reverse=True)
+    page = []
+    seen = set()
+    for topic_id, score in merged:
+        if topic_id in seen:
+            continue
+        seen.add(topic_id)
+        page.append((topic_id, score))
+        if len(page) == limit:
+            break
+    return page
@@ -0,0 +1,70 @@
+import datetime
+import logging
+
+import redis
+from django.conf import settings
+from django.utils import timezone
+
+from communities.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# real time trending communities and topics. interactions add weighted
+# points to per minute sorted sets in redis, a read merges the buckets of
+# the last minutes with ZUNIONSTORE. the merged set is kept for a few seconds
+# so the workers do not merge the window again on every read
+
+COMMUNITIES = 'communities'
+TOPICS = 'topics'
+
+
+def bucket_key(kind, minute):
+    return f'trending:{kind}:{minute:%Y%m%d%H%M}'
+
+
+def window_key(kind, minutes, minute):
+    return f'trending_window:{kind}:{minutes}:{minute:%Y%m%d%H%M}'
+
+
+def record_trending(event, community_id=None, topic_id=None):
+    weight = settings.TRENDING_WEIGHTS[event]
+    minute = timezone.now()
+    ttl = (settings.TRENDING_MAX_WINDOW_MINUTES + 1) * 60
+    pipeline = get_redis().pipeline(transaction=False)
+    for kind, member in ((COMMUNITIES, community_id), (TOPICS, topic_id)):
+        if member is not None:
+            pipeline.zincrby(bucket_key(kind, minute), weight, member)
+            pipeline.expire(bucket_key(kind, minute), ttl)
+    try:
+        pipeline.execute()
+    except redis.RedisError:
+        # trending misses the interaction, nothing else depends on it
+        pass
+
+
+def trending(kind, size, minutes):
+    # the ids with the most points in the last `minutes` minutes, best first.
+    # without redis nothing is trending
+    try:
+        return rank_window(kind, size, minutes)
+    except redis.RedisError:
+        logger.warning('trending %s are not available', kind, exc_info=True)
+        return []
+
+
+def rank_window(kind, size, minutes):
+    now = timezone.now()
+    key = window_key(kind, minutes, now)
+    client = get_redis()
+    pipeline = client.pipeline(transaction=False)
+    pipeline.exists(key)
+    pipeline.zrevrange(key, 0, size - 1, withscores=True)
+    exists, ranked = pipeline.execute()
+    if not exists:
+        buckets = [bucket_key(kind, now - datetime.timedelta(minutes=offset)) for offset in range(minutes)]
+        pipeline = client.pipeline(transaction=False)
+        pipeline.zunionstore(key, buckets)
+        pipeline.expire(key, settings.TRENDING_MERGE_TTL)
+        pipeline.zrevrange(key, 0, size - 1, withscores=True)
+        ranked = pipeline.execute()[-1]
+    return [(int(member), score) for member, score in ranked]
@@ -0,0 +1,46 @@
+import copy
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+from communities.cache import LocalCache
+
+# users resolved from access tokens are cached in the worker for a few
+# seconds and in redis under a per user version, changing a user bumps the
+# version so every worker misses the old entry
+
+local_users = LocalCache(max_size=settings.USER_CACHE_LOCAL_SIZE, ttl=settings.USER_CACHE_LOCAL_TTL)
+
+
+def user_version_key(user_id):
+    return f'auth_user_version:{user_id}'
+
+
+def user_key(user_id, version):
+    return f'auth_user:{user_id}:{version}'
+
+
+def get_cached_user(user_id):
+    # raises User.DoesNotExist, every caller gets its own copy of the
+    # shared instance since requests may change it
+    user = local_users.get(user_id)
+    if user is not None:
+        return copy.copy(user)
+
+    key = user_key(user_id, cache.get(user_version_key(user_id), 0))
+    user = cache.get(key)
+    if user is None:
+        user = User.objects.get(id=user_id)
+        cache.set(key, user, settings.USER_CACHE_TTL)
+    local_users.set(user_id, user)
+    return copy.copy(user)
+
+
+def forget_cached_user(user_id):
+    local_users.delete(user_id)
+    try:
+        cache.incr(user_version_key(user_id))
+    except ValueError:
+        # readers without a version use 0
+        cache.set(user_version_key(user_id), 1, None)
@@ -1,31 +1,48 @@
 import datetime
+import math
 
-from asgiref.sync import async_to_sync
+from django.conf import settings
 from django.contrib.auth import authenticate
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
 from django.db.models import Q, Count, ExpressionWrapper, F
 from django.db.models.fields import IntegerField
+from django.http import HttpResponse, Http404
 from django.utils import timezone
+from django.utils.crypto import constant_time_compare
 from rest_framework import permissions, views, status, viewsets
 from rest_framework.decorators import action
 from rest_framework.exceptions import PermissionDenied
 from rest_framework.generics import RetrieveUpdateAPIView
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from rest_framework_simplejwt.exceptions import TokenError
 from rest_framework_simplejwt.tokens import RefreshToken
-from channels.layers import get_channel_layer
 
+from communities.authorization import get_authorization
+from communities.comment_tree import CommentThread, COMMENT_SORTS, encode_cursor, decode_cursor, parse_position
+from communities.metrics import REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE
 from communities.models import Profile, Community, Topic, Moderator, Comment, TopicVote, CommentVote, Subscriber, \
     Notification, Ban, TopicClick, CommunityClick
+from communities.notifications import request_topic_fan_out, notify_user, \
+    notification_target, forget_unread_count, get_unread_count, mark_read_filters, mark_notifications_read, \
+    recent_notifications
+from communities.object_cache import get_profile_card, profile_user_id
 from communities.permissions import IsOwnerOrReadonly, IsOwnerOrReadonlyForUser, DoesUserDontHaveProfile, \
     IsNotAuthenticated, IsModerator, IsModeratorOfTopic, IsModeratorOfBan, \
     IsNotBannedFromCommunity, IsModeratorOfComment
+from communities.response_cache import cached_object_id, get_version, response_variant, validators, not_modified, \
+    payload_key
 from communities.serializers import ProfileSerializer, UserSerializer, UserRegisterSerializer, CommunitySerializer, \
-    TopicSerializer, CommentSerializer, NotificationSerializer, BanSerializer, SubscriberSerializer
+    TopicSerializer, CommentSerializer, NotificationSerializer, BanSerializer, SubscriberSerializer, \
+    CommentThreadSerializer
+from communities.timeline import read_timeline
 
 
 class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
+    cursor_ordering = ('-date_joined', '-id')
 
     @action(detail=False, methods=['get'])
     def am_i_authenticated(self, request):
@@ -37,7 +54,13 @@ class UserViewSet(viewsets.ModelViewSet):
 
     @action(detail=True, methods=['get'])
     def profile(self, request, pk):
-        profile = self.get_object().profile
+        # the card is cached with its karma, the user itself is not read
+        try:
+            profile = get_profile_card(int(pk))
+        except ValueError:
+            raise Http404
+        if profile is None:
+            raise Http404
         serializer = ProfileSerializer(profile, context={ 'request': request })
         return Response({ 'profile': serializer.data })
 
@@ -122,6 +145,15 @@ class ProfileViewSet(viewsets.ModelViewSet):
     queryset = Profile.objects.all()
     serializer_class = ProfileSerializer
     lookup_field = 'slug'
+    cursor_ordering = ('-id',)
+
+    def retrieve(self, request, *args, **kwargs):
+        user_id = profile_user_id(kwargs['slug'])
+        profile = get_profile_card(user_id) if user_id is not None else None
+        if profile is None:
+            raise Http404
+        serializer = self.get_serializer(profile)
+        return Response(serializer.data)
 
     def get_profile_and_topic(self, request):
         profile = self.get_object()
@@ -154,11 +186,13 @@ class ProfileViewSet(viewsets.ModelViewSet):
         if isinstance(result, Response):
             return result
         profile, topic = result
-        bans = Ban.objects.filter(user=profile.user, community=topic.community).order_by('-expires_at')
-        for ban in bans:
-            if ban.is_active():
-                serializer = BanSerializer(ban, context={'request': request})
-                return Response(serializer.data, status=status.HTTP_200_OK)
+        # permanent bans come first, postgres sorts nulls first in descending order
+        ban = Ban.objects.active().filter(
+            user_id=profile.user_id, community_id=topic.community_id
+        ).order_by('-expires_at').first()
+        if ban is not None:
+            serializer = BanSerializer(ban, context={'request': request})
+            return Response(serializer.data, status=status.HTTP_200_OK)
         return Response({'expires_at': ''}, status=status.HTTP_200_OK)
 
     def get_permissions(self):
@@ -180,12 +214,8 @@ class MyProfileView(RetrieveUpdateAPIView):
 
 class BanManager:
     @staticmethod
-    def is_user_banned(user, community):
-        bans = Ban.objects.filter(user=user, community=community)
-        for ban in bans:
-            if ban.is_active():
-                return True
-        return False
+    def is_user_banned(request, community):
+        return get_authorization(request).is_banned(community.id)
 
 class Clickable:
     click_class = None
@@ -197,46 +227,71 @@ class Clickable:
     def get_click_field(self):
         return self.click_field
 
+    def record_click(self, request, object_id):
+        # a user is counted at most once an hour, the cache keeps the
+        # repeated views of that hour away from the database
+        if not request.user.is_authenticated:
+            return
+        field = self.get_click_field()
+        if not cache.add(f'click:{field}:{object_id}:{request.user.id}', 1, 60*60):
+            return
+        click_filter = {'user_id': request.user.id, f'{field}_id': object_id}
+        last = self.get_click_class().objects.filter(**click_filter).order_by('-created_date').first()
+        if last is None or timezone.now() - last.created_date >= datetime.timedelta(hours=1):
+            self.get_click_class().objects.create(**click_filter)
+
     def retrieve(self, request, *args, **kwargs):
         obj = self.get_object()
-
-        def create_click():
-            self.get_click_class().objects.create(
-                user=request.user,
-                **{self.get_click_field(): obj}
-            )
-            print(f'created click for {self.click_field}')
-
-        if request.user.is_authenticated:
-            already = self.get_click_class().objects.filter(user=request.user, **{self.get_click_field(): obj})
-            if already.exists():
-                last = already[len(already) - 1]
-                if timezone.now() - last.created_date >= datetime.timedelta(hours=1):
-                    create_click()
-            else:
-                create_click()
-
+        self.record_click(request, obj.id)
         serializer = self.get_serializer(obj)
         return Response(serializer.data)
 
-class CommunityViewSet(Clickable, viewsets.ModelViewSet):
+class CachedRetrieve:
+    # detail payloads are cached per object version, conditional requests
+    # are answered with 304 from the version alone
+    response_cache_name = None
+
+    def retrieve(self, request, *args, **kwargs):
+        name = self.response_cache_name
+        object_id = cached_object_id(name, self.get_serializer_class().Meta.model, kwargs[self.lookup_field])
+        if object_id is None:
+            return super().retrieve(request, *args, **kwargs)
+        self.record_click(request, object_id)
+
+        version = get_version(name, object_id)
+        variant = response_variant(request)
+        headers = validators(name, object_id, version, variant)
+        if not_modified(request, headers):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        key = payload_key(name, object_id, version, variant)
+        data = cache.get(key)
+        if data is None:
+            data = dict(self.get_serializer(self.get_object()).data)
+            cache.set(key, data, settings.RESPONSE_CACHE_TTL)
+        return Response(data, headers=headers)
+
+class CommunityViewSet(CachedRetrieve, Clickable, viewsets.ModelViewSet):
     serializer_class = CommunitySerializer
     lookup_field = 'slug'
 
     click_class = CommunityClick
     click_field = 'community'
 
+    response_cache_name = 'community'
+
     @action(detail=True, methods=['get'])
     def topics(self, request, slug):
         community = self.get_object()
-        serializer = TopicSerializer(community.topics(), many=True, context={'request': request})
-        response = Response(serializer.data)
-        return response
+        context = {'request': request}
+        topics = self.paginate_queryset(TopicSerializer.prepare_queryset(community.topics(), context))
+        serializer = TopicSerializer(topics, many=True, context=context)
+        return self.get_paginated_response(serializer.data)
 
     @action(detail=True, methods=['get'])
     def am_i_mod(self, request, slug):
         community = self.get_object()
-        am_i_mod = Moderator.objects.filter(user=request.user, community=community).exists()
+        am_i_mod = get_authorization(request).is_moderator(community.id)
         return Response({'am_i_mod': am_i_mod}, status=status.HTTP_200_OK)
 
     @action(detail=True, methods=['post'])
@@ -268,18 +323,22 @@ class CommunityViewSet(Clickable, viewsets.ModelViewSet):
     @action(detail=True, methods=['get'])
     def am_i_banned(self, request, slug):
         return Response({'am_i_banned': BanManager.is_user_banned(
-            user=request.user,
+            request=request,
             community=self.get_object()
         )}, status=status.HTTP_200_OK)
 
+    def paginate_queryset(self, queryset):
+        # the list is only the five newest communities
+        if self.action == 'list':
+            return None
+        return super().paginate_queryset(queryset)
+
     def get_queryset(self):
-        queryset_length = 5
-        real_length = Community.objects.count()
-        if real_length < 5:
-            queryset_length = real_length
         qs = Community.objects.order_by('-created_date')
+        if self.action in ['list', 'retrieve']:
+            qs = CommunitySerializer.prepare_queryset(qs, self.get_serializer_context(), many=self.action == 'list')
         if self.action == 'list':
-            return qs[:queryset_length]
+            return qs[:5]
         return qs
 
     def get_permissions(self):
@@ -298,12 +357,55 @@ class Subscriptions(views.APIView):
 
     def get(self, request):
         user = request.user
-        subscribes = Subscriber.objects.filter(user=user).order_by('-joined_date')
-        subscribed_communities = [subscribe.community for subscribe in subscribes]
+        context = {'request': request}
+        subscribed_communities = CommunitySerializer.prepare_queryset(
+            Community.objects.filter(subscriber__user_id=user.id).order_by('-subscriber__joined_date'),
+            context
+        )
 
-        serializer = CommunitySerializer(subscribed_communities, many=True, context={'request': request})
+        serializer = CommunitySerializer(subscribed_communities, many=True, context=context)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+class HomeTimeline(views.APIView):
+    # newest topics of the subscribed communities, paginated with a `cursor`
+    # of the (score, topic id) position of the last topic
+    permission_classes = [permissions.IsAuthenticated]
+    max_limit = 50
+
+    def get(self, request):
+        try:
+            before = request.query_params.get('cursor', None)
+            if before is not None:
+                score, topic_id = decode_cursor(before)
+                before = (float(score), int(topic_id))
+                if not math.isfinite(before[0]):
+                    raise ValueError
+            limit = min(int(request.query_params.get('limit', 10)), self.max_limit)
+            if limit < 1:
+                raise ValueError
+        except (ValueError, TypeError):
+            return Response(
+                {'error': 'Invalid cursor or limit parameter'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        page = read_timeline(request.user, before=before, limit=limit)
+        context = {'request': request}
+        topics = TopicSerializer.prepare_queryset(
+            Topic.objects.filter(id__in=[topic_id for topic_id, _ in page]),
+            context
+        )
+        topics_by_id = {topic.id: topic for topic in topics}
+        # deleted topics are skipped, they are still in the timelines
+        ordered_topics = [topics_by_id[topic_id] for topic_id, _ in page if topic_id in topics_by_id]
+
+        next_url = None
+        if len(page) == limit:
+            topic_id, score = page[-1]
+            next_url = replace_query_param(request.build_absolute_uri(), 'cursor', encode_cursor([score, topic_id]))
+        serializer = TopicSerializer(ordered_topics, many=True, context=context)
+        return Response({'next': next_url, 'results': serializer.data}, status=status.HTTP_200_OK)
+
 class Votable:
     vote_class = None
     vote_field_name = None
@@ -372,7 +474,7 @@ class Votable:
         except self.get_vote_class().DoesNotExist:
             return Response({'value': 0}, status=status.HTTP_200_OK)
 
-class TopicViewSet(Clickable, Votable, viewsets.ModelViewSet):
+class TopicViewSet(CachedRetrieve, Clickable, Votable, viewsets.ModelViewSet):
     serializer_class = TopicSerializer
     lookup_field = 'slug'
 
@@ -382,15 +484,68 @@ class TopicViewSet(Clickable, Votable, viewsets.ModelViewSet):
     click_class = TopicClick
     click_field = 'topic'
 
+    response_cache_name = 'topic'
+
+    max_comment_depth = 10
+    max_comment_limit = 50
+
     @action(detail=True, methods=['get'])
     def am_i_banned(self, request, slug):
         return Response({'am_i_banned': BanManager.is_user_banned(
-            user=request.user,
+            request=request,
             community=self.get_object().community
         )}, status=status.HTTP_200_OK)
 
+    @action(detail=True, methods=['get'])
+    def comments(self, request, slug):
+        # loads a thread incrementally, `parent` selects the level,
+        # `cursor` continues it, `depth` limits how many levels are nested
+        # and `sort` is one of old, new, top and best
+        topic = self.get_object()
+        sort = request.query_params.get('sort', 'old')
+        try:
+            if sort not in COMMENT_SORTS:
+                raise ValueError
+            depth = min(int(request.query_params.get('depth', 2)), self.max_comment_depth)
+            limit = min(int(request.query_params.get('limit', 10)), self.max_comment_limit)
+            if depth < 1 or limit < 1:
+                raise ValueError
+            after = request.query_params.get('cursor', None)
+            if after is not None:
+                after = parse_position(sort, decode_cursor(after))
+        except (ValueError, TypeError):
+            return Response(
+                {'error': 'Invalid sort, depth, limit or cursor parameter'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        parent = None
+        parent_query = request.query_params.get('parent', None)
+        if parent_query is not None:
+            try:
+                parent = Comment.objects.filter(topic=topic, id=int(parent_query)).first()
+            except ValueError:
+                parent = None
+            if parent is None:
+                return Response(status=status.HTTP_404_NOT_FOUND)
+
+        comment_thread = CommentThread(topic, parent=parent, depth=depth, limit=limit, sort=sort, after=after)
+        serializer = CommentThreadSerializer(comment_thread.comments, many=True, context={
+            'request': request,
+            'comment_tree': comment_thread,
+        })
+        next_url = None
+        if comment_thread.has_next:
+            next_url = replace_query_param(
+                request.build_absolute_uri(), 'cursor', encode_cursor(comment_thread.next_position())
+            )
+        return Response({'next': next_url, 'results': serializer.data}, status=status.HTTP_200_OK)
+
     def get_queryset(self):
-        return Topic.objects.order_by('-created_date')
+        qs = Topic.objects.order_by('-created_date')
+        if self.action in ['list', 'retrieve']:
+            qs = TopicSerializer.prepare_queryset(qs, self.get_serializer_context(), many=self.action == 'list')
+        return qs
 
     def get_permissions(self):
         if self.action in ['create', 'up_vote', 'down_vote', 'remove_vote']:
@@ -402,33 +557,14 @@ class TopicViewSet(Clickable, Votable, viewsets.ModelViewSet):
         return [permissions.IsAuthenticatedOrReadOnly()]
 
     def perform_create(self, serializer):
-        user = self.request.user
         community = serializer.validated_data.get('community')
 
-        if BanManager.is_user_banned(user, community):
+        if BanManager.is_user_banned(self.request, community):
             raise PermissionDenied('You are banned from this community and cannot create topics in it.')
 
         topic = serializer.save(user=self.request.user)
-        subs = Subscriber.objects.filter(community=topic.community)
         url = serializer.data.get('url')
-
-        channel_layer = get_channel_layer()
-        for sub in subs:
-            notification = Notification.objects.create(
-                user=sub.user,
-                information='New Post on ' + topic.community.name,
-                direct_url=url
-            )
-
-            serialized = NotificationSerializer(notification, context={'request': self.request})
-
-            async_to_sync(channel_layer.group_send)(
-                f'user_{sub.user.id}',
-                {
-                    'type': 'notify',
-                    'notification': serialized.data
-                }
-            )
+        transaction.on_commit(lambda: request_topic_fan_out(topic, url))
 
 class CommentViewSet(Votable, viewsets.ModelViewSet):
     queryset = Comment.objects.all()
@@ -445,50 +581,26 @@ class CommentViewSet(Votable, viewsets.ModelViewSet):
         return [permissions.IsAuthenticatedOrReadOnly()]
 
     def perform_create(self, serializer):
-        user = self.request.user
         community = serializer.validated_data.get('topic').community
 
-        if BanManager.is_user_banned(user, community):
+        if BanManager.is_user_banned(self.request, community):
             raise PermissionDenied('You are banned from this community and cannot create topics in it.')
 
         comment = serializer.save(user=self.request.user)
         url = serializer.data.get('url')
 
-        channel_layer = get_channel_layer()
+        # comments under the same post or comment are merged into one notification
         if comment.upper_comment is None:
-            user = comment.topic.user
-            notification = Notification.objects.create(
-                user=user,
-                information='Someone commented on your post!',
-                direct_url=url
-            )
-            serialized = NotificationSerializer(notification)
-            async_to_sync(channel_layer.group_send)(
-                f'user_{user.id}',
-                {
-                    'type': 'notify',
-                    'notification': serialized.data
-                }
-            )
+            notify_user(comment.topic.user_id, Notification.Kind.COMMENT,
+                        notification_target(comment.topic), url)
         else:
-            user = comment.upper_comment.user
-            notification = Notification.objects.create(
-                user=user,
-                information='Someone replied to your comment!',
-                direct_url=url
-            )
-            serialized = NotificationSerializer(notification)
-            async_to_sync(channel_layer.group_send)(
-                f'user_{user.id}',
-                {
-                    'type': 'notify',
-                    'notification': serialized.data
-                }
-            )
+            notify_user(comment.upper_comment.user_id, Notification.Kind.REPLY,
+                        notification_target(comment.upper_comment), url)
 
 class BanViewSet(viewsets.ModelViewSet):
     queryset = Ban.objects.all()
     serializer_class = BanSerializer
+    cursor_ordering = ('-created_at', '-id')
 
     def get_permissions(self):
         if self.action in ['create', 'partial_update', 'update', 'destroy']:
@@ -499,21 +611,7 @@ class BanViewSet(viewsets.ModelViewSet):
     def perform_create(self, serializer):
         ban = serializer.save()
         url = serializer.data.get('url')
-        user = ban.user
-        notification = Notification.objects.create(
-            user=user,
-            information='You have been banned from a community',
-            direct_url=url
-        )
-        serialized = NotificationSerializer(notification)
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            f'user_{user.id}',
-            {
-                'type': 'notify',
-                'notification': serialized.data
-            }
-        )
+        notify_user(ban.user_id, Notification.Kind.BAN, notification_target(ban), url)
 
 class SearchAPI(views.APIView):
     permission_classes = [permissions.AllowAny]
@@ -528,20 +626,23 @@ class SearchAPI(views.APIView):
             Q(text__icontains=query) |
             Q(comments__text__icontains=query)
         ).distinct().annotate(
-            vote_count=Count('topicvote'),
-            view_count=Count('topicclick'),
+            vote_number=Count('topicvote'),
+            view_number=Count('topicclick'),
             score=ExpressionWrapper(
-                F('vote_count') + F('view_count'),
+                F('vote_number') + F('view_number'),
                 output_field=IntegerField()
             )
-        ).order_by('-score')[:5]
+        ).order_by('-score')
 
-        serializer = TopicSerializer(search_results, many=True, context={'request': request})
+        context = {'request': request}
+        search_results = TopicSerializer.prepare_queryset(search_results, context)[:5]
+        serializer = TopicSerializer(search_results, many=True, context=context)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 class SubscriberViewSet(viewsets.ModelViewSet):
     queryset = Subscriber.objects.all()
     serializer_class = SubscriberSerializer
+    cursor_ordering = ('-joined_date', '-id')
 
     def get_permissions(self):
         if self.action in ['create', 'partial_update', 'update', 'destroy']:
@@ -552,4 +653,41 @@ class SubscriberViewSet(viewsets.ModelViewSet):
 class NotificationViewSet(viewsets.ModelViewSet):
     queryset = Notification.objects.all()
     serializer_class = NotificationSerializer
-    permission_classes = [permissions.IsAuthenticated]
\ No newline at end of file
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return recent_notifications().filter(user_id=self.request.user.id)
+
+    @action(detail=False, methods=['post'])
+    def mark_read(self, request):
+        try:
+            filters = mark_read_filters(request.data)
+        except (TypeError, ValueError) as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        marked = mark_notifications_read(request.user.id, filters)
+        return Response({
+            'marked': marked,
+            'unread_count': get_unread_count(request.user.id)
+        }, status=status.HTTP_200_OK)
+
+    # the cached unread count is counted again after changes made here
+    def perform_update(self, serializer):
+        notification = serializer.save()
+        forget_unread_count(notification.user_id)
+
+    def perform_destroy(self, instance):
+        user_id = instance.user_id
+        instance.delete()
+        forget_unread_count(user_id)
+
+class MetricsView(views.APIView):
+    # prometheus scrape endpoint, with METRICS_TOKEN set the scraper sends
+    # it as a bearer token
+    authentication_classes = []
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request):
+        token = settings.METRICS_TOKEN
+        if token and not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+        return HttpResponse(REGISTRY.render(), content_type=METRICS_CONTENT_TYPE)
\ No newline at end of file
@@ -1,3 +1,32 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+import redis
+
+from communities.tests import CommunityTestCase
+
+
+class TrendingTests(CommunityTestCase):
+    def test_trending_is_empty_without_redis(self):
+        client = mock.Mock(pipeline=mock.Mock(side_effect=redis.ConnectionError))
+        with mock.patch('communities.trending.get_redis', return_value=client), \
+                self.assertLogs('communities.trending', 'WARNING'):
+            for url in ['/stats/trending_communities/', '/stats/trending_topics/']:
+                with self.subTest(url=url):
+                    response = self.client.get(url)
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(response.data, [])
+
+
+class ActivityOfWebsiteTests(CommunityTestCase):
+    def test_approx_flag_is_parsed_strictly(self):
+        for approx in ['no', 'yes', '2', '']:
+            with self.subTest(approx=approx):
+                response = self.client.get(f'/stats/activity_of_website/?approx={approx}')
+                self.assertEqual(response.status_code, 400)
+
+    def test_every_mode_returns_the_same_keys(self):
+        for query in ['', '?approx=0', '?approx=1', '?approx=false&time=24', '?approx=true&time=24']:
+            with self.subTest(query=query):
+                response = self.client.get(f'/stats/activity_of_website/{query}')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(set(response.data), {'activity_count', 'active_users', 'approximate'})
@@ -1,7 +1,7 @@
 from django.urls import path
 
 from stats.views import MostSubscribedCommunities, MostKarmaProfiles, HotTopics, MostViewedCommunities, Recommendation, \
-    ActivityOfWebsite
+    ActivityOfWebsite, TrendingCommunities, TrendingTopics
 
 app_name = 'stats'
 urlpatterns = [
@@ -11,4 +11,6 @@ urlpatterns = [
     path('most_subscribed_communities/', MostSubscribedCommunities.as_view(), name='most_subscribed_communities'),
     path('most_karma_profiles/', MostKarmaProfiles.as_view(), name='most_karma_profiles'),
     path('activity_of_website/', ActivityOfWebsite.as_view(), name='activity_of_website'),
+    path('trending_communities/', TrendingCommunities.as_view(), name='trending_communities'),
+    path('trending_topics/', TrendingTopics.as_view(), name='trending_topics'),
 ]
\ No newline at end of file
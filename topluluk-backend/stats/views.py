@@ -1,30 +1,61 @@
 import datetime
+import logging
 
-from django.db.models import Count, ExpressionWrapper, F, Sum, Q
-from django.db.models.fields import IntegerField
+import redis
+from django.conf import settings
+from django.db import connection, transaction
 from django.utils import timezone
 from rest_framework import views, status, permissions
 from rest_framework.response import Response
 
-from communities.models import Community, Topic, Profile, TopicVote, CommentVote, TopicClick, Subscriber, \
+from communities.activity import estimated_row_counts, windowed_activity
+from communities.annotations import community_subscriber_total, community_view_total, profile_karma_total
+from communities.cache import TieredCache
+from communities.metrics import VECTOR_QUERY_SECONDS
+from communities.models import Community, Topic, Profile, TopicVote, CommentVote, TopicClick, \
     CommunityClick, Comment
+from communities.object_cache import get_communities, get_profile_cards, get_topic_cards
+from communities.pagination import KeysetCursorPagination
+from communities.response_cache import response_variant
 from communities.serializers import CommunitySerializer, TopicSerializer, ProfileSerializer
+from communities.trending import trending, COMMUNITIES, TOPICS
 
+logger = logging.getLogger(__name__)
+
+# the stats are shown on the landing page, every result is cached per
+# endpoint and time window and recomputed by one worker at a time
+stats_cache = TieredCache('stats', ttl=settings.STATS_CACHE_TTL, stale_ttl=settings.STATS_CACHE_STALE_TTL,
+                          refresh_ahead=settings.STATS_CACHE_REFRESH_AHEAD,
+                          fallback_ttl=settings.STATS_CACHE_FALLBACK_TTL)
+
+
+def cached_stat(key, compute):
+    def recompute():
+        # a slow recomputation is cancelled by the database and the last
+        # good result is served instead
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('SET LOCAL statement_timeout = %s', [settings.STATS_STATEMENT_TIMEOUT])
+            return compute()
+
+    return stats_cache.get(key, recompute)
+
+
+class HotTopicsPagination(KeysetCursorPagination):
+    ordering = ('-hot_score', '-id')
 
 class HotTopics(views.APIView):
-    # today`s hot topics
+    # today`s hot topics, every page is cached with its links
     def get(self, request):
+        return Response(cached_stat(f'hot_topics:{response_variant(request)}', lambda: self.hot_topics(request)))
+
+    def hot_topics(self, request):
         one_day_ago = timezone.now() - datetime.timedelta(days=1)
-        result = Topic.objects.filter(created_date__gt=one_day_ago).annotate(
-            vote_value=Sum('topicvote__value'),
-            view_value=Count('topicclick'),
-            score=ExpressionWrapper(
-                F('view_value') + F('vote_value') * 5,
-                output_field=IntegerField()
-            )
-        ).order_by('-score')
-        serializer = TopicSerializer(result, many=True, context={'request': request})
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        result = Topic.objects.filter(created_date__gt=one_day_ago)
+        context = {'request': request}
+        paginator = HotTopicsPagination()
+        result = paginator.paginate_queryset(TopicSerializer.prepare_queryset(result, context), request, view=self)
+        serializer = TopicSerializer(result, many=True, context=context)
+        return paginator.get_paginated_response(serializer.data).data
 
 class Recommendation(views.APIView):
     permission_classes = [permissions.IsAuthenticated]
@@ -46,94 +77,188 @@ class Recommendation(views.APIView):
             embedding__isnull=False
         ).order_by(
             CosineDistance('embedding', profile.interest_vector)
-        )[:limit]
+        )
 
-        serializer = TopicSerializer(similar_topics, many=True, context={'request': request})
+        context = {'request': request}
+        with VECTOR_QUERY_SECONDS.time(query='recommendations'):
+            similar_topics = list(TopicSerializer.prepare_queryset(similar_topics, context)[:limit])
+        serializer = TopicSerializer(similar_topics, many=True, context=context)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
-class MostSubscribedCommunities(views.APIView):
-    def get(self, request):
-        time_query = request.query_params.get('time', None)
-        community_query = Community.objects.all()
-        if time_query is not None:
-            try:
-                hours = int(time_query)
-                real_time = timezone.now() - datetime.timedelta(hours=hours)
-                communities = sorted(community_query, key=lambda c: c.subscriber_count_after(real_time), reverse=True)[:5]
-                context = {'request': request, 'subscriber_count_after_time': real_time}
-            except (ValueError, TypeError):
-                return Response(
-                    {'error': 'Invalid time parameter'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-        else:
-            communities = sorted(community_query, key=lambda c: c.subscriber_count(), reverse=True)[:5]
-            context = {'request': request}
+class Leaderboard(views.APIView):
+    # the top five of a ranking. the ranked ids with their counters are
+    # cached per time window, the objects come from the shared object caches
+    # so changes to them show up before the ranking is recomputed
+    name = None
+    model = None
+    serializer_class = None
+    ranking = None
+    key_field = 'id'
+    total_annotation = None
+    after_annotation = None
+    expand = None
+    after_time_context = None
+    # maps a list of keys to a dict of the objects found
+    object_loader = None
+    size = 5
 
-        serializer = CommunitySerializer(communities, many=True, context=context)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+    def rank(self, annotation, after_time):
+        queryset = self.model.objects.annotate(**{annotation: self.ranking(after_time)}).order_by(f'-{annotation}')
+        return list(queryset.values_list(self.key_field, annotation)[:self.size])
 
-class MostViewedCommunities(views.APIView):
     def get(self, request):
         time_query = request.query_params.get('time', None)
-        community_query = Community.objects.all()
         if time_query is not None:
             try:
                 hours = int(time_query)
                 real_time = timezone.now() - datetime.timedelta(hours=hours)
-                communities = sorted(community_query, key=lambda c: c.view_count_after(real_time), reverse=True)[:5]
-                context = {'request': request, 'view_count_after_time': real_time}
             except (ValueError, TypeError):
                 return Response(
                     {'error': 'Invalid time parameter'},
                     status=status.HTTP_400_BAD_REQUEST
                 )
+            annotation = self.after_annotation
+            context = {'request': request, self.after_time_context: real_time}
         else:
-            communities = sorted(community_query, key=lambda c: c.total_view_count(), reverse=True)[:5]
-            context = {'request': request}
+            hours = None
+            real_time = None
+            annotation = self.total_annotation
+            context = {'request': request, 'expand': [self.expand]}
 
-        serializer = CommunitySerializer(communities, many=True, context=context)
+        ranked = cached_stat(f'{self.name}:{hours}', lambda: self.rank(annotation, real_time))
+        objects = self.object_loader([key for key, _ in ranked])
+        result = []
+        for key, value in ranked:
+            if key in objects:
+                setattr(objects[key], annotation, value)
+                result.append(objects[key])
+        serializer = self.serializer_class(result, many=True, context=context)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
-class MostKarmaProfiles(views.APIView):
+class MostSubscribedCommunities(Leaderboard):
+    name = 'most_subscribed_communities'
+    model = Community
+    serializer_class = CommunitySerializer
+    ranking = staticmethod(community_subscriber_total)
+    total_annotation = 'subscriber_total'
+    after_annotation = 'subscriber_total_after'
+    expand = 'subscriber_count'
+    after_time_context = 'subscriber_count_after_time'
+    object_loader = staticmethod(get_communities)
+
+class MostViewedCommunities(Leaderboard):
+    name = 'most_viewed_communities'
+    model = Community
+    serializer_class = CommunitySerializer
+    ranking = staticmethod(community_view_total)
+    total_annotation = 'view_total'
+    after_annotation = 'view_total_after'
+    expand = 'total_view_count'
+    after_time_context = 'view_count_after_time'
+    object_loader = staticmethod(get_communities)
+
+class MostKarmaProfiles(Leaderboard):
+    name = 'most_karma_profiles'
+    model = Profile
+    serializer_class = ProfileSerializer
+    ranking = staticmethod(profile_karma_total)
+    key_field = 'user_id'
+    total_annotation = 'karma_total'
+    after_annotation = 'karma_total_after'
+    expand = 'karma'
+    after_time_context = 'karma_after_time'
+    object_loader = staticmethod(get_profile_cards)
+
+class Trending(views.APIView):
+    # the most interacted with objects of the last `?minutes=` minutes, ranked
+    # in redis and served from the object caches without the database
+    kind = None
+    serializer_class = None
+    # maps a list of ids to a dict of the objects found
+    object_loader = None
+    size = 5
+
     def get(self, request):
-        time_query = request.query_params.get('time', None)
-        profile_query = Profile.objects.all()
-        if time_query is not None:
-            try:
-                hours = int(time_query)
-                real_time = timezone.now() - datetime.timedelta(hours=hours)
-                profiles = sorted(profile_query, key=lambda p: p.karma_after(real_time), reverse=True)[:5]
-                context = {'request': request, 'karma_after_time': real_time}
-            except (ValueError, TypeError):
-                return Response(
-                    {'error': 'Invalid time parameter'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-        else:
-            profiles = sorted(profile_query, key=lambda p: p.karma(), reverse=True)[:5]
-            context = {'request': request}
-        serializer = ProfileSerializer(profiles, many=True, context=context)
+        try:
+            minutes = int(request.query_params.get('minutes', settings.TRENDING_WINDOW_MINUTES))
+        except (ValueError, TypeError):
+            return Response(
+                {'error': 'Invalid minutes parameter'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        minutes = max(1, min(minutes, settings.TRENDING_MAX_WINDOW_MINUTES))
+        ranked = trending(self.kind, self.size, minutes)
+        objects = self.object_loader([object_id for object_id, _ in ranked])
+        result = [objects[object_id] for object_id, _ in ranked if object_id in objects]
+        serializer = self.serializer_class(result, many=True, context={'request': request})
         return Response(serializer.data, status=status.HTTP_200_OK)
 
+class TrendingCommunities(Trending):
+    kind = COMMUNITIES
+    serializer_class = CommunitySerializer
+    object_loader = staticmethod(get_communities)
+
+class TrendingTopics(Trending):
+    kind = TOPICS
+    serializer_class = TopicSerializer
+    object_loader = staticmethod(get_topic_cards)
+
 class ActivityOfWebsite(views.APIView):
+    # ?approx=1 counts from planner estimates and redis counters in bounded
+    # time, ?approx=0 counts exactly. without it the counts are approximate
+    # once the tables together hold more than ACTIVITY_EXACT_COUNT_LIMIT rows.
+    # active_users is only counted by the redis counters, otherwise it is None
     all_activities = [Topic, Comment, Community, TopicClick, CommunityClick, TopicVote, CommentVote]
+    approx_values = {'1': True, 'true': True, '0': False, 'false': False}
 
     def get(self, request):
         time_query = request.query_params.get('time', None)
-        activity_count = 0
+        real_time = None
+        hours = None
         if time_query is not None:
             try:
                 hours = int(time_query)
                 real_time = timezone.now() - datetime.timedelta(hours=hours)
-                for activity in self.all_activities:
-                    activity_count += activity.objects.filter(created_date__gt=real_time).count()
             except (ValueError, TypeError):
                 return Response(
                     {'error': 'Invalid time parameter'},
                     status=status.HTTP_400_BAD_REQUEST
                 )
-        else:
-            for activity in self.all_activities:
-                activity_count += activity.objects.count()
-        return Response({'activity_count': activity_count}, status=status.HTTP_200_OK)
\ No newline at end of file
+        approx = request.query_params.get('approx', None)
+        if approx is not None and approx.lower() not in self.approx_values:
+            return Response(
+                {'error': 'Invalid approx parameter'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        approximate = None if approx is None else self.approx_values[approx.lower()]
+        result = cached_stat(f'activity_of_website:{hours}:{approximate}',
+                             lambda: self.count(hours, real_time, approximate))
+        return Response(result, status=status.HTTP_200_OK)
+
+    def count(self, hours, after_time, approximate):
+        estimates = estimated_row_counts(self.all_activities) if approximate is not False else {}
+        if approximate is None:
+            approximate = sum(estimates.values()) > settings.ACTIVITY_EXACT_COUNT_LIMIT
+        if approximate and after_time is None:
+            # tables without an estimate yet are small enough to count
+            activity_count = sum(
+                estimates[activity] if activity in estimates else activity.objects.count()
+                for activity in self.all_activities
+            )
+            return {'activity_count': activity_count, 'active_users': None, 'approximate': True}
+        if approximate and hours <= settings.ACTIVITY_RETENTION_HOURS:
+            try:
+                activity_count, active_users = windowed_activity(hours)
+                return {'activity_count': activity_count, 'active_users': active_users, 'approximate': True}
+            except redis.RedisError:
+                logger.warning('activity counters are not available, counting exactly', exc_info=True)
+        return {'activity_count': self.count_activities(after_time), 'active_users': None, 'approximate': False}
+
+    def count_activities(self, after_time):
+        activity_count = 0
+        for activity in self.all_activities:
+            queryset = activity.objects.all()
+            if after_time is not None:
+                queryset = queryset.filter(created_date__gt=after_time)
+            activity_count += queryset.count()
+        return activity_count
@@ -1,5 +1,5 @@
 import * as React from 'react';
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import AppBar from '@mui/material/AppBar';
 import Box from '@mui/material/Box';
 import Toolbar from '@mui/material/Toolbar';
@@ -38,8 +38,13 @@ function ResponsiveAppBar() {
   const { isAuthenticated, logout } = useAuth()
   const [username, setUsername] = useState<string>('')
   const [profilePicture, setProfilePicture] = useState<string>('')
-  const [notificationCount, setNotificationCount] = useState<number>(0)
   const [notifications, setNotifications] = useState<NotificationResponse[]>([])
+  const [notificationCount, setNotificationCount] = useState<number>(0)
+  // newest notification id this client has, reconnects only fetch what came after it
+  const lastNotificationId = useRef<number | null>(null)
+  // read by the socket handler, which keeps the state of its first render
+  const notificationsRef = useRef<NotificationResponse[]>([])
+  notificationsRef.current = notifications
   const navigate = useNavigate()
 
   const handleOpenUserMenu = (event: React.MouseEvent<HTMLElement>) => {
@@ -74,35 +79,99 @@ function ResponsiveAppBar() {
         console.error(error)
       })
 
-    const ws = getWebSocket()
-    ws.onopen = () => {
-        console.log("WebSocket connected");
-        ws.send(JSON.stringify({
-          'type': 'unread_notifications',
-        }))
-    };
+    // merged notifications replace the unread one of the same target
+    const addNotifications = (added: NotificationResponse[]) => {
+      added.forEach(notification => {
+        if (notification.id !== null && notification.id > (lastNotificationId.current ?? 0))
+          lastNotificationId.current = notification.id
+      })
+      const merges = (prew: NotificationResponse, notification: NotificationResponse) =>
+        !prew.is_read && notification.target && prew.kind === notification.kind && prew.target === notification.target
+      setNotifications(prewNotifications => [
+        ...prewNotifications.filter(prew => !added.some(notification =>
+          (notification.id !== null && prew.id === notification.id) || merges(prew, notification)
+        )),
+        ...added.map(notification => {
+          // a community broadcast counts on from the notification it merges into,
+          // with the same text the server writes to the merged row
+          const merged = notification.merged_information
+            ? prewNotifications.find(prew => merges(prew, notification))
+            : undefined
+          if (merged === undefined)
+            return notification
+          const count = merged.count + 1
+          return { ...notification, id: merged.id, count: count, information: `${count}${notification.merged_information}` }
+        })
+      ])
+    }
+
+    let closed = false
+    const connect = () => {
+      const ws = getWebSocket()
+      ws.onopen = () => {
+          console.log("WebSocket connected");
+          if (lastNotificationId.current === null) {
+            ws.send(JSON.stringify({
+              'type': 'unread_notifications',
+            }))
+          }
+          else {
+            ws.send(JSON.stringify({
+              'type': 'resume',
+              'payload': { 'last_id': lastNotificationId.current }
+            }))
+          }
+      };
 
-    ws.onerror = (err) => {
-        console.error("WebSocket error", err);
-    };
+      ws.onerror = (err) => {
+          console.error("WebSocket error", err);
+      };
 
-    ws.onmessage = (e) => {
-      const data = JSON.parse(e.data)
-      if (data.type === 'notification') {
-        setNotificationCount(prewCount => prewCount + 1)
-        setNotifications(prewNotifications => [...prewNotifications, data.payload])
+      ws.onclose = () => {
+        if (!closed)
+          setTimeout(connect, 3000)
       }
-      else if (data.type === 'unread_notifications') {
-        data.payload.map((notification: NotificationResponse) => {
-          if (!notification.is_read) {
-            setNotificationCount(prewCount => prewCount + 1)
+
+      ws.onmessage = (e) => {
+        // notifications that arrive together come as one array frame
+        const frame = JSON.parse(e.data)
+        const messages = Array.isArray(frame) ? frame : [frame]
+        const notifications: NotificationResponse[] = []
+        messages.forEach(data => {
+          if (data.type === 'notification') {
+            if (data.unread_count !== undefined)
+              setNotificationCount(data.unread_count)
+            // community broadcasts come without a count, they add one unless
+            // they merge into an unread notification of the same target
+            else if (![...notificationsRef.current, ...notifications].some(prew =>
+              !prew.is_read && prew.kind === data.payload.kind && prew.target === data.payload.target))
+              setNotificationCount(count => count + 1)
+            notifications.push(data.payload)
+          }
+          else if (data.type === 'notifications_collapsed') {
+            // the server skipped notifications of a burst, fetch what was missed
+            ws.send(JSON.stringify({
+              'type': 'resume',
+              'payload': { 'last_id': lastNotificationId.current ?? 0 }
+            }))
+          }
+          else if (data.type === 'unread_notifications' || data.type === 'missed_notifications') {
+            notifications.push(...[...data.payload.results].reverse())
+            setNotificationCount(data.payload.unread_count)
+          }
+          else if (data.type === 'marked_read') {
+            setNotificationCount(data.payload.unread_count)
           }
-          setNotifications(prewNots => [...prewNots, notification])
         })
+        if (notifications.length > 0)
+          addNotifications(notifications)
       }
     }
+    connect()
 
     return () => {
+      closed = true
+      lastNotificationId.current = null
       closeWebSocket()
     }
 
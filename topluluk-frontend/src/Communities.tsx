@@ -28,7 +28,7 @@ function Communities({ message = 'Recent Communities', url = 'community/' }: Com
     useEffect(() => {
         const fetchCommunities = async () => {
             try {
-                const response = await apiClient.get(url)
+                const response = await apiClient.get(url, { params: { expand: 'subscriber_count' } })
                 let communitiesData = response.data.results
                 if (communitiesData === undefined) {
                     communitiesData = response.data
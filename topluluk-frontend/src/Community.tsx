@@ -42,7 +42,7 @@ function Community() {
 
             try {
                 const response = await apiClient.get(`community/${slug}/topics/`)
-                const topicsResponse = response.data
+                const topicsResponse = response.data.results
 
                 const topicPromises = topicsResponse.map(async (topicResponse: TopicResponse) => {
                     return topicResponseToTopic(topicResponse, isAuthenticated)
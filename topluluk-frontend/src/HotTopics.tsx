@@ -27,7 +27,7 @@ function HotTopics() {
         const fetchData = async () => {
             try {
                 const response = await apiClient.get('stats/hot_topics/')
-                const topicsResponse = response.data
+                const topicsResponse = response.data.results
 
                 const topicPromises = topicsResponse.map(async (topicResponse: TopicResponse) => {
                     let amIBanned = false
@@ -31,6 +31,7 @@ export interface Topic {
     voteCount: number,
     viewCount: number,
     slug: string,
+    commentCount: number,
     comments: CommentResponse[],
     vote: number, // users vote that is to handle frontend rendering
 }
@@ -61,7 +62,8 @@ export const topicResponseToTopic = async (topicResponse: TopicResponse, isAuthe
         voteCount: topicResponse.vote_count,
         viewCount: topicResponse.view_count,
         slug: topicResponse.slug,
-        comments: topicResponse.comments,
+        commentCount: topicResponse.comment_count,
+        comments: topicResponse.comments ?? [],
         vote: voteResponse.data.value,
     }
     return topic
@@ -2,7 +2,7 @@ import React from 'react'
 import { Avatar, Box, Card, CardActionArea, CardActions, CardMedia, Grid, IconButton, ToggleButton, ToggleButtonGroup, Typography, Menu, MenuItem } from "@mui/material"
 import { ArrowDownward, ArrowUpward, Comment, Delete, Block } from "@mui/icons-material"
 import { formatDate } from "./responseTypes"
-import { calcualteCommentCount, type Topic } from './Topic'
+import { type Topic } from './Topic'
 import ProfileTooltip from './ProfileTooltip'
 
 interface TopicCardProps {
@@ -296,7 +296,7 @@ const TopicCard = ({
                                     fontSize: '0.875rem'
                                 }}
                             >
-                                {calcualteCommentCount(topic.comments)}
+                                {topic.commentCount}
                             </Typography>
                         </Box>
                     </Box>
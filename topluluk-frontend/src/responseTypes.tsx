@@ -8,7 +8,8 @@ export interface TopicResponse {
     user: string,
     vote_count: number,
     view_count: number,
-    comments: CommentResponse[],
+    comment_count: number,
+    comments?: CommentResponse[], // only in topic detail unless requested with ?expand=comments
     slug: string,
 }
 
@@ -26,8 +27,13 @@ export interface CommentResponse {
 }
 
 export interface NotificationResponse {
-    id: number,
+    id: number | null,
+    kind: string,
+    target: string,
+    count: number,
     information: string,
+    // community broadcasts only, the text after the count of a merged notification
+    merged_information?: string | null,
     direct_url: string,
     created_date: string,
     is_read: boolean,